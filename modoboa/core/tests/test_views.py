@@ -93,7 +93,9 @@ SETTINGS_SAMPLE = {
     "core-password_recovery_msg": "",
     "core-ldap_dovecot_sync": False,
     "maillog-logfile": "/var/log/mail.log",
+    "maillog-statistics_backend": "rrd",
     "maillog-rrd_rootdir": "/tmp",
+    "maillog-maillog_maximum_age": 365,
     "maillog-greylist": False,
     "pdfcredentials-enabled_pdfcredentials": True,
     "pdfcredentials-storage_dir": "./",
@@ -1,5 +1,5 @@
 from django.conf import settings
-from django.db import connection
+from django.db import NotSupportedError, connection, migrations
 from django.utils.translation import gettext as _
 
 from modoboa.lib.exceptions import InternalError
@@ -24,3 +24,37 @@ def db_type(cname="default"):
         if settings.DATABASES[cname]["ENGINE"].find(t) != -1:
             return t
     return None
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """Add an index without locking writes on PostgreSQL.
+
+    Other engines create the index the usual way. Migrations using this
+    operation must be non atomic.
+    """
+
+    def _use_concurrently(self, schema_editor):
+        if schema_editor.connection.vendor != "postgresql":
+            return False
+        if schema_editor.connection.in_atomic_block:
+            raise NotSupportedError(
+                "AddIndexConcurrently cannot be used inside a transaction. "
+                "Set atomic = False on the Migration class."
+            )
+        return True
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if not self._use_concurrently(schema_editor):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+            return
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if not self._use_concurrently(schema_editor):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+            return
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
@@ -1,9 +1,258 @@
 """Pagination utilities."""
 
-from rest_framework import pagination
+import base64
+import binascii
+from collections import OrderedDict
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework import exceptions, pagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
 
 class CustomPageNumberPagination(pagination.PageNumberPagination):
 
     page_size = 50
     page_size_query_param = "page_size"
+
+
+def estimate_count(queryset):
+    """Return the number of rows estimated by the PostgreSQL planner.
+
+    None is returned for other database engines.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class CappedCountPaginator(Paginator):
+    """Paginator which stops counting rows after a limit.
+
+    Beyond the limit, the count is estimated (when possible) or
+    capped, and ``count_exact`` is False.
+    """
+
+    def __init__(self, *args, count_limit=None, estimate=True, **kwargs):
+        """Constructor."""
+        super().__init__(*args, **kwargs)
+        self.count_limit = count_limit
+        self.estimate = estimate
+        self.count_exact = True
+
+    @cached_property
+    def count(self):
+        if not self.count_limit:
+            return super().count
+        count = self.object_list.order_by()[: self.count_limit + 1].count()
+        if count <= self.count_limit:
+            return count
+        self.count_exact = False
+        if self.estimate:
+            estimation = estimate_count(self.object_list)
+            if estimation is not None:
+                return max(estimation, count)
+        return self.count_limit
+
+
+class KeysetPageNumberPagination(CustomPageNumberPagination):
+    """Page number or keyset pagination.
+
+    Page numbers are used by default, with an exact count.
+
+    When the ``cursor`` parameter is given (empty for the first page),
+    results are ordered by ``(keyset_field, pk)`` and pages are
+    selected using the position of the last row seen, so the cost of a
+    page does not depend on its position. The ``ordering`` parameter
+    can only be ``keyset_field`` (ascending) or ``-keyset_field``
+    (descending, the default). No count is done unless ``count=true``
+    is given.
+
+    In both modes, ``count=capped`` limits the count to ``count_limit``
+    rows (estimated beyond when possible).
+    """
+
+    keyset_field = None
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+    capped_count_value = "capped"
+    count_limit = 10000
+    estimate_count = True
+    invalid_cursor_message = _("Invalid cursor")
+    invalid_ordering_message = _("Unsupported ordering with a cursor")
+
+    def django_paginator_class(self, queryset, page_size):
+        return CappedCountPaginator(
+            queryset,
+            page_size,
+            count_limit=self.get_count_limit() if self.capped_count else None,
+            estimate=self.estimate_count,
+        )
+
+    def get_count_limit(self):
+        return self.count_limit
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor = None
+        count = request.query_params.get(self.count_query_param)
+        self.capped_count = count == self.capped_count_value
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view)
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        ordering = request.query_params.get(api_settings.ORDERING_PARAM, "")
+        ordering = ordering.strip() or "-" + self.keyset_field
+        if ordering not in (self.keyset_field, "-" + self.keyset_field):
+            raise exceptions.ValidationError(
+                {api_settings.ORDERING_PARAM: [self.invalid_ordering_message]}
+            )
+        self.descending = ordering.startswith("-")
+        field = queryset.model._meta.get_field(self.keyset_field)
+        self.cursor = self.decode_cursor(request, field)
+        value, pk, backwards = self.cursor
+        self.count = None
+        if self.capped_count or count in ("1", "true"):
+            paginator = self.django_paginator_class(queryset, self.page_size)
+            self.count = paginator.count
+            self.count_exact = paginator.count_exact
+
+        descending = self.descending != backwards
+        if pk is not None:
+            if descending:
+                condition = Q(**{"{}__lt".format(self.keyset_field): value}) | Q(
+                    pk__lt=pk
+                )
+                bound = "{}__lte".format(self.keyset_field)
+            else:
+                condition = Q(**{"{}__gt".format(self.keyset_field): value}) | Q(
+                    pk__gt=pk
+                )
+                bound = "{}__gte".format(self.keyset_field)
+            queryset = queryset.filter(Q(**{bound: value}) & condition)
+        prefix = "-" if descending else ""
+        queryset = queryset.order_by(prefix + self.keyset_field, prefix + "pk")
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if backwards:
+            results.reverse()
+            self.has_next = pk is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = pk is not None
+        self.page_results = results
+        return results
+
+    def decode_cursor(self, request, field):
+        """Return the (value, pk, backwards) position of a cursor."""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return (None, None, False)
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+            return (field.to_python(data["v"]), int(data["p"]), bool(data["r"]))
+        except (
+            binascii.Error,
+            KeyError,
+            TypeError,
+            ValueError,
+            ValidationError,
+        ):
+            raise exceptions.NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, obj, backwards):
+        """Return the cursor of the page after (or before) obj."""
+        field = obj._meta.get_field(self.keyset_field)
+        data = {"v": field.value_to_string(obj), "p": obj.pk, "r": int(backwards)}
+        encoded = base64.urlsafe_b64encode(json.dumps(data).encode()).decode("ascii")
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.cursor is None:
+            return super().get_next_link()
+        if not self.has_next or not self.page_results:
+            return None
+        return self.encode_cursor(self.page_results[-1], False)
+
+    def get_previous_link(self):
+        if self.cursor is None:
+            return super().get_previous_link()
+        if not self.has_previous:
+            return None
+        if not self.page_results:
+            url = self.request.build_absolute_uri()
+            return replace_query_param(url, self.cursor_query_param, "")
+        return self.encode_cursor(self.page_results[0], True)
+
+    def get_paginated_response(self, data):
+        if self.cursor is None:
+            return Response(
+                OrderedDict(
+                    [
+                        ("count", self.page.paginator.count),
+                        ("count_exact", self.page.paginator.count_exact),
+                        ("next", self.get_next_link()),
+                        ("previous", self.get_previous_link()),
+                        ("results", data),
+                    ]
+                )
+            )
+        content = [
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ]
+        if self.count is not None:
+            content = [
+                ("count", self.count),
+                ("count_exact", self.count_exact),
+            ] + content
+        return Response(OrderedDict(content))
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema["properties"]["count_exact"] = {"type": "boolean"}
+        schema["required"] = ["results"]
+        return schema
+
+    def get_schema_operation_parameters(self, view):
+        parameters = super().get_schema_operation_parameters(view)
+        parameters += [
+            {
+                "name": self.cursor_query_param,
+                "required": False,
+                "in": "query",
+                "description": str(_("Position of the page (empty for the first one)")),
+                "schema": {"type": "string"},
+            },
+            {
+                "name": self.count_query_param,
+                "required": False,
+                "in": "query",
+                "description": str(
+                    _(
+                        "true to count results when a cursor is used, capped "
+                        "to limit (and estimate) the count"
+                    )
+                ),
+                "schema": {"type": "string", "enum": ["true", "false", "capped"]},
+            },
+        ]
+        return parameters
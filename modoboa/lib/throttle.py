@@ -80,6 +80,10 @@ class GetThrottleViewsetMixin:
             "dns_detail",
             "applications",
             "structure",
+            "batch",
+            "top_mailboxes",
+            "mailbox_usage",
+            "heavy_hitters",
         ]
         if self.action in actions:
             throttles.append(UserLesserDdosUser())
@@ -4,9 +4,10 @@ from django.utils.translation import gettext as _
 
 from rest_framework import serializers
 
+from ... import constants
+from ... import mailboxes
 from ... import models
 
-
 PERIODS = [
     ("day", "Day"),
     ("week", "Week"),
@@ -15,6 +16,9 @@ PERIODS = [
     ("custom", "Custom"),
 ]
 
+# Maximum number of graphic sets (or domains) of a batch request
+BATCH_MAX_ITEMS = 100
+
 
 class StatisticsInputSerializer(serializers.Serializer):
     """Serializer used to filter statistics."""
@@ -37,6 +41,50 @@ class StatisticsInputSerializer(serializers.Serializer):
         return data
 
 
+class StatisticsBatchInputSerializer(StatisticsInputSerializer):
+    """Serializer used to filter statistics of several sets and domains."""
+
+    gset = None
+    searchquery = None
+    gsets = serializers.ListField(
+        child=serializers.CharField(), min_length=1, max_length=BATCH_MAX_ITEMS
+    )
+    domains = serializers.ListField(
+        child=serializers.CharField(), required=False, max_length=BATCH_MAX_ITEMS
+    )
+
+
+class MailboxTopInputSerializer(StatisticsInputSerializer):
+    """Serializer used to select the most active mailboxes."""
+
+    gset = None
+    graphic = None
+    searchquery = None
+    metric = serializers.ChoiceField(choices=list(mailboxes.METRICS))
+    domain = serializers.CharField(required=False)
+    limit = serializers.IntegerField(default=10, min_value=1, max_value=BATCH_MAX_ITEMS)
+
+
+class HeavyHittersInputSerializer(StatisticsInputSerializer):
+    """Serializer used to select the most frequent items."""
+
+    gset = None
+    graphic = None
+    searchquery = None
+    kind = serializers.ChoiceField(choices=constants.SKETCH_KINDS)
+    domain = serializers.CharField(required=False)
+    limit = serializers.IntegerField(default=10, min_value=1, max_value=BATCH_MAX_ITEMS)
+
+
+class MailboxUsageInputSerializer(StatisticsInputSerializer):
+    """Serializer used to get the hourly counters of a mailbox."""
+
+    gset = None
+    graphic = None
+    searchquery = None
+    address = serializers.EmailField()
+
+
 class GraphPointSerializer(serializers.Serializer):
     """A serializer to represent a point in a curve."""
 
@@ -65,6 +113,77 @@ class StatisticsSerializer(serializers.Serializer):
     graphs = GraphSerializer(many=True)
 
 
+class ColumnarGraphCurveSerializer(serializers.Serializer):
+    """A serializer to represent the values of a curve."""
+
+    name = serializers.CharField()
+    backgroundColor = serializers.CharField()
+    data = serializers.ListField(child=serializers.FloatField(allow_null=True))
+
+
+class ColumnarGraphSerializer(serializers.Serializer):
+    """A serializer to represent a graph using columns."""
+
+    title = serializers.CharField()
+    timestamps = serializers.ListField(child=serializers.IntegerField())
+    series = ColumnarGraphCurveSerializer(many=True)
+
+
+class StatisticsBatchItemSerializer(serializers.Serializer):
+    """Statistics of a graphic set for a domain."""
+
+    gset = serializers.CharField()
+    domain = serializers.CharField(allow_null=True)
+    graphs = serializers.DictField(child=ColumnarGraphSerializer())
+
+
+class StatisticsBatchSerializer(serializers.Serializer):
+    """Serializer to return statistics of several sets and domains."""
+
+    results = StatisticsBatchItemSerializer(many=True)
+
+
+class MailboxTotalSerializer(serializers.Serializer):
+    """Total of a mailbox."""
+
+    address = serializers.EmailField()
+    value = serializers.IntegerField()
+
+
+class MailboxTopSerializer(serializers.Serializer):
+    """Serializer to return the most active mailboxes."""
+
+    results = MailboxTotalSerializer(many=True)
+
+
+class MailboxUsageCurveSerializer(serializers.Serializer):
+    """Hourly values of a mailbox counter."""
+
+    name = serializers.CharField()
+    data = serializers.ListField(child=serializers.IntegerField())
+
+
+class MailboxUsageSerializer(serializers.Serializer):
+    """Serializer to return the hourly counters of a mailbox."""
+
+    timestamps = serializers.ListField(child=serializers.IntegerField())
+    series = MailboxUsageCurveSerializer(many=True)
+
+
+class HeavyHitterSerializer(serializers.Serializer):
+    """A frequent item."""
+
+    item = serializers.CharField()
+    count = serializers.IntegerField()
+    error = serializers.IntegerField(help_text="Maximum over-estimation of count")
+
+
+class HeavyHittersSerializer(serializers.Serializer):
+    """Serializer to return the most frequent items."""
+
+    results = HeavyHitterSerializer(many=True)
+
+
 class MaillogSerializer(serializers.ModelSerializer):
     """Serializer for Maillog model."""
 
@@ -86,6 +205,11 @@ class MaillogGlobalParemetersSerializer(serializers.Serializer):
     """A serializer for global parameters."""
 
     logfile = serializers.CharField(default="/var/log/mail.log")
+    statistics_backend = serializers.ChoiceField(
+        choices=constants.STATISTICS_STORES, default="rrd"
+    )
     rrd_rootdir = serializers.CharField(default="/tmp/modoboa")
+    rrdcached_address = serializers.CharField(default="", allow_blank=True)
+    maillog_maximum_age = serializers.IntegerField(default=365, min_value=0)
     greylist = serializers.BooleanField(default=False)
     enable_domain_limits = serializers.BooleanField(default=False)
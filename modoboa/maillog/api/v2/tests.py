@@ -1,8 +1,19 @@
 """API v2 tests."""
 
+import datetime
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
 
+from modoboa.admin import factories as admin_factories
+from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoAPITestCase
+from modoboa.maillog import factories, lib, mailboxes, sketches
 
 
 class StatisticsViewSetTestCase(ModoAPITestCase):
@@ -20,6 +31,143 @@ class StatisticsViewSetTestCase(ModoAPITestCase):
         )
         self.assertEqual(resp.status_code, 200)
 
+    def test_batch(self):
+        admin_factories.populate_database()
+        url = reverse("v2:statistics-batch")
+        query = (
+            "?gsets=mailtraffic&gsets=accountgraphicset"
+            "&domains=test.com&domains=test2.com&period=day"
+        )
+        resp = self.client.get(url + query)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [item["domain"] for item in resp.json()["results"]],
+            ["test.com", "test2.com", None],
+        )
+
+        self.set_global_parameter("statistics_backend", "sql")
+        # Accounts created during the current second are not counted
+        core_models.User.objects.update(
+            date_joined=timezone.now() - datetime.timedelta(minutes=1)
+        )
+        resp = self.client.get(url + query)
+        self.assertEqual(resp.status_code, 200)
+        results = resp.json()["results"]
+        graph = results[0]["graphs"]["averagetraffic"]
+        self.assertTrue(graph["timestamps"])
+        for serie in graph["series"]:
+            self.assertEqual(len(serie["data"]), len(graph["timestamps"]))
+        graph = results[2]["graphs"]["accountcreationgraphic"]
+        self.assertEqual(
+            sum(graph["series"][0]["data"]), core_models.User.objects.count()
+        )
+
+        resp = self.client.get(url + "?gsets=unknown&period=day")
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(
+            url + "?gsets=mailtraffic&domains=unknown.com&period=day"
+        )
+        self.assertEqual(resp.status_code, 400)
+
+        da = core_models.User.objects.get(username="admin@test.com")
+        self.client.force_authenticate(da)
+        resp = self.client.get(url + "?gsets=mailtraffic&domains=test.com&period=day")
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(url + "?gsets=mailtraffic&domains=test2.com&period=day")
+        self.assertEqual(resp.status_code, 403)
+
+    def test_mailboxes(self):
+        admin_factories.populate_database()
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.set_global_parameter("rrd_rootdir", workdir)
+        now = int(time.time())
+        hour = now - now % 3600
+        counters = mailboxes.MailboxCounters(workdir)
+        counters.add(
+            {
+                ("user@test.com", hour): {"sent": 3, "size_sent": 100},
+                ("admin@test.com", hour): {"sent": 1},
+                ("user@test2.com", hour - 3600): {"sent": 2},
+            }
+        )
+        counters.close()
+
+        url = reverse("v2:statistics-top-mailboxes")
+        resp = self.client.get(url + "?metric=sent&period=day")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            resp.json()["results"],
+            [
+                {"address": "user@test.com", "value": 3},
+                {"address": "user@test2.com", "value": 2},
+                {"address": "admin@test.com", "value": 1},
+            ],
+        )
+        resp = self.client.get(url + "?metric=unknown&period=day")
+        self.assertEqual(resp.status_code, 400)
+
+        url = reverse("v2:statistics-mailbox-usage")
+        resp = self.client.get(url + "?address=user@test.com&period=day")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["timestamps"][-1], hour)
+        series = {serie["name"]: serie["data"] for serie in resp.json()["series"]}
+        self.assertEqual(series["sent"][-1], 3)
+        self.assertEqual(series["size_sent"][-1], 100)
+        resp = self.client.get(url + "?address=unknown@test.com&period=day")
+        self.assertEqual(resp.status_code, 404)
+
+        da = core_models.User.objects.get(username="admin@test.com")
+        self.client.force_authenticate(da)
+        resp = self.client.get(
+            reverse("v2:statistics-top-mailboxes") + "?metric=sent&period=day"
+        )
+        self.assertEqual(
+            [item["address"] for item in resp.json()["results"]],
+            ["user@test.com", "admin@test.com"],
+        )
+        resp = self.client.get(
+            reverse("v2:statistics-top-mailboxes")
+            + "?metric=sent&period=day&domain=test2.com"
+        )
+        self.assertEqual(resp.status_code, 403)
+        resp = self.client.get(url + "?address=user@test2.com&period=day")
+        self.assertEqual(resp.status_code, 403)
+
+    def test_heavy_hitters(self):
+        admin_factories.populate_database()
+        now = int(time.time())
+        window = sketches.get_window(now)
+        sketch = sketches.SpaceSaving(10)
+        sketch.add("spammer@ext.com", 3)
+        sketch.add("friend@ext.com")
+        sketches.save_sketches(
+            {
+                (window, "global", "senders"): sketch,
+                (window, "test.com", "senders"): sketch,
+            }
+        )
+
+        url = reverse("v2:statistics-heavy-hitters")
+        resp = self.client.get(url + "?kind=senders&period=day&limit=1")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            resp.json()["results"],
+            [{"item": "spammer@ext.com", "count": 3, "error": 0}],
+        )
+        resp = self.client.get(url + "?kind=unknown&period=day")
+        self.assertEqual(resp.status_code, 400)
+
+        da = core_models.User.objects.get(username="admin@test.com")
+        self.client.force_authenticate(da)
+        resp = self.client.get(url + "?kind=senders&period=day")
+        self.assertEqual(resp.status_code, 403)
+        resp = self.client.get(url + "?kind=senders&period=day&domain=test2.com")
+        self.assertEqual(resp.status_code, 403)
+        resp = self.client.get(url + "?kind=senders&period=day&domain=test.com")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json()["results"]), 2)
+
 
 class MaillogViewSetTestCase(ModoAPITestCase):
 
@@ -27,3 +175,113 @@ class MaillogViewSetTestCase(ModoAPITestCase):
         url = reverse("v2:maillog-list")
         resp = self.client.get(url)
         self.assertEqual(resp.status_code, 200)
+
+    def _create_maillogs(self):
+        domain = admin_factories.DomainFactory(name="test.com")
+        date = timezone.now().replace(microsecond=0)
+        # Several entries share the same date
+        for i in range(7):
+            factories.MaillogFactory(
+                queue_id="QID{}".format(i),
+                date=date - datetime.timedelta(minutes=i // 2),
+                sender="user{}@test.com".format(i),
+                to_domain=domain,
+            )
+
+    def test_list_with_cursor(self):
+        self._create_maillogs()
+        url = reverse("v2:maillog-list")
+        resp = self.client.get(url + "?cursor=&page_size=3")
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("count", resp.json())
+        self.assertIsNone(resp.json()["previous"])
+        seen = [item["queue_id"] for item in resp.json()["results"]]
+        pages = [list(seen)]
+        next_url = resp.json()["next"]
+        while next_url:
+            resp = self.client.get(next_url)
+            self.assertEqual(resp.status_code, 200)
+            page = [item["queue_id"] for item in resp.json()["results"]]
+            pages.append(page)
+            seen += page
+            next_url = resp.json()["next"]
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(sorted(seen), ["QID{}".format(i) for i in range(7)])
+        dates = [
+            item["date"]
+            for item in self.client.get(url + "?cursor=&page_size=10").json()["results"]
+        ]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+        # Go back to the second page
+        resp = self.client.get(resp.json()["previous"])
+        self.assertEqual(
+            [item["queue_id"] for item in resp.json()["results"]], pages[1]
+        )
+        resp = self.client.get(resp.json()["previous"])
+        self.assertEqual(
+            [item["queue_id"] for item in resp.json()["results"]], pages[0]
+        )
+        self.assertIsNone(resp.json()["previous"])
+
+        # Ascending order
+        resp = self.client.get(url + "?cursor=&ordering=date&page_size=10&count=true")
+        self.assertEqual(resp.json()["count"], 7)
+        self.assertEqual(
+            [item["queue_id"] for item in resp.json()["results"]],
+            list(reversed(seen)),
+        )
+
+        resp = self.client.get(url + "?cursor=invalid")
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get(url + "?cursor=&ordering=sender")
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(url + "?cursor=&ordering=-date")
+        self.assertEqual(resp.status_code, 200)
+
+    @override_settings(MAILLOG_COUNT_LIMIT=5)
+    def test_list_capped_count(self):
+        self._create_maillogs()
+        url = reverse("v2:maillog-list")
+        # Counts are exact unless asked otherwise
+        resp = self.client.get(url + "?page_size=2&page=4")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["count"], 7)
+        self.assertTrue(resp.json()["count_exact"])
+        resp = self.client.get(url + "?page_size=2&count=capped")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["count"], 5)
+        self.assertFalse(resp.json()["count_exact"])
+        resp = self.client.get(url + "?cursor=&count=capped")
+        self.assertEqual(resp.json()["count"], 5)
+        self.assertFalse(resp.json()["count_exact"])
+        resp = self.client.get(url + "?page_size=2&count=capped&search=user1")
+        self.assertEqual(resp.json()["count"], 1)
+        self.assertTrue(resp.json()["count_exact"])
+
+    def test_search(self):
+        self._create_maillogs()
+        url = reverse("v2:maillog-list")
+        resp = self.client.get(url + "?search=QID3")
+        self.assertEqual(resp.json()["count"], 1)
+        resp = self.client.get(url + "?search=user")
+        self.assertEqual(resp.json()["count"], 7)
+        resp = self.client.get(url + "?search=USER1@")
+        self.assertEqual(resp.json()["count"], 1)
+        resp = self.client.get(url + "?search=sent")
+        self.assertEqual(resp.json()["count"], 7)
+        # Queue ids must be complete, addresses are matched by prefix
+        resp = self.client.get(url + "?search=QID")
+        self.assertEqual(resp.json()["count"], 0)
+        resp = self.client.get(url + "?search=@test.com")
+        self.assertEqual(resp.json()["count"], 0)
+
+    def test_search_substring(self):
+        self._create_maillogs()
+        url = reverse("v2:maillog-list")
+        with mock.patch.object(lib, "has_trigram_indexes", return_value=True):
+            resp = self.client.get(url + "?search=@TEST.com")
+            self.assertEqual(resp.json()["count"], 7)
+            resp = self.client.get(url + "?search=qid")
+            self.assertEqual(resp.json()["count"], 7)
@@ -2,17 +2,27 @@
 
 import time
 
+from django.conf import settings
 from django.db.models import Q
+from django.utils.translation import gettext as _
 
 from drf_spectacular.utils import extend_schema
 from rest_framework import filters, permissions, response, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 
 from modoboa.admin import models as admin_models
-from modoboa.lib import pagination
+from modoboa.lib import exceptions, pagination
+from modoboa.lib.email_utils import split_mailbox
 from modoboa.lib.throttle import GetThrottleViewsetMixin
+from modoboa.parameters import tools as param_tools
 
+from ... import graphics
+from ... import lib
+from ... import mailboxes
 from ... import models
 from ... import signals
+from ... import sketches
 from . import serializers
 
 
@@ -21,6 +31,25 @@ class StatisticsViewSet(GetThrottleViewsetMixin, viewsets.ViewSet):
 
     permission_classes = (permissions.IsAuthenticated,)
 
+    def get_graph_sets(self):
+        graph_sets = {}
+        for result in signals.get_graph_sets.send(
+            sender="index", user=self.request.user
+        ):
+            graph_sets.update(result[1])
+        return graph_sets
+
+    def get_period(self, data):
+        """Return the (start, end) period of validated data."""
+        period = data["period"]
+        if period == "custom":
+            start = int(time.mktime(data["start"].timetuple()))
+            end = int(time.mktime(data["end"].timetuple()))
+        else:
+            end = int(time.mktime(time.localtime()))
+            start = "-1{}".format(period)
+        return start, end
+
     @extend_schema(
         parameters=[serializers.StatisticsInputSerializer],
         responses={200: serializers.StatisticsSerializer},
@@ -28,35 +57,222 @@ class StatisticsViewSet(GetThrottleViewsetMixin, viewsets.ViewSet):
     def list(self, request, **kwargs):
         serializer = serializers.StatisticsInputSerializer(data=request.GET)
         serializer.is_valid(raise_exception=True)
-        graph_sets = {}
-        for result in signals.get_graph_sets.send(sender="index", user=request.user):
-            graph_sets.update(result[1])
+        graph_sets = self.get_graph_sets()
         gset = serializer.validated_data["gset"]
         fname = graph_sets[gset].get_file_name(
             request.user, serializer.validated_data.get("searchquery")
         )
-        period = serializer.validated_data["period"]
-        if period == "custom":
-            start = int(time.mktime(serializer.validated_data["start"].timetuple()))
-            end = int(time.mktime(serializer.validated_data["end"].timetuple()))
-        else:
-            end = int(time.mktime(time.localtime()))
-            start = "-1{}".format(period)
+        start, end = self.get_period(serializer.validated_data)
         graphs = graph_sets[gset].export(
             fname, start, end, serializer.validated_data.get("graphic")
         )
         return response.Response({"graphs": graphs})
 
+    @extend_schema(
+        parameters=[serializers.StatisticsBatchInputSerializer],
+        responses={200: serializers.StatisticsBatchSerializer},
+    )
+    @action(methods=["get"], detail=False)
+    def batch(self, request, **kwargs):
+        """Return statistics of several graphic sets and domains at once.
+
+        Graphs are returned using columns: a timestamp vector and a
+        value array per curve.
+        """
+        serializer = serializers.StatisticsBatchInputSerializer(data=request.GET)
+        serializer.is_valid(raise_exception=True)
+        graph_sets = self.get_graph_sets()
+        domains = serializer.validated_data.get("domains") or [None]
+        items = []
+        for gset in serializer.validated_data["gsets"]:
+            if gset not in graph_sets:
+                raise ValidationError({"gsets": _("Unknown graphic set %s") % gset})
+            for domain in domains if graph_sets[gset].domain_selector else [None]:
+                try:
+                    fname = graph_sets[gset].get_file_name(request.user, domain)
+                except exceptions.PermDeniedException:
+                    raise PermissionDenied
+                if fname is None:
+                    raise ValidationError({"domains": _("Unknown domain %s") % domain})
+                if (gset, fname) not in items:
+                    items.append((gset, fname))
+        start, end = self.get_period(serializer.validated_data)
+        exports = graphics.export_graphic_sets(
+            [(graph_sets[gset], fname) for gset, fname in items],
+            start,
+            end,
+            serializer.validated_data.get("graphic"),
+        )
+        results = [
+            {
+                "gset": gset,
+                "domain": fname if graph_sets[gset].domain_selector else None,
+                "graphs": graphs,
+            }
+            for (gset, fname), graphs in zip(items, exports)
+        ]
+        return response.Response({"results": results})
+
+    def get_mailbox_counters(self):
+        return mailboxes.MailboxCounters(
+            param_tools.get_global_parameter("rrd_rootdir", app="maillog"),
+            readonly=True,
+        )
+
+    @extend_schema(
+        parameters=[serializers.MailboxTopInputSerializer],
+        responses={200: serializers.MailboxTopSerializer},
+    )
+    @action(methods=["get"], detail=False, url_path="mailboxes/top")
+    def top_mailboxes(self, request, **kwargs):
+        """Return the mailboxes with the highest hourly counters."""
+        serializer = serializers.MailboxTopInputSerializer(data=request.GET)
+        serializer.is_valid(raise_exception=True)
+        domains = None
+        if not request.user.is_superuser:
+            domains = admin_models.Domain.objects.get_for_admin(
+                request.user
+            ).values_list("name", flat=True)
+        domain = serializer.validated_data.get("domain")
+        if domain is not None:
+            if domains is not None and domain not in domains:
+                raise PermissionDenied
+            domains = [domain]
+        if not mailboxes.get_slots():
+            return response.Response({"results": []})
+        start, end = self.get_period(serializer.validated_data)
+        counters = self.get_mailbox_counters()
+        try:
+            top = counters.get_top(
+                serializer.validated_data["metric"],
+                start,
+                end,
+                serializer.validated_data["limit"],
+                domains,
+            )
+        finally:
+            counters.close()
+        results = [{"address": address, "value": value} for address, value in top]
+        return response.Response({"results": results})
+
+    @extend_schema(
+        parameters=[serializers.MailboxUsageInputSerializer],
+        responses={200: serializers.MailboxUsageSerializer},
+    )
+    @action(methods=["get"], detail=False, url_path="mailboxes/usage")
+    def mailbox_usage(self, request, **kwargs):
+        """Return the hourly counters of a mailbox."""
+        serializer = serializers.MailboxUsageInputSerializer(data=request.GET)
+        serializer.is_valid(raise_exception=True)
+        address = serializer.validated_data["address"].lower()
+        local_part, domain = split_mailbox(address)
+        mailbox = admin_models.Mailbox.objects.filter(
+            address=local_part, domain__name=domain
+        ).first()
+        if mailbox is None:
+            raise NotFound
+        if not request.user.can_access(mailbox):
+            raise PermissionDenied
+        start, end = self.get_period(serializer.validated_data)
+        hours, values = [], {metric: [] for metric in mailboxes.METRICS}
+        if mailboxes.get_slots():
+            counters = self.get_mailbox_counters()
+            try:
+                hours, values = counters.get_usage(address, start, end)
+            finally:
+                counters.close()
+        series = [{"name": metric, "data": data} for metric, data in values.items()]
+        return response.Response({"timestamps": hours, "series": series})
+
+    @extend_schema(
+        parameters=[serializers.HeavyHittersInputSerializer],
+        responses={200: serializers.HeavyHittersSerializer},
+    )
+    @action(methods=["get"], detail=False, url_path="top")
+    def heavy_hitters(self, request, **kwargs):
+        """Return the most frequent senders, recipients...
+
+        Global results are only available to super administrators.
+        """
+        serializer = serializers.HeavyHittersInputSerializer(data=request.GET)
+        serializer.is_valid(raise_exception=True)
+        domain = serializer.validated_data.get("domain")
+        if not request.user.is_superuser:
+            if domain is None:
+                raise PermissionDenied
+            domains = admin_models.Domain.objects.get_for_admin(request.user)
+            if not domains.filter(name=domain).exists():
+                raise PermissionDenied
+        start, end = self.get_period(serializer.validated_data)
+        top = sketches.get_top(
+            domain or "global",
+            serializer.validated_data["kind"],
+            start,
+            end,
+            serializer.validated_data["limit"],
+        )
+        results = [
+            {"item": item, "count": count, "error": error} for item, count, error in top
+        ]
+        return response.Response({"results": results})
+
+
+class MaillogPagination(pagination.KeysetPageNumberPagination):
+    """Paginate message log using dates."""
+
+    keyset_field = "date"
+
+    def get_count_limit(self):
+        return getattr(settings, "MAILLOG_COUNT_LIMIT", self.count_limit)
+
+
+class MaillogSearchFilter(filters.SearchFilter):
+    """Search filter which can use indexes.
+
+    A term matches entries whose queue id is equal to it or whose
+    addresses start with it (case-insensitively). When trigram indexes
+    are available (PostgreSQL), it can be found anywhere in those
+    fields instead. A term equal to a delivery status matches entries
+    with that status.
+    """
+
+    exact_fields = ["queue_id"]
+    statuses = ["sent", "bounced", "deferred", "expired", "undeliverable"]
+
+    def get_term_filter(self, fields, term, substring):
+        condition = Q()
+        for field in fields:
+            if substring:
+                lookup = "icontains"
+            elif field in self.exact_fields:
+                lookup = "exact"
+            else:
+                lookup = "istartswith"
+            condition |= Q(**{"{}__{}".format(field, lookup): term})
+        if term.lower() in self.statuses:
+            condition |= Q(status=term.lower())
+        return condition
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        fields = self.get_search_fields(view, request)
+        substring = lib.has_trigram_indexes()
+        for term in terms:
+            queryset = queryset.filter(self.get_term_filter(fields, term, substring))
+        return queryset
+
 
 class MaillogViewSet(GetThrottleViewsetMixin, viewsets.ReadOnlyModelViewSet):
     """Simple viewset to access message log."""
 
-    filter_backends = [filters.OrderingFilter, filters.SearchFilter]
+    filter_backends = [filters.OrderingFilter, MaillogSearchFilter]
     ordering = ["-date"]
     ordering_fields = "__all__"
-    pagination_class = pagination.CustomPageNumberPagination
+    pagination_class = MaillogPagination
     permissions = (permissions.IsAuthenticated,)
-    search_fields = ["queue_id", "sender", "rcpt", "original_rcpt", "status"]
+    search_fields = ["queue_id", "sender", "rcpt", "original_rcpt"]
     serializer_class = serializers.MaillogSerializer
 
     def get_queryset(self):
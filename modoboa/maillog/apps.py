@@ -23,6 +23,17 @@ GLOBAL_PARAMETERS_STRUCT = collections.OrderedDict(
                                 ),
                             },
                         ),
+                        (
+                            "statistics_backend",
+                            {
+                                "label": _("Statistics storage"),
+                                "help_text": _(
+                                    "Where statistics are stored: RRD files (in "
+                                    "the directory below) or database tables, "
+                                    "which can be shared between servers"
+                                ),
+                            },
+                        ),
                         (
                             "rrd_rootdir",
                             {
@@ -32,6 +43,28 @@ GLOBAL_PARAMETERS_STRUCT = collections.OrderedDict(
                                 ),
                             },
                         ),
+                        (
+                            "rrdcached_address",
+                            {
+                                "label": _("rrdcached address"),
+                                "help_text": _(
+                                    "Address of a rrdcached daemon used to write "
+                                    "RRD files (unix:/path/to/socket or host:port). "
+                                    "Leave empty to write files directly"
+                                ),
+                            },
+                        ),
+                        (
+                            "maillog_maximum_age",
+                            {
+                                "label": _("Maximum message log age"),
+                                "help_text": _(
+                                    "The maximum age in days of a message log "
+                                    "record (0 means no limit). Older records "
+                                    "are removed by the purge_maillogs command"
+                                ),
+                            },
+                        ),
                         (
                             "greylist",
                             {
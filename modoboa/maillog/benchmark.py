@@ -0,0 +1,200 @@
+"""Synthetic mail logs to benchmark log parsers.
+
+Generated logs look like the ones of a postfix server using amavis:
+connections, accepted messages (with one or more recipients), rejected
+ones, content filter results and unrelated lines (dovecot), with many
+messages being processed at the same time so their lines interleave.
+
+Generated domains use the ``.invalid`` top level domain and parsers
+are given the domain list directly, so the database is never used.
+"""
+
+import random
+import time
+import types
+
+from .parser import MaillogParser
+
+HOSTNAME = "mx1"
+
+
+class LogGenerator:
+    """Generate log lines."""
+
+    def __init__(
+        self,
+        domains=100,
+        users=1000,
+        concurrency=50,
+        reject_ratio=0.1,
+        spam_ratio=0.05,
+        noise_ratio=0.2,
+        seed=None,
+    ):
+        """Constructor.
+
+        :param int domains: number of local domains
+        :param int users: number of local users
+        :param int concurrency: number of messages processed at the
+                                same time
+        :param float reject_ratio: part of rejected messages
+        :param float spam_ratio: part of messages flagged as spam
+        :param float noise_ratio: part of lines not related to messages
+        :param seed: seed of the random generator
+        """
+        self.random = random.Random(seed)
+        self.concurrency = max(concurrency, 1)
+        self.reject_ratio = reject_ratio
+        self.spam_ratio = spam_ratio
+        self.noise_ratio = noise_ratio
+        self.domains = ["bench{}.invalid".format(i) for i in range(max(domains, 1))]
+        self.users = [
+            "user{}@{}".format(i, self.domains[i % len(self.domains)])
+            for i in range(max(users, 1))
+        ]
+        self.queue_id = 0x1000000000
+
+    def new_queue_id(self):
+        """Return a new postfix queue id."""
+        self.queue_id += self.random.randrange(1, 1000)
+        return "%X" % self.queue_id
+
+    def address(self):
+        """Return a local or a remote address."""
+        if self.random.random() < 0.5:
+            return self.random.choice(self.users)
+        return "contact{}@example{}.org".format(
+            self.random.randrange(1000), self.random.randrange(100)
+        )
+
+    def client(self):
+        """Return a remote client."""
+        return "client{0}.example.net[198.51.100.{0}]".format(
+            self.random.randrange(1, 255)
+        )
+
+    def noise(self):
+        """Lines not related to a message."""
+        yield "dovecot[{}]: imap({}): Disconnected: Logged out in=120 out=3400".format(
+            self.random.randrange(1000, 30000), self.random.choice(self.users)
+        )
+
+    def rejected_message(self):
+        """Lines of a rejected message."""
+        pid = self.random.randrange(1000, 30000)
+        client = self.client()
+        recipient = self.random.choice(self.users)
+        yield "postfix/smtpd[{}]: connect from {}".format(pid, client)
+        yield (
+            "postfix/smtpd[{}]: NOQUEUE: reject: RCPT from {}: 450 4.2.0 <{}>: "
+            "Recipient address rejected: Greylisted; from=<{}> to=<{}> "
+            "proto=ESMTP helo=<client.example.net>"
+        ).format(pid, client, recipient, self.address(), recipient)
+        yield "postfix/smtpd[{}]: disconnect from {} commands=3/4".format(pid, client)
+
+    def message(self):
+        """Lines of an accepted message."""
+        pid = self.random.randrange(1000, 30000)
+        client = self.client()
+        queue_id = self.new_queue_id()
+        sender = self.address()
+        recipients = [
+            self.address() for i in range(self.random.choice([1, 1, 1, 2, 3]))
+        ]
+        yield "postfix/smtpd[{}]: connect from {}".format(pid, client)
+        yield "postfix/smtpd[{}]: {}: client={}".format(pid, queue_id, client)
+        yield "postfix/cleanup[{}]: {}: message-id=<{}.{}@{}>".format(
+            pid + 1, queue_id, queue_id, self.random.getrandbits(32), HOSTNAME
+        )
+        yield (
+            "postfix/qmgr[900]: {}: from=<{}>, size={}, nrcpt={} (queue active)"
+        ).format(
+            queue_id, sender, self.random.randrange(1000, 1000000), len(recipients)
+        )
+        yield "postfix/smtpd[{}]: disconnect from {} commands=5".format(pid, client)
+        if self.random.random() < self.spam_ratio:
+            yield (
+                "amavis[{}]: ({}-01) Blocked SPAM {{DiscardedInbound}}, {} <{}> -> "
+                "<{}>, Queue-ID: {}, Hits: 12.3"
+            ).format(pid + 2, pid, client, sender, recipients[0], queue_id)
+        for recipient in recipients:
+            status = self.random.choice(["sent"] * 8 + ["deferred", "bounced"])
+            yield (
+                "postfix/lmtp[{}]: {}: to=<{}>, relay=127.0.0.1[127.0.0.1]:24, "
+                "delay=0.2, delays=0.1/0/0.05/0.05, dsn=2.0.0, status={} (250 Ok)"
+            ).format(pid + 3, queue_id, recipient, status)
+        yield "postfix/qmgr[900]: {}: removed".format(queue_id)
+
+    def new_source(self):
+        """Return the lines of a new message (or of something else)."""
+        value = self.random.random()
+        if value < self.noise_ratio:
+            return self.noise()
+        if value < self.noise_ratio + self.reject_ratio:
+            return self.rejected_message()
+        return self.message()
+
+    def lines(self, count, start=None):
+        """Generate count lines, one second apart by default."""
+        if start is None:
+            start = int(time.time()) - count
+        active = []
+        produced = 0
+        last_ts = None
+        while produced < count:
+            while len(active) < self.concurrency:
+                active.append(self.new_source())
+            index = self.random.randrange(len(active))
+            try:
+                body = next(active[index])
+            except StopIteration:
+                active[index] = active[-1]
+                active.pop()
+                continue
+            ts = start + produced
+            if ts != last_ts:
+                date = time.strftime("%b %d %H:%M:%S", time.localtime(ts))
+                last_ts = ts
+            produced += 1
+            yield "{} {} {}\n".format(date, HOSTNAME, body)
+
+    def write(self, path, count):
+        """Write count lines to path."""
+        with open(path, "w") as fp:
+            fp.writelines(self.lines(count))
+
+
+class CountingParser(MaillogParser):
+    """Parser which only counts events."""
+
+    def __init__(self, domains, **kwargs):
+        """Constructor."""
+        template = types.SimpleNamespace(domains=set(domains), domain_ids={})
+        super().__init__(template=template, **kwargs)
+        self.events = {}
+        self.messages = 0
+
+    def new_domain_event(self, domain, name, value=1):
+        """Count events."""
+        self.events[name] = self.events.get(name, 0) + 1
+
+    def new_message_processed(self, *args):
+        """Count messages."""
+        self.messages += 1
+
+
+def run(path, domains, greylist=True):
+    """Parse a log file and return results."""
+    parser = CountingParser(domains, greylist=greylist)
+    start = time.perf_counter()
+    parser.parse(path)
+    duration = time.perf_counter() - start
+    return {
+        "lines": parser.lines,
+        "duration": duration,
+        "throughput": parser.lines / duration if duration else 0,
+        "messages": parser.messages,
+        "events": parser.events,
+        "pending": len(parser.workdict),
+        "evicted": parser.workdict.evicted,
+    }
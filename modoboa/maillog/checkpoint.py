@@ -0,0 +1,149 @@
+"""Checkpoints of parsed log files.
+
+A checkpoint remembers, for each log file, where the previous run
+stopped (inode, byte offset and timestamp of the last parsed line) so
+only new data are read during the next one.
+
+When a file has been rotated, the previous one is looked for (using
+the usual ``.1``, ``.1.gz`` or ``-<date>`` suffixes) and the end of it
+is read before the new file. Files are identified using a fingerprint
+of their first bytes, so compressed rotated files are recognized too.
+"""
+
+import glob
+import gzip
+import hashlib
+import json
+import os
+
+FINGERPRINT_SIZE = 1024
+
+
+def open_logfile(path):
+    """Open a log file (in binary mode), compressed or not."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def get_fingerprint(path, size=FINGERPRINT_SIZE):
+    """Return the fingerprint of the first bytes of a file."""
+    with open_logfile(path) as fp:
+        return hashlib.sha1(fp.read(size)).hexdigest()
+
+
+def get_rotated_files(path):
+    """Return the files path might have been rotated to."""
+    candidates = ["{}.1".format(path), "{}.1.gz".format(path), "{}.0".format(path)]
+    # dateext option of logrotate
+    dated = glob.glob("{}-*".format(glob.escape(path)))
+    dated.sort(key=os.path.getmtime, reverse=True)
+    return [candidate for candidate in candidates + dated if os.path.isfile(candidate)]
+
+
+class Checkpoint:
+    """Position reached in a log file."""
+
+    def __init__(self, inode=None, offset=0, timestamp=None, fingerprint=None, size=0):
+        """Constructor.
+
+        :param int inode: inode of the file
+        :param int offset: offset of the next line to read
+        :param int timestamp: timestamp of the last parsed line
+        :param str fingerprint: fingerprint of the first bytes of the file
+        :param int size: number of bytes used to compute the fingerprint
+        """
+        self.inode = inode
+        self.offset = offset
+        self.timestamp = timestamp
+        self.fingerprint = fingerprint
+        self.size = size
+
+    def to_dict(self):
+        """Return a serializable representation."""
+        return {
+            "inode": self.inode,
+            "offset": self.offset,
+            "timestamp": self.timestamp,
+            "fingerprint": self.fingerprint,
+            "size": self.size,
+        }
+
+    def matches(self, path):
+        """Check if path is the file this checkpoint was taken from."""
+        if self.fingerprint is None:
+            return False
+        try:
+            return get_fingerprint(path, self.size) == self.fingerprint
+        except (OSError, EOFError):
+            return False
+
+    def get_sources(self, path):
+        """Return the parts of files to read to parse new data of path.
+
+        :return: a tuple (sources, resumed) where sources is a list of
+                 (path, offset) tuples and resumed tells if the previous
+                 position has been found
+        """
+        if self.fingerprint is None:
+            return [(path, 0)], False
+        stat = os.stat(path)
+        if (
+            stat.st_ino == self.inode
+            and stat.st_size >= self.offset
+            and self.matches(path)
+        ):
+            return [(path, self.offset)], True
+        for candidate in get_rotated_files(path):
+            if self.matches(candidate):
+                return [(candidate, self.offset), (path, 0)], True
+        return [(path, 0)], False
+
+    def update(self, path, offset, timestamp):
+        """Remember the position reached in path."""
+        self.inode = os.stat(path).st_ino
+        self.offset = offset
+        if timestamp is not None:
+            self.timestamp = timestamp
+        self.size = min(offset, FINGERPRINT_SIZE)
+        # An empty fingerprint would match any file
+        self.fingerprint = get_fingerprint(path, self.size) if self.size else None
+
+
+class CheckpointStore:
+    """Checkpoints of all log files, stored in a JSON file."""
+
+    def __init__(self, path):
+        """Constructor."""
+        self.path = path
+        self.checkpoints = {}
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as fp:
+                content = json.load(fp)
+        except ValueError:
+            # Corrupted file, start from scratch
+            return
+        for logfile, values in content.items():
+            self.checkpoints[logfile] = Checkpoint(**values)
+
+    def get(self, logfile):
+        """Return the checkpoint of a log file."""
+        logfile = os.path.abspath(logfile)
+        if logfile not in self.checkpoints:
+            self.checkpoints[logfile] = Checkpoint()
+        return self.checkpoints[logfile]
+
+    def save(self):
+        """Write checkpoints to disk."""
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as fp:
+            json.dump(
+                {
+                    logfile: checkpoint.to_dict()
+                    for logfile, checkpoint in self.checkpoints.items()
+                },
+                fp,
+            )
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,15 @@
+"""Maillog constants."""
+
+from django.utils.translation import gettext_lazy
+
+STATISTICS_STORES = [
+    ("rrd", gettext_lazy("RRD files")),
+    ("sql", gettext_lazy("Database")),
+]
+
+SKETCH_KINDS = [
+    ("senders", gettext_lazy("Senders")),
+    ("recipients", gettext_lazy("Recipients")),
+    ("rejected_clients", gettext_lazy("Rejected client domains")),
+    ("bounce_sources", gettext_lazy("Bounce sources")),
+]
@@ -0,0 +1,161 @@
+"""Continuous sources of log lines.
+
+Each source provides a ``read(timeout)`` method which waits at most
+``timeout`` seconds for new data and returns the list of complete
+lines (as bytes) received in the meantime.
+"""
+
+import os
+import re
+import select
+import socket
+import time
+
+# Delay between two checks of a followed file
+POLL_INTERVAL = 0.5
+# Maximum size of a syslog message received on a socket
+MAX_DATAGRAM_SIZE = 65536
+# Number of bytes read at once from a followed file
+READ_SIZE = 65536
+
+# Priority prepended to messages sent to a syslog socket
+PRIORITY_REGEX = re.compile(rb"^<\d{1,3}>")
+
+
+class LineBuffer:
+    """Split received data into lines."""
+
+    def __init__(self):
+        """Constructor."""
+        self.pending = b""
+
+    def feed(self, data):
+        """Add data and return the complete lines."""
+        data = self.pending + data
+        end = data.rfind(b"\n") + 1
+        self.pending = data[end:]
+        return data[:end].splitlines(True)
+
+
+class FileSource:
+    """Follow a file, like ``tail -F`` would do.
+
+    The file is reopened when it has been rotated or truncated.
+    """
+
+    def __init__(self, path, offset=0):
+        """Constructor."""
+        self.path = path
+        self.fp = None
+        self.inode = None
+        self.offset = offset
+        self.buffer = LineBuffer()
+        self.open(offset)
+
+    def open(self, offset=0):
+        """Open the file and move to offset."""
+        if self.fp is not None:
+            self.fp.close()
+        self.fp = open(self.path, "rb")
+        self.inode = os.fstat(self.fp.fileno()).st_ino
+        self.fp.seek(offset)
+        self.offset = offset
+        self.buffer = LineBuffer()
+
+    def has_been_rotated(self):
+        """Check if the file has been replaced or truncated."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # New file not created yet
+            return False
+        return stat.st_ino != self.inode or stat.st_size < self.fp.tell()
+
+    def read(self, timeout):
+        """Return new complete lines (at most READ_SIZE bytes at once)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            data = self.fp.read(READ_SIZE)
+            if data:
+                lines = self.buffer.feed(data)
+                self.offset += sum(len(line) for line in lines)
+                if lines:
+                    return lines
+                # Incomplete line, read what follows
+                continue
+            if self.has_been_rotated():
+                self.open()
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+    def close(self):
+        """Close the file."""
+        self.fp.close()
+
+
+class StreamSource:
+    """Read lines from a stream (a pipe for example)."""
+
+    def __init__(self, fileobj):
+        """Constructor."""
+        self.fd = fileobj.fileno()
+        self.buffer = LineBuffer()
+        self.closed = False
+
+    def read(self, timeout):
+        """Return new complete lines."""
+        if self.closed:
+            raise EOFError
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return []
+        data = os.read(self.fd, MAX_DATAGRAM_SIZE)
+        if not data:
+            self.closed = True
+            # Parse the last line, even if incomplete
+            return self.buffer.feed(self.buffer.pending and b"\n")
+        return self.buffer.feed(data)
+
+    def close(self):
+        """Nothing to do."""
+
+
+class SocketSource:
+    """Receive syslog messages on a UNIX datagram socket.
+
+    Messages must use the traditional file format (including the
+    hostname), the priority is removed if present.
+    """
+
+    def __init__(self, path):
+        """Constructor."""
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+
+    def read(self, timeout):
+        """Return received messages."""
+        lines = []
+        self.sock.settimeout(timeout)
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                return lines
+            except BlockingIOError:
+                return lines
+            for line in data.splitlines():
+                lines.append(PRIORITY_REGEX.sub(b"", line) + b"\n")
+            # Read what is already available without waiting
+            self.sock.settimeout(0)
+
+    def close(self):
+        """Close and remove the socket."""
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -11,6 +11,8 @@ from django import forms
 from modoboa.lib import form_utils
 from modoboa.parameters import forms as param_forms
 
+from . import constants
+
 
 class ParametersForm(param_forms.AdminParametersForm):
     """Stats global parameters."""
@@ -26,6 +28,17 @@ class ParametersForm(param_forms.AdminParametersForm):
         widget=forms.TextInput(attrs={"class": "form-control"}),
     )
 
+    statistics_backend = forms.ChoiceField(
+        label=gettext_lazy("Statistics storage"),
+        choices=constants.STATISTICS_STORES,
+        initial="rrd",
+        help_text=gettext_lazy(
+            "Where statistics are stored: RRD files (in the directory below) "
+            "or database tables, which can be shared between servers"
+        ),
+        widget=forms.Select(attrs={"class": "form-control"}),
+    )
+
     rrd_rootdir = forms.CharField(
         label=gettext_lazy("Directory to store RRD files"),
         initial="/tmp/modoboa",
@@ -33,6 +46,29 @@ class ParametersForm(param_forms.AdminParametersForm):
         widget=forms.TextInput(attrs={"class": "form-control"}),
     )
 
+    rrdcached_address = forms.CharField(
+        label=gettext_lazy("rrdcached address"),
+        initial="",
+        required=False,
+        help_text=gettext_lazy(
+            "Address of a rrdcached daemon used to write RRD files "
+            "(unix:/path/to/socket or host:port). Leave empty to write "
+            "files directly"
+        ),
+        widget=forms.TextInput(attrs={"class": "form-control"}),
+    )
+
+    maillog_maximum_age = forms.IntegerField(
+        label=gettext_lazy("Maximum message log age"),
+        initial=365,
+        min_value=0,
+        help_text=gettext_lazy(
+            "The maximum age in days of a message log record (0 means no "
+            "limit). Older records are removed by the purge_maillogs command"
+        ),
+        widget=forms.NumberInput(attrs={"class": "form-control"}),
+    )
+
     greylist = form_utils.YesNoField(
         label=gettext_lazy("Show greylisted messages"),
         initial=False,
@@ -1,19 +1,18 @@
 """Classes to define graphics."""
 
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import json
 import inspect
 from itertools import chain
-import os
 
 from django.conf import settings
-from django.utils.encoding import smart_bytes, smart_str
-from django.utils.translation import gettext as _, gettext_lazy
+from django.utils import translation
+from django.utils.translation import gettext_lazy
 
 from modoboa.admin import models as admin_models
 from modoboa.lib import exceptions
-from modoboa.lib.sysutils import exec_cmd
-from modoboa.parameters import tools as param_tools
+
+from . import stores
 
 
 class Curve:
@@ -29,21 +28,6 @@ class Curve:
         self.legend = legend
         self.cfunc = cfunc
 
-    def to_rrd_command_args(self, rrdfile):
-        """Convert this curve to the approriate RRDtool command.
-
-        :param str rrdfile: RRD file name
-        :return: a list
-        """
-        rrdfile = os.path.join(
-            param_tools.get_global_parameter("rrd_rootdir"), "%s.rrd" % rrdfile
-        )
-        return [
-            "DEF:%s=%s:%s:%s" % (self.dsname, rrdfile, self.dsname, self.cfunc),
-            "CDEF:%(ds)spm=%(ds)s,UN,0,%(ds)s,IF,60,*" % {"ds": self.dsname},
-            'XPORT:%spm:"%s"' % (self.dsname, self.legend),
-        ]
-
 
 class Graphic:
     """Graphic."""
@@ -71,56 +55,41 @@ class Graphic:
     def display_name(self):
         return self.__class__.__name__.lower()
 
-    @property
-    def rrdtool_binary(self):
-        """Return path to rrdtool binary."""
-        dpath = None
-        code, output = exec_cmd("which rrdtool")
-        if not code:
-            dpath = output.strip()
-        else:
-            known_paths = getattr(
-                settings,
-                "RRDTOOL_LOOKUP_PATH",
-                ("/usr/bin/rrdtool", "/usr/local/bin/rrdtool"),
-            )
-            for fpath in known_paths:
-                if os.path.isfile(fpath) and os.access(fpath, os.X_OK):
-                    dpath = fpath
-        if dpath is None:
-            raise exceptions.InternalError(_("Failed to locate rrdtool binary."))
-        return smart_str(dpath)
-
-    def export(self, rrdfile, start, end):
-        """Export data to JSON using rrdtool."""
+    def export(self, rrdfile, start, end, store=None):
+        """Export data to JSON using the statistics store."""
+        if store is None:
+            store = stores.get_active_store()
         result = []
-        cmdargs = []
         for curve in self._curves:
             result += [
                 {"name": str(curve.legend), "backgroundColor": curve.color, "data": []}
             ]
-            cmdargs += curve.to_rrd_command_args(rrdfile)
-        code = 0
-
-        cmd = "{} xport --json -t --start {} --end {} ".format(
-            self.rrdtool_binary, str(start), str(end)
-        )
-        cmd += " ".join(cmdargs)
-        code, output = exec_cmd(smart_bytes(cmd))
-        if code:
-            return []
-
-        xport = json.loads(output)
-        for row in xport["data"]:
-            timestamp = int(row[0])
+        for timestamp, values in store.export(rrdfile, self._curves, start, end):
             date = datetime.datetime.fromtimestamp(timestamp).isoformat(sep=" ")
-            for vindex, value in enumerate(row[1:]):
+            for vindex, value in enumerate(values):
                 result[vindex]["data"].append(
                     {"x": date, "y": value, "timestamp": timestamp}
                 )
 
         return result
 
+    def export_columns(self, rrdfile, start, end, store=None):
+        """Export data as a timestamp vector and a value array per curve."""
+        if store is None:
+            store = stores.get_active_store()
+        rows = store.export(rrdfile, self._curves, start, end)
+        return {
+            "timestamps": [timestamp for timestamp, values in rows],
+            "series": [
+                {
+                    "name": str(curve.legend),
+                    "backgroundColor": curve.color,
+                    "data": [values[index] for timestamp, values in rows],
+                }
+                for index, curve in enumerate(self._curves)
+            ],
+        }
+
 
 class GraphicSet(object):
     """A set of graphics."""
@@ -151,14 +120,27 @@ class GraphicSet(object):
         """Return database file name."""
         return self.file_name
 
-    def export(self, rrdfile, start, end, graphic=None):
+    def export(self, rrdfile, start, end, graphic=None, store=None, columnar=False):
+        """Export graphics of this set.
+
+        With columnar, each graphic is exported using a timestamp vector
+        and a value array per curve (see Graphic.export_columns).
+        """
         result = {}
+        if store is None:
+            store = stores.get_active_store()
         for graph in self.graphics:
             if graphic is None or graphic == graph.display_name:
-                result[graph.display_name] = {
-                    "title": str(graph.title),
-                    "series": graph.export(rrdfile, start, end),
-                }
+                if columnar:
+                    result[graph.display_name] = {
+                        "title": str(graph.title),
+                        **graph.export_columns(rrdfile, start, end, store),
+                    }
+                else:
+                    result[graph.display_name] = {
+                        "title": str(graph.title),
+                        "series": graph.export(rrdfile, start, end, store),
+                    }
         return result
 
 
@@ -248,6 +230,29 @@ class MailTraffic(GraphicSet):
         return self._check_domain_access(user, searchq)
 
 
+def export_graphic_sets(items, start, end, graphic=None):
+    """Export several graphic sets at once (using columns).
+
+    Files are read concurrently when the active store allows it.
+
+    :param list items: list of (GraphicSet instance, file name) tuples
+    :return: the list of exports, in the same order
+    """
+    store = stores.get_active_store()
+    language = translation.get_language()
+
+    def export(item):
+        gset, fname = item
+        with translation.override(language):
+            return gset.export(fname, start, end, graphic, store=store, columnar=True)
+
+    if not store.concurrent_exports or len(items) < 2:
+        return [export(item) for item in items]
+    workers = min(len(items), getattr(settings, "MAILLOG_EXPORT_WORKERS", 4))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(export, items))
+
+
 class AccountCreationGraphic(Graphic):
     """Account creation over time."""
 
@@ -1,7 +1,19 @@
 # coding: utf-8
+import functools
 import sys
 import time
 
+from django.db import connection
+
+# Trigram indexes created by migrations on PostgreSQL (when the
+# pg_trgm extension is available) to speed up substring searches
+TRIGRAM_INDEXES = [
+    "maillog_queue_id_trgm",
+    "maillog_sender_trgm",
+    "maillog_rcpt_trgm",
+    "maillog_original_rcpt_trgm",
+]
+
 
 def date_to_timestamp(timetuple):
     """Date conversion.
@@ -21,3 +33,16 @@ def date_to_timestamp(timetuple):
         print >> sys.stderr, "Error: failed to convert date and time"
         return 0
     return int(time.mktime(local))
+
+
+@functools.lru_cache(maxsize=None)
+def has_trigram_indexes():
+    """Check if trigram indexes are available (PostgreSQL only)."""
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM pg_indexes WHERE indexname = ANY(%s)",
+            [TRIGRAM_INDEXES],
+        )
+        return cursor.fetchone()[0] == len(TRIGRAM_INDEXES)
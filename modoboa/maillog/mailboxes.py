@@ -0,0 +1,270 @@
+"""Per mailbox traffic counters.
+
+Counters are recorded per hour in fixed-width files, one per metric,
+which are memory-mapped. Each file is an array of ``slots`` counters
+per mailbox:
+
+* the row of a mailbox is its position in the mailbox table (one
+  address per line in ``mailboxes.idx``, new addresses are appended),
+* the slot of an hour is the hour number modulo ``slots``, so the last
+  ``slots`` hours are kept. The hour held by each slot is stored in
+  ``hours.dat``.
+
+The hourly counters of a mailbox are thus one contiguous slice, and
+the counters of every mailbox for a given hour one strided slice.
+
+Files are only written by the log parser.
+"""
+
+import heapq
+import mmap
+import os
+
+from django.conf import settings
+
+from .stores import to_timestamp
+
+HOUR = 3600
+# Number of hours kept by default
+DEFAULT_SLOTS = 7 * 24
+# Metric -> type of its counters (see the array module)
+METRICS = {
+    "sent": "I",
+    "recv": "I",
+    "size_sent": "Q",
+    "size_recv": "Q",
+}
+# Number of rows added at once when the files are full
+GROWTH = 1024
+
+
+def get_slots():
+    """Return the number of hours to keep (0 if counters are disabled)."""
+    return getattr(settings, "MAILLOG_MAILBOX_COUNTER_HOURS", DEFAULT_SLOTS)
+
+
+class MailboxCounters:
+    """Hourly traffic counters of mailboxes."""
+
+    def __init__(self, workdir, slots=None, readonly=False):
+        """Constructor.
+
+        :param str workdir: directory where files are stored (a
+                            ``mailboxes`` sub-directory is used)
+        :param int slots: number of hours to keep
+        :param bool readonly: open files in read-only mode (missing
+                              files are then considered as empty)
+        """
+        self.path = os.path.join(workdir, "mailboxes")
+        self.slots = slots or get_slots()
+        self.readonly = readonly
+        self.addresses = []
+        self.rows = {}
+        self.capacity = 0
+        self.hours = None
+        self.views = {}
+        # file name -> (file object, mmap object, memoryview)
+        self._maps = {}
+        if self.slots:
+            self._open()
+
+    def _get_file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _map(self, name, typecode, size):
+        """Map a file (created or extended up to size bytes if needed)."""
+        self._unmap(name)
+        path = self._get_file_path(name)
+        if self.readonly:
+            fp = open(path, "rb")
+            access = mmap.ACCESS_READ
+        else:
+            fp = open(path, "a+b")
+            if os.fstat(fp.fileno()).st_size < size:
+                fp.truncate(size)
+            access = mmap.ACCESS_WRITE
+        try:
+            mapping = mmap.mmap(fp.fileno(), 0, access=access)
+        except ValueError:
+            # Empty file
+            fp.close()
+            raise
+        view = memoryview(mapping).cast(typecode)
+        self._maps[name] = (fp, mapping, view)
+        return view
+
+    def _unmap(self, name):
+        if name not in self._maps:
+            return
+        fp, mapping, view = self._maps.pop(name)
+        view.release()
+        mapping.close()
+        fp.close()
+
+    def _open(self):
+        if not os.path.isdir(self.path):
+            if self.readonly:
+                return
+            os.makedirs(self.path)
+        hours_path = self._get_file_path("hours.dat")
+        if not self.readonly and os.path.exists(hours_path):
+            if os.stat(hours_path).st_size != self.slots * 8:
+                # The number of hours has changed, start again
+                for name in os.listdir(self.path):
+                    os.unlink(self._get_file_path(name))
+        try:
+            with open(self._get_file_path("mailboxes.idx")) as fp:
+                self.addresses = fp.read().splitlines()
+            self.hours = self._map("hours.dat", "Q", self.slots * 8)
+            if len(self.hours) != self.slots:
+                raise ValueError
+            self._map_metrics(len(self.addresses))
+        except (FileNotFoundError, ValueError):
+            if self.readonly:
+                self.close()
+                self.addresses = []
+                return
+            self.hours = self._map("hours.dat", "Q", self.slots * 8)
+            self._map_metrics(0)
+        self.rows = {address: row for row, address in enumerate(self.addresses)}
+
+    def _map_metrics(self, rows):
+        """Map metric files, making room for at least rows mailboxes."""
+        if not self.readonly:
+            rows = (rows // GROWTH + 1) * GROWTH
+        for metric, typecode in METRICS.items():
+            itemsize = 4 if typecode == "I" else 8
+            self.views[metric] = self._map(
+                "{}.dat".format(metric), typecode, rows * self.slots * itemsize
+            )
+        self.capacity = min(len(view) for view in self.views.values()) // self.slots
+        if self.readonly and self.capacity < len(self.addresses):
+            # Rows being added by the parser
+            self.addresses = self.addresses[: self.capacity]
+
+    def close(self):
+        """Release mapped files."""
+        for name in list(self._maps):
+            self._unmap(name)
+        self.views = {}
+        self.hours = None
+
+    def get_row(self, address):
+        """Return the row of address, adding it if needed."""
+        row = self.rows.get(address)
+        if row is not None:
+            return row
+        row = len(self.addresses)
+        if row >= self.capacity:
+            # Files must be extended before rows are known by readers
+            self._map_metrics(row + 1)
+        with open(self._get_file_path("mailboxes.idx"), "a") as fp:
+            fp.write(address + "\n")
+        self.addresses.append(address)
+        self.rows[address] = row
+        return row
+
+    def get_slot(self, hour):
+        """Return the slot of hour, or None if it is too old to be kept.
+
+        The slot is cleared if it holds an older hour.
+        """
+        slot = hour // HOUR % self.slots
+        if self.hours[slot] == hour:
+            return slot
+        if self.hours[slot] > hour:
+            return None
+        for metric, view in self.views.items():
+            view[slot :: self.slots] = memoryview(
+                bytearray(view.itemsize * self.capacity)
+            ).cast(view.format)
+        self.hours[slot] = hour
+        return slot
+
+    def add(self, increments):
+        """Add values to the counters.
+
+        :param dict increments: ``{(address, hour): {metric: value}}``
+                                where hour is a timestamp (start of
+                                the hour)
+        """
+        slots = {
+            hour: self.get_slot(hour)
+            for hour in sorted({hour for address, hour in increments})
+        }
+        # Values are summed per position first, then each array is
+        # updated in a single ordered pass
+        offsets = {metric: {} for metric in METRICS}
+        for (address, hour), values in increments.items():
+            if slots[hour] is None:
+                continue
+            offset = self.get_row(address) * self.slots + slots[hour]
+            for metric, value in values.items():
+                offsets[metric][offset] = offsets[metric].get(offset, 0) + value
+        for metric, values in offsets.items():
+            view = self.views[metric]
+            for offset in sorted(values):
+                view[offset] += values[offset]
+
+    def get_period_slots(self, start, end):
+        """Return the (hour, slot) pairs recorded between start and end."""
+        if self.hours is None:
+            return []
+        result = []
+        for slot, hour in enumerate(self.hours):
+            if hour and start <= hour < end:
+                result.append((hour, slot))
+        return sorted(result)
+
+    def get_usage(self, address, start, end):
+        """Return the hourly counters of a mailbox.
+
+        Hours which are not kept anymore are skipped.
+
+        :return: a tuple (list of hours, {metric: list of values})
+        """
+        end = int(end)
+        start = to_timestamp(start, end)
+        last = end - 1 - (end - 1) % HOUR
+        start = max(start - start % HOUR, last - (self.slots - 1) * HOUR)
+        hours = list(range(start, end, HOUR))
+        result = {metric: [0] * len(hours) for metric in METRICS}
+        row = self.rows.get(address)
+        if row is None or self.hours is None:
+            return hours, result
+        slots = [hour // HOUR % self.slots for hour in hours]
+        for metric, view in self.views.items():
+            counters = view[row * self.slots : (row + 1) * self.slots].tolist()
+            result[metric] = [
+                counters[slot] if self.hours[slot] == hour else 0
+                for hour, slot in zip(hours, slots)
+            ]
+        return hours, result
+
+    def get_top(self, metric, start, end, limit=10, domains=None):
+        """Return the mailboxes with the highest totals for a metric.
+
+        :param list domains: only consider mailboxes of these domains
+        :return: a list of (address, total) tuples
+        """
+        end = int(end)
+        start = to_timestamp(start, end)
+        start -= start % HOUR
+        count = len(self.addresses)
+        totals = None
+        for hour, slot in self.get_period_slots(start, end):
+            counters = self.views[metric][slot :: self.slots][:count].tolist()
+            if totals is None:
+                totals = counters
+            else:
+                totals = [a + b for a, b in zip(totals, counters)]
+        if not totals:
+            return []
+        rows = range(count)
+        if domains is not None:
+            domains = set(domains)
+            rows = [
+                row for row in rows if self.addresses[row].rpartition("@")[2] in domains
+            ]
+        rows = heapq.nlargest(limit, rows, key=totals.__getitem__)
+        return [(self.addresses[row], totals[row]) for row in rows if totals[row]]
@@ -14,6 +14,8 @@ Predefined events are:
  * Per domain sent/received messages,
  * Per domain received bad messages (bounced, reject for now),
  * Per domain sent/received traffics size,
+ * Per mailbox sent/received messages and traffics size (hourly),
+ * Top senders, recipients, rejected clients and bounce sources,
  * Global consolidation of all previous events.
 
 """
@@ -21,28 +23,32 @@ Predefined events are:
 from datetime import datetime
 import io
 import os
-import re
+import glob
+import multiprocessing
+import signal
 import sys
 import time
 
-import rrdtool
-
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Max
 from django.utils import timezone
 
-from modoboa.admin.models import Domain
+from modoboa.admin import models as admin_models
 from modoboa.parameters import tools as param_tools
-from modoboa.lib.email_utils import split_mailbox
 
-from ... import lib
+from ... import mailboxes
 from ... import models
-
-
-rrdstep = 60
-xpoints = 540
-points_per_sample = 3
+from ... import sketches
+from ... import stores
+from ...checkpoint import CheckpointStore, open_logfile
+from ...follow import FileSource, SocketSource, StreamSource
+from ...parser import MaillogParser
+from ...stores.rrd import rrdstep
+
+# Number of Maillog entries written at once
+maillog_batch_size = 1000
 variables = [
     "sent",
     "recv",
@@ -55,246 +61,129 @@ variables = [
 ]
 
 
-class LogParser:
+class LogParser(MaillogParser):
+    """Parser which records events in a statistics store and Maillog entries."""
 
-    def __init__(self, options, workdir, year=None, greylist=False):
-        """Constructor."""
+    def __init__(self, options, workdir, year=None, greylist=False, template=None):
+        """Constructor.
+
+        When template (another parser) is given, the domains, mailboxes
+        and Maillog watermark it has loaded are reused so the database
+        is not accessed.
+        """
+        super().__init__(
+            year, greylist, options["verbose"], options["debug"], template=template
+        )
         self.logfile = options["logfile"]
-        self.debug = options["debug"]
-        self.verbose = options["verbose"]
         self.workdir = workdir
-        self.__year = year
-        self.cfs = ["AVERAGE", "MAX"]
-
-        curtime = time.localtime()
-        if not self.__year:
-            self.__year = curtime.tm_year
-        self.curmonth = curtime.tm_mon
+        if template is None:
+            self.store = stores.get_active_store(
+                workdir=workdir,
+                rrdcached=options.get("rrdcached"),
+                debug=options["debug"],
+                verbose=options["verbose"],
+            )
+        else:
+            self.store = template.store
+        self.checkpoints = None
+        if options.get("checkpoint", True):
+            self.checkpoints = CheckpointStore(
+                os.path.join(workdir, "logparser_checkpoints.json")
+            )
 
         self.data = {"global": {}}
-        self.domains = []
-        self._load_domain_list()
-
-        self.workdict = {}
-        self.lupdates = {}
-
-        # set up regular expression
-        self._date_expressions = [
-            r"(?P<month>\w+)\s+(?P<day>\d+)\s+(?P<hour>\d+):(?P<min>\d+):(?P<sec>\d+)(?P<eol>.*)",  # noqa
-            r"(?P<year>\d+)-(?P<month>\d+)-(?P<day>\d+)T(?P<hour>\d+):(?P<min>\d+):(?P<sec>\d+)\.\d+\+\d+:\d+(?P<eol>.*)",  # noqa
-        ]
-        self._date_expressions = [re.compile(v) for v in self._date_expressions]
-        self.date_expr = None
-        self._regex = {
-            "line": r"\s+([-\w\.]+)\s+(\w+)/?(\w*)[[](\d+)[]]:\s+(.*)",
-            "id": r"(\w+): (.*)",
-            "reject": r"reject: .*from=<.*>,? to=<[^@]+@([^>]+)>",
-            "message-id": r"message-id=<([^>]*)>",
-            "from+size": r"from=<([^>]*)>, size=(\d+)",
-            "to+status": r"to=<([^>]*)>.*status=(\S+)",
-            "orig_to": r"orig_to=<([^>]*)>.*",
-            "amavis": r"(?P<result>INFECTED|SPAM|SPAMMY) .* <[^>]+> -> <[^@]+@(?P<domain>[^>]+)>.*",  # noqa
-            "rmilter_line": r"<(?P<hash>[0-9a-f]{10})>; (?P<line>.*)",
-            "rmilter_msg_done": r"msg done: queue_id: <(?P<queue_id>[^>]+)>; message id: <(?P<message_id>[^>]+)>.*; from: <(?P<from>[^>]+)>; rcpt: <(?P<rcpt>[^>]+)>.*; spam scan: (?P<action>[^;]+); virus scan:",  # noqa
-            "rmilter_spam": r"mlfi_eom: (rejecting spam|add spam header to message according to spamd action)",  # noqa
-            "rmilter_virus": r"mlfi_eom:.* virus found",
-            "rmilter_greylist": (r"GREYLIST\([0-9]+\.[0-9]{2}\)\[greylisted[^\]]*\]"),
-        }
-        self._regex = {k: re.compile(v) for k, v in self._regex.items()}
-        self._srs_regex = {
-            "detect_srs": "^SRS[01][+-=]",
-            "reverse_srs0": r"^SRS0[+-=]\S+=\S{2}=(\S+)=(\S+)\@\S+$",
-            "reverse_srs1": r"^SRS1[+-=]\S+=\S+==\S+=\S{2}=(\S+)=(\S+)\@\S+$",
-        }
-        self._srs_regex = {
-            k: re.compile(v, re.IGNORECASE) for k, v in self._srs_regex.items()
-        }
-
-        self.greylist = greylist
-        if greylist:
-            variables.insert(4, "greylist")
-            self._dprint("[settings] greylisting enabled")
-
-        self._prev_se = -1
-        self._prev_mi = -1
-        self._prev_ho = -1
-        self.cur_t = 0
-
-    def _load_domain_list(self):
-        """Load the list of allowed domains."""
-        for dom in Domain.objects.all():
-            domname = str(dom.name)
-            self.domains += [domname]
+        for domname in self.domains:
             self.data[domname] = {}
-
-            # Also add alias domains
-            for alias in dom.domainalias_set.all():
-                aliasname = str(alias.name)
-                self.domains += [aliasname]
-                self.data[aliasname] = {}
-
-    def _dprint(self, msg):
-        """Print a debug message if required.
-
-        :param str msg: debug message
-        """
-        if not self.debug:
-            return
-        print(msg)
-
-    def _parse_date(self, line):
-        """Try to match a date inside :kw:`line` and to convert it to
-        a timestamp.
-
-        We try different date format until we find valid one. We then
-        store it for future use.
-
-        :param str line: a log entry
-        :return: the remaining part of the line or None
-        """
-        match = None
-        if self.date_expr is None:
-            for expr in self._date_expressions:
-                match = expr.match(line)
-                if match is not None:
-                    self.date_expr = expr
-                    break
+        self.maillogs = []
+        # Write Maillog entries as soon as a batch is complete
+        self.autoflush = True
+        if template is None:
+            self._load_maillog_watermark()
         else:
-            match = self.date_expr.match(line)
-        if match is None:
-            return None
-        ho = match.group("hour")
-        mi = match.group("min")
-        se = match.group("sec")
-        mo = match.group("month")
-        da = match.group("day")
-        try:
-            ye = match.group("year")
-        except IndexError:
-            ye = self.year(mo)
-        # Keep original timestamp
-        self.orig_ts = lib.date_to_timestamp([ye, mo, da, ho, mi, se])
-
-        # Now get the current period (based on rrdstep)
-        se = int(int(se) / rrdstep)  # rrd step is one-minute => se = 0
-        if self._prev_se != se or self._prev_mi != mi or self._prev_ho != ho:
-            self.cur_t = lib.date_to_timestamp([ye, mo, da, ho, mi, se])
-            self.cur_t = self.cur_t - self.cur_t % rrdstep
-            self._prev_mi = mi
-            self._prev_ho = ho
-            self._prev_se = se
-        return match.group("eol")
-
-    def init_rrd(self, fname, m):
-        """init_rrd.
-
-        Set-up Data Sources (DS)
-        Set-up Round Robin Archives (RRA):
-        - day,week,month and year archives
-        - 2 types : AVERAGE and MAX
-
-        parameter : start time
-        return    : last epoch recorded
-        """
-        ds_type = "ABSOLUTE"
-        rows = xpoints / points_per_sample
-        realrows = int(rows * 1.1)  # ensure that the full range is covered
-        day_steps = int(3600 * 24 / (rrdstep * rows))
-        week_steps = day_steps * 7
-        month_steps = week_steps * 5
-        year_steps = month_steps * 12
-
-        # Set up data sources for our RRD
-        params = []
-        for v in variables:
-            params += ["DS:%s:%s:%s:0:U" % (v, ds_type, rrdstep * 2)]
-
-        # Set up RRD to archive data
-        for cf in ["AVERAGE", "MAX"]:
-            for step in [day_steps, week_steps, month_steps, year_steps]:
-                params += ["RRA:%s:0.5:%s:%s" % (cf, step, realrows)]
+            self.last_maillog_date = template.last_maillog_date
+            self.last_maillog_queue_ids = set(template.last_maillog_queue_ids)
+
+        # Per mailbox counters ({(address, hour): {variable: value}})
+        self.mailbox_data = {}
+        self.mailbox_counters = None
+        self.mailboxes = set()
+        if template is not None:
+            self.mailboxes = template.mailboxes
+        elif mailboxes.get_slots():
+            self._load_mailbox_list()
+
+        # Heavy hitters ({(window, name, kind): SpaceSaving})
+        self.sketches = {}
+        self.sketch_capacity = sketches.get_capacity()
+        self.sketch_window_size = sketches.get_window_size()
+
+        # Several parsers might be created by the same process
+        if greylist and "greylist" not in variables:
+            variables.insert(4, "greylist")
 
-        # With those setup, we can now created the RRD
-        rrdtool.create(str(fname), "--start", str(m), "--step", str(rrdstep), *params)
-        return m
+        self.cur_t = 0
 
-    def add_datasource_to_rrd(self, fname, dsname):
-        """Add a new data source to an exisitng file.
+    def _load_maillog_watermark(self):
+        """Load the date of the most recent Maillog entry.
 
-        Add missing Data Sources (DS) to existing Round Robin Archive (RRA):
-        See init_rrd for details.
-        """
-        ds_def = "DS:%s:ABSOLUTE:%s:0:U" % (dsname, rrdstep * 2)
-        rrdtool.tune(fname, ds_def)
-        self._dprint("[rrd] added DS %s to %s" % (dsname, fname))
-
-    def add_point_to_rrd(self, fname, tpl, values, ts=None):
-        """Try to add a new point to RRD file."""
-        if ts:
-            values = "{}:{}".format(ts, values)
-        if self.verbose:
-            print("[rrd] VERBOSE update -t %s %s" % (tpl, values))
-        try:
-            rrdtool.update(str(fname), "-t", tpl, values)
-        except rrdtool.OperationalError as e:
-            op_match = re.match(r"unknown DS name '(\w+)'", str(e))
-            if op_match is None:
-                raise
-            self.add_datasource_to_rrd(str(fname), op_match.group(1))
-            rrdtool.update(str(fname), "-t", tpl, values)
-
-    def update_rrd(self, dom, t):
-        """update_rrd
-
-        Update RRD with records at t time.
-
-        True  : if data are up-to-date for current minute
-        False : syslog may have probably been already recorded
-        or something wrong
+        Entries older than this date are considered as already
+        recorded, as well as the ones logged at the same date for the
+        same queue id.
         """
-        fname = "%s/%s.rrd" % (self.workdir, dom)
-        m = t - (t % rrdstep)
+        self.last_maillog_date = models.Maillog.objects.aggregate(date=Max("date"))[
+            "date"
+        ]
+        self.last_maillog_queue_ids = set()
+        if self.last_maillog_date is not None:
+            self.last_maillog_queue_ids = set(
+                models.Maillog.objects.filter(date=self.last_maillog_date).values_list(
+                    "queue_id", flat=True
+                )
+            )
 
-        self._dprint("[rrd] updating %s" % fname)
-        if not os.path.exists(fname):
-            self.lupdates[fname] = self.init_rrd(fname, m)
-            self._dprint("[rrd] create new RRD file %s" % fname)
-        else:
-            if fname not in self.lupdates:
-                self.lupdates[fname] = rrdtool.last(str(fname))
+    def _load_mailbox_list(self):
+        """Load the addresses of local mailboxes."""
+        qset = admin_models.Mailbox.objects.values_list("address", "domain__name")
+        self.mailboxes = {
+            "{}@{}".format(address, domain).lower() for address, domain in qset
+        }
 
-        if m <= self.lupdates[fname]:
-            if self.verbose:
-                print("[rrd] VERBOSE events at %s already recorded in RRD" % m)
+    def reload_lists(self):
+        """Reload domains and mailboxes (when following a log)."""
+        self._load_domain_list()
+        for domname in self.domains:
+            self.data.setdefault(domname, {})
+        if mailboxes.get_slots():
+            self._load_mailbox_list()
+
+    def is_maillog_recorded(self, date, queue_id):
+        """Check if a Maillog entry has already been recorded."""
+        if self.last_maillog_date is None:
             return False
+        return date < self.last_maillog_date or (
+            date == self.last_maillog_date and queue_id in self.last_maillog_queue_ids
+        )
 
-        tpl = ""
-        for v in variables:
-            if tpl != "":
-                tpl += ":"
-            tpl += v
-        # Missing some RRD steps
-        # Est ce vraiment nécessaire... ?
-        if m > self.lupdates[fname] + rrdstep:
-            values = ""
-            for v in variables:
-                if values != "":
-                    values += ":"
-                values += "0"
-            for p in range(self.lupdates[fname] + rrdstep, m, rrdstep):
-                self.add_point_to_rrd(fname, tpl, values, ts=p)
-
-        values = "%s" % m
-        tpl = ""
-        for v in variables:
-            values += ":"
-            values += str(self.data[dom][m][v])
-            if tpl != "":
-                tpl += ":"
-            tpl += v
-        self.add_point_to_rrd(fname, tpl, values)
-        self.lupdates[fname] = m
-        return True
+    def add_maillog(self, date, queue_id, **kwargs):
+        """Queue a new Maillog entry."""
+        self.maillogs.append(models.Maillog(date=date, queue_id=queue_id, **kwargs))
+        if self.last_maillog_date is None or date > self.last_maillog_date:
+            self.last_maillog_date = date
+            self.last_maillog_queue_ids = set()
+        self.last_maillog_queue_ids.add(queue_id)
+        if self.autoflush and len(self.maillogs) >= maillog_batch_size:
+            self.flush_maillogs()
+
+    def flush_maillogs(self):
+        """Write pending Maillog entries to the database."""
+        if not self.maillogs:
+            return
+        with transaction.atomic():
+            models.Maillog.objects.bulk_create(
+                self.maillogs, batch_size=maillog_batch_size
+            )
+        self._dprint("[maillog] %d entries recorded" % len(self.maillogs))
+        self.maillogs = []
 
     def initcounters(self, dom):
         init = {}
@@ -312,283 +201,366 @@ class LogParser:
             self.initcounters("global")
         self.data["global"][self.cur_t][counter] += val
 
-    def year(self, month):
-        """Return the appropriate year
-
-        Date used in log files don't always embark the year so we need
-        to guess it :p
+    def _store_current_date(self, match):
+        """Also store the current period (based on rrdstep)."""
+        super()._store_current_date(match)
+        self.cur_t = self.orig_ts - self.orig_ts % rrdstep
 
-        This method tries to deal with year changes in a simply
-        (ugly?) way: if we currently are in january and the given
-        month is different, return the current year -1. Otherwise,
-        return the current year.
+    def is_supported_status(self, status):
+        """Only statuses having a counter are supported."""
+        return status in variables
 
-        Obviously, this method only works for year to year + 1
-        changes.
+    def new_domain_event(self, domain, name, value=1):
+        """Increment the counter of the event."""
+        self.inc_counter(domain, name, value)
 
-        :param month: the month of the current record beeing parsed
-        :return: an integer
-        """
-        month = time.strptime(month, "%b").tm_mon if not month.isdigit() else int(month)
-        if self.curmonth == 1 and month != self.curmonth:
-            return self.__year - 1
-        return self.__year
+    def new_mailbox_event(self, address, name, value=1):
+        """Increment the counter of the event for the current hour."""
+        address = address.lower()
+        if address not in self.mailboxes:
+            return
+        key = (address, self.cur_t - self.cur_t % mailboxes.HOUR)
+        counters = self.mailbox_data.setdefault(key, {})
+        counters[name] = counters.get(name, 0) + value
+
+    def new_sketch_event(self, kind, item, domains):
+        """Count the item in the sketches of the current window."""
+        window = self.cur_t - self.cur_t % self.sketch_window_size
+        for name in ["global"] + domains:
+            key = (window, name, kind)
+            sketch = self.sketches.get(key)
+            if sketch is None:
+                sketch = self.sketches[key] = sketches.SpaceSaving(self.sketch_capacity)
+            sketch.add(item)
+
+    def new_message_processed(
+        self, queue_id, message, msg_status, from_domain, to_domain, msg_to, msg_orig_to
+    ):
+        """Record a Maillog entry (unless already done)."""
+        cur_dt = datetime.fromtimestamp(self.orig_ts)
+        tz = timezone.get_current_timezone()
+        cur_dt = cur_dt.replace(tzinfo=tz)
+        if self.is_maillog_recorded(cur_dt, queue_id):
+            return
+        from_domain_id = self.domain_ids.get(from_domain)
+        to_domain_id = self.domain_ids.get(to_domain)
+        if msg_status == "sent" and to_domain_id:
+            msg_status = "received"
+        self.add_maillog(
+            cur_dt,
+            queue_id,
+            sender=message.sender,
+            rcpt=msg_to,
+            original_rcpt=msg_orig_to,
+            size=message.size,
+            status=msg_status,
+            from_domain_id=from_domain_id,
+            to_domain_id=to_domain_id,
+        )
 
-    def is_srs_forward(self, mail_address):
-        """Check if mail address has been mangled by SRS
+    def _parse_file(self, path, offset=0):
+        """Parse a log file, starting at offset.
 
-        Sender Rewriting Scheme (SRS) modifies mail adresses so that they
-        always end in a local domain.
+        Only complete lines are parsed.
 
-        :param str mail_address
-        :return a boolean
+        :return: the offset of the first line not parsed
         """
-        return self._srs_regex["detect_srs"].match(mail_address) is not None
-
-    def reverse_srs(self, mail_address):
-        """Try to unwind a mail address rewritten by SRS
+        with open_logfile(path) as fp:
+            if offset:
+                fp.seek(offset)
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    # Line is being written
+                    break
+                offset += len(line)
+                self._parse_line(line.decode("utf-8", errors="ignore"))
+        return offset
 
-        Sender Rewriting Scheme (SRS) modifies mail adresses so that they
-        always end in a local domain. Common Postfix implementations of SRS
-        rewrite all non-local mail addresss.
+    def write_statistics(self, before=None):
+        """Write pending points to the statistics store.
 
-        :param str mail_address
-        :return a str
+        :param int before: only write points older than this timestamp
+        """
+        for dom, data in self.data.items():
+            times = sorted(t for t in data if before is None or t < before)
+            if not times:
+                continue
+            self._dprint("[stats] dealing with domain %s" % dom)
+            self.store.update(dom, {t: data[t] for t in times})
+            for t in times:
+                del data[t]
+        self.write_mailbox_counters()
+        self.write_sketches(before)
+
+    def write_mailbox_counters(self):
+        """Add pending per mailbox counters to the counter files."""
+        if not self.mailbox_data:
+            return
+        if self.mailbox_counters is None:
+            self.mailbox_counters = mailboxes.MailboxCounters(self.workdir)
+        self.mailbox_counters.add(self.mailbox_data)
+        self._dprint("[stats] %d mailbox counters updated" % len(self.mailbox_data))
+        self.mailbox_data = {}
+
+    def write_sketches(self, before=None):
+        """Merge pending sketches with the recorded ones.
+
+        :param int before: only write sketches of windows over before
+                           this timestamp (merging partial sketches
+                           makes counts less accurate)
         """
-        m = self._srs_regex["reverse_srs0"].match(mail_address)
-        m = self._srs_regex["reverse_srs1"].match(mail_address) if m is None else m
+        keys = [
+            key
+            for key in self.sketches
+            if before is None or key[0] + self.sketch_window_size <= before
+        ]
+        if not keys:
+            return
+        sketches.save_sketches({key: self.sketches.pop(key) for key in keys})
+        self._dprint("[stats] %d sketches updated" % len(keys))
+
+    def get_sources(self):
+        """Return the parts of files to read (see Checkpoint.get_sources)."""
+        self.checkpoint = None
+        if self.checkpoints is None:
+            return [(self.logfile, 0)]
+        try:
+            self.checkpoint = self.checkpoints.get(self.logfile)
+            sources, resumed = self.checkpoint.get_sources(self.logfile)
+        except IOError as errno:
+            self._dprint("%s" % errno)
+            sys.exit(1)
+        if not resumed and self.checkpoint.timestamp is not None:
+            # Previous position is lost, skip lines already seen
+            self._dprint("[parser] checkpoint not found, reading the whole file")
+            self.skip_before = self.checkpoint.timestamp
+        for path, offset in sources:
+            self._dprint("[parser] reading %s from offset %d" % (path, offset))
+        return sources
+
+    def save_checkpoint(self, path, offset):
+        """Remember the position reached in the log file."""
+        if self.checkpoint is None:
+            return
+        self.checkpoint.update(path, offset, self.orig_ts)
+        self.checkpoints.save()
 
-        if m is not None:
-            return "%s@%s" % m.group(2, 1)
-        else:
-            return mail_address
+    def process(self):
+        """Process the log file.
 
-    def _parse_amavis(self, log, host, pid, subprog):
-        """Parse an Amavis log entry.
+        We parse it and then generate standard graphics (day, week,
+        month).
 
-        :param str log: logged message
-        :param str host: hostname
-        :param str pid: process ID
-        :return: True on success
-        """
-        m = self._regex["amavis"].search(log)
-        if m is not None:
-            dom = m.group("domain")
-            spam_result = m.group("result")
-            if dom is not None and dom in self.domains:
-                if spam_result == "INFECTED":
-                    self.inc_counter(dom, "virus")
-                elif spam_result in ["SPAM", "SPAMMY"]:
-                    self.inc_counter(dom, "spam")
-                return True
-
-        return False
-
-    def _parse_rmilter(self, log, host, pid, subprog):
-        """Parse an Rmilter log entry.
-
-        :param str log: logged message
-        :param str host: hostname
-        :param str pid: process ID
-        :return: True on success
+        When checkpoints are enabled, only the data added since the
+        previous run are parsed.
         """
-        m = self._regex["rmilter_line"].match(log)
-        if m is None:
-            return False
-        rmilter_hash, msg = m.groups()
-        workdict_key = "rmilter_" + rmilter_hash
-
-        # Virus check must come before spam check due to pattern similarity.
-        m = self._regex["rmilter_virus"].match(msg)
-        if m is not None:
-            self.workdict[workdict_key] = {"action": "virus"}
-            return True
-        m = self._regex["rmilter_spam"].match(msg)
-        if m is not None:
-            self.workdict[workdict_key] = {"action": "spam"}
-            return True
-
-        # Greylisting
-        if self.greylist:
-            m = self._regex["rmilter_greylist"].search(msg)
-            if m is not None:
-                self.workdict[workdict_key] = {"action": "greylist"}
-                return True
-
-        # Gather information about message sender and queue ID
-        m = self._regex["rmilter_msg_done"].match(msg)
-        if m is not None:
-            dom = split_mailbox(m.group("rcpt"))[1]
-
-            if workdict_key in self.workdict:
-                action = self.workdict[workdict_key].get("action", None)
-                if action is not None:
-                    self.inc_counter(dom, action)
-            return True
-
-        return False
-
-    def _parse_postfix(self, log, host, pid, subprog):
-        """Parse a log entry generated by Postfix.
-
-        :param str log: logged message
-        :param str host: hostname
-        :param str pid: process ID
-        :return: True on success
+        sources = self.get_sources()
+        try:
+            for path, offset in sources:
+                offset = self._parse_file(path, offset)
+        except IOError as errno:
+            self._dprint("%s" % errno)
+            sys.exit(1)
+        self.flush_maillogs()
+        self.write_statistics()
+        self.save_checkpoint(self.logfile, offset)
+        self.report_evictions()
+
+    def collect(self, path):
+        """Parse a log file without writing anything.
+
+        :return: a tuple (number of lines, counters, Maillog entries,
+                 number of evicted pending messages, mailbox counters,
+                 sketches)
         """
-        m = self._regex["id"].match(log)
-        if m is None:
-            return False
+        self.autoflush = False
+        self._parse_file(path)
+        return (
+            self.lines,
+            self.data,
+            self.maillogs,
+            self.workdict.evicted,
+            self.mailbox_data,
+            self.sketches,
+        )
 
-        queue_id, msg = m.groups()
+    def get_first_timestamp(self, path):
+        """Return the timestamp of the first dated line of a file.
 
-        # Handle rejected mails.
-        if queue_id == "NOQUEUE":
-            m = self._regex["reject"].match(msg)
-            dom = m.group(1) if m is not None else None
-            if dom in self.domains:
-                condition = self.greylist and (
-                    "Greylisted" in msg or (subprog == "postscreen" and " 450 " in msg)
-                )
-                if condition:
-                    self.inc_counter(dom, "greylist")
-                else:
-                    self.inc_counter(dom, "reject")
-            return True
-
-        # Message acknowledged.
-        m = self._regex["message-id"].search(msg)
-        if m is not None:
-            self.workdict[queue_id] = {"from": m.group(1), "size": 0}
-            return True
-
-        # Message enqueued.
-        m = self._regex["from+size"].search(msg)
-        if m is not None:
-            self.workdict[queue_id] = {
-                "from": self.reverse_srs(m.group(1)),
-                "size": int(m.group(2)),
-            }
-            return True
-
-        # Message disposition.
-        m = self._regex["to+status"].search(msg)
-        if m is None:
-            return False
-        (msg_to, msg_status) = m.groups()
-        if queue_id not in self.workdict:
-            self._dprint(
-                "[parser] inconsistent mail (%s: %s), skipping" % (queue_id, msg_to)
-            )
-            return True
-        if msg_status not in variables:
-            self._dprint("[parser] unsupported status %s, skipping" % msg_status)
-            return True
-
-        # orig_to is optional.
-        m = self._regex["orig_to"].search(msg)
-        msg_orig_to = m.group(1) if m is not None else None
-
-        # Handle local "from" domains.
-        from_domain = split_mailbox(self.workdict[queue_id]["from"])[1]
-        if from_domain is not None and from_domain in self.domains:
-            self.inc_counter(from_domain, "sent")
-            self.inc_counter(from_domain, "size_sent", self.workdict[queue_id]["size"])
-
-        # Handle local "to" domains.
-        to_domain = None
-        condition = msg_orig_to is not None and not self.is_srs_forward(msg_orig_to)
-        if condition:
-            to_domain = split_mailbox(msg_orig_to)[1]
-        if to_domain is None:
-            to_domain = split_mailbox(msg_to)[1]
-
-        if msg_status == "sent":
-            self.inc_counter(to_domain, "recv")
-            self.inc_counter(to_domain, "size_recv", self.workdict[queue_id]["size"])
-        else:
-            self.inc_counter(to_domain, msg_status)
+        0 is returned if the file does not contain any date.
+        """
+        with open_logfile(path) as fp:
+            for line in fp:
+                if self._parse_date(line.decode("utf-8", errors="ignore")) is not None:
+                    return self.orig_ts
+        return 0
 
-        last_message = models.Maillog.objects.last()
-        cur_dt = datetime.fromtimestamp(self.orig_ts)
-        tz = timezone.get_current_timezone()
-        cur_dt = cur_dt.replace(tzinfo=tz)
-        condition = last_message and (
-            cur_dt < last_message.date
-            or (
-                cur_dt == last_message.date
-                and models.Maillog.objects.filter(
-                    date=cur_dt, queue_id=queue_id
-                ).exists()
-            )
-        )
-        if not condition:
-            if from_domain in self.domains:
-                from_domain = Domain.objects.filter(
-                    Q(name=from_domain) | Q(domainalias__name=from_domain)
-                ).first()
-            else:
-                from_domain = None
-            if to_domain in self.domains:
-                to_domain = Domain.objects.filter(
-                    Q(name=to_domain) | Q(domainalias__name=to_domain)
-                ).first()
+    def flush_before(self, before=None):
+        """Write pending data logged before a timestamp.
+
+        Pending Maillog entries are sorted by date first, those logged
+        after before (if given) are kept.
+        """
+        # Sorting is stable so entries logged at the same time keep
+        # the order in which they were added
+        self.maillogs.sort(key=lambda maillog: maillog.date)
+        pending = []
+        if before is not None:
+            for index, maillog in enumerate(self.maillogs):
+                if maillog.date.timestamp() >= before:
+                    pending = self.maillogs[index:]
+                    del self.maillogs[index:]
+                    break
+            before -= before % rrdstep
+        self.flush_maillogs()
+        self.maillogs = pending
+        self.write_statistics(before)
+
+    def merge(self, data, maillogs, mailbox_data=None, sketch_data=None):
+        """Add the results of another parser (see collect)."""
+        for key, sketch in (sketch_data or {}).items():
+            if key not in self.sketches:
+                self.sketches[key] = sketch
             else:
-                to_domain = None
-            if msg_status == "sent" and to_domain:
-                msg_status = "received"
-            models.Maillog.objects.create(
-                queue_id=queue_id,
-                date=cur_dt,
-                sender=self.workdict[queue_id]["from"],
-                rcpt=msg_to,
-                original_rcpt=msg_orig_to,
-                size=self.workdict[queue_id]["size"],
-                status=msg_status,
-                from_domain=from_domain,
-                to_domain=to_domain,
+                self.sketches[key].merge(sketch)
+        for key, counters in (mailbox_data or {}).items():
+            if key not in self.mailbox_data:
+                self.mailbox_data[key] = counters
+                continue
+            for v, value in counters.items():
+                self.mailbox_data[key][v] = self.mailbox_data[key].get(v, 0) + value
+        for dom, minutes in data.items():
+            if dom not in self.data:
+                continue
+            for t, counters in minutes.items():
+                if t not in self.data[dom]:
+                    self.data[dom][t] = counters
+                    continue
+                for v, value in counters.items():
+                    self.data[dom][t][v] += value
+        self.maillogs += maillogs
+
+    def report_evictions(self):
+        """Print the number of pending messages evicted so far."""
+        if self.workdict.evicted:
+            self._dprint(
+                "[parser] %d pending messages evicted (%d expired, %d dropped)"
+                % (self.workdict.evicted, self.workdict.expired, self.workdict.dropped)
             )
 
-        return True
+    def flush(self, final=False, idle=0):
+        """Write pending Maillog entries and statistics.
 
-    def _parse_line(self, line):
-        """Parse a single log line.
+        Unless final is True, points of the current minute (the one of
+        the last parsed line) are kept since more events might be
+        received for it: once a point is written, older ones are
+        ignored by the store. It is written anyway when the source has
+        been quiet for more than one step, so graphs stay up-to-date.
 
-        :param str line: log line
+        :param float idle: number of seconds since the last line was
+                           received
         """
-        line = self._parse_date(line)
-        if line is None:
+        self.flush_maillogs()
+        self.report_evictions()
+        if final:
+            self.write_statistics()
             return
-        m = self._regex["line"].match(line)
-        if not m:
-            return
-        host, prog, subprog, pid, log = m.groups()
+        before = self.cur_t
+        if idle > rrdstep:
+            before += rrdstep
+        self.write_statistics(before=before)
 
-        try:
-            parser = getattr(self, "_parse_{}".format(prog))
-            if not parser(log, host, pid, subprog):
-                self._dprint("[parser] ignoring %r log: %r" % (prog, log))
-        except AttributeError:
-            self._dprint('[parser] no log handler for "{}": {}'.format(prog, log))
+    def follow(self, source, flush_interval=60, flush_lines=10000, reload_interval=300):
+        """Parse lines received from source until it is closed.
 
-    def process(self):
-        """Process the log file.
+        Pending data are flushed every flush_interval seconds or every
+        flush_lines lines, whichever comes first. Domains and mailboxes
+        are reloaded at the first flush after reload_interval seconds.
 
-        We parse it and then generate standard graphics (day, week,
-        month).
+        :param source: an object providing a read(timeout) method (see
+                       the follow module)
         """
+        checkpoint_source = source if isinstance(source, FileSource) else None
+        lines = 0
+        next_flush = last_received = time.monotonic()
+        next_reload = next_flush + reload_interval
+        next_flush += flush_interval
+        try:
+            while True:
+                try:
+                    received = source.read(max(next_flush - time.monotonic(), 0))
+                except EOFError:
+                    break
+                for line in received:
+                    self._parse_line(line.decode("utf-8", errors="ignore"))
+                if received:
+                    last_received = time.monotonic()
+                lines += len(received)
+                if lines < flush_lines and time.monotonic() < next_flush:
+                    continue
+                self.flush(idle=time.monotonic() - last_received)
+                if checkpoint_source is not None:
+                    self.save_followed_file_checkpoint(checkpoint_source)
+                if time.monotonic() >= next_reload:
+                    self.reload_lists()
+                    next_reload = time.monotonic() + reload_interval
+                lines = 0
+                next_flush = time.monotonic() + flush_interval
+        finally:
+            self.flush(final=True)
+            if checkpoint_source is not None:
+                self.save_followed_file_checkpoint(checkpoint_source)
+            source.close()
+
+    def save_followed_file_checkpoint(self, source):
+        """Save the position reached in a followed file."""
+        try:
+            inode = os.stat(source.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode != source.inode:
+            # Rotated file still being read, wait for the next one
+            return
+        self.save_checkpoint(source.path, source.offset)
+
+    def follow_logfile(self, flush_interval=60, flush_lines=10000, reload_interval=300):
+        """Follow the log file, starting from the last checkpoint."""
+        sources = self.get_sources()
         try:
-            with open(self.logfile, encoding="utf-8", errors="ignore") as fp:
-                for line in fp:
-                    self._parse_line(line)
+            # Catch up with rotated files
+            for path, offset in sources[:-1]:
+                self._parse_file(path, offset)
+            source = FileSource(*sources[-1])
         except IOError as errno:
             self._dprint("%s" % errno)
             sys.exit(1)
+        self.follow(source, flush_interval, flush_lines, reload_interval)
 
-        for dom, data in self.data.items():
-            self._dprint("[rrd] dealing with domain %s" % dom)
-            for t in sorted(data.keys()):
-                self.update_rrd(dom, t)
+
+# Arguments used to create the parsers of collect_logfile (inherited
+# by worker processes)
+_collect_arguments = None
+
+
+def collect_logfile(path):
+    """Parse a single log file (for parallel parsing).
+
+    :return: see LogParser.collect
+    """
+    options, workdir, greylist, template = _collect_arguments
+    parser = LogParser(
+        dict(options, logfile=path), workdir, None, greylist, template=template
+    )
+    return parser.collect(path)
+
+
+def expand_paths(patterns):
+    """Return the paths matching a list of paths or glob patterns."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths += [path for path in matches if path not in paths]
+    return paths
 
 
 class Command(BaseCommand):
@@ -596,12 +568,60 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         """Add extra arguments to command line."""
+        parser.add_argument(
+            "logfiles",
+            nargs="*",
+            help="log files (or glob patterns) to parse at once, possibly "
+            "compressed, instead of the configured one",
+            metavar="FILE",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of processes used to parse log files given as arguments",
+            metavar="N",
+        )
         parser.add_argument(
             "--logfile",
             default=None,
-            help="postfix log in syslog format",
+            help="postfix log in syslog format (- to read standard input)",
             metavar="FILE",
         )
+        parser.add_argument(
+            "--follow",
+            default=False,
+            action="store_true",
+            help="Keep reading the log file as it grows (like tail -F)",
+        )
+        parser.add_argument(
+            "--socket",
+            default=None,
+            help="Receive log lines on this UNIX datagram socket instead of "
+            "reading a file (implies --follow)",
+            metavar="PATH",
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=int,
+            default=60,
+            help="When following, write pending data every N seconds",
+            metavar="N",
+        )
+        parser.add_argument(
+            "--flush-lines",
+            type=int,
+            default=10000,
+            help="When following, write pending data every N lines",
+            metavar="N",
+        )
+        parser.add_argument(
+            "--reload-interval",
+            type=int,
+            default=300,
+            help="When following, reload domains and mailboxes every N seconds",
+            metavar="N",
+        )
         parser.add_argument(
             "--verbose",
             default=False,
@@ -612,6 +632,14 @@ class Command(BaseCommand):
         parser.add_argument(
             "--debug", default=False, action="store_true", help="Set debug mode"
         )
+        parser.add_argument(
+            "--no-checkpoint",
+            default=True,
+            action="store_false",
+            dest="checkpoint",
+            help="Parse the whole log file instead of resuming from the "
+            "previous position",
+        )
 
     def can_start(self):
         """Check if another process is already running or not."""
@@ -630,6 +658,74 @@ class Command(BaseCommand):
             fp.write(f"{os.getpid()}\n")
         return True
 
+    def parse_logfiles(self, options, workdir, greylist):
+        """Parse log files given as arguments, in parallel if asked.
+
+        Each file is parsed by its own parser (in a worker process
+        when several jobs are used). Files are parsed from the oldest
+        to the most recent one, by batches of jobs files whose results
+        are merged in a deterministic order. Data logged before the
+        start of the next batch are then written, so only files whose
+        periods overlap are kept in memory together. Workers never
+        access the database: they reuse what the main parser has
+        loaded.
+        """
+        global _collect_arguments
+
+        paths = expand_paths(options["logfiles"])
+        jobs = max(min(options["jobs"], len(paths)), 1)
+        worker_options = {
+            "debug": options["debug"],
+            "verbose": options["verbose"],
+            "rrdcached": options["rrdcached"],
+            "checkpoint": False,
+        }
+        parser = LogParser(dict(worker_options, logfile=None), workdir, None, greylist)
+        _collect_arguments = (worker_options, workdir, greylist, parser)
+        start = time.monotonic()
+        lines = evicted = 0
+        pool = None
+        if jobs > 1:
+            pool = multiprocessing.get_context("fork").Pool(jobs)
+        try:
+            starts = {path: parser.get_first_timestamp(path) for path in paths}
+            paths.sort(key=starts.get)
+            for offset in range(0, len(paths), jobs):
+                batch = paths[offset : offset + jobs]
+                if pool is not None:
+                    results = pool.map(collect_logfile, batch, chunksize=1)
+                else:
+                    results = map(collect_logfile, batch)
+                for (
+                    result_lines,
+                    data,
+                    result_maillogs,
+                    result_evicted,
+                    mailbox_data,
+                    result_sketches,
+                ) in results:
+                    lines += result_lines
+                    evicted += result_evicted
+                    parser.merge(data, result_maillogs, mailbox_data, result_sketches)
+                if offset + jobs < len(paths):
+                    parser.flush_before(starts[paths[offset + jobs]])
+        except IOError as errno:
+            self.stderr.write("%s" % errno)
+            sys.exit(1)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        parser.flush_before()
+        duration = time.monotonic() - start
+        self.stdout.write(
+            "%d lines parsed from %d file(s) in %.1fs (%d lines/s)"
+            % (lines, len(paths), duration, lines / duration if duration else lines)
+        )
+        if evicted:
+            self.stdout.write(
+                "%d messages evicted before their end was found" % evicted
+            )
+
     def handle(self, *args, **options):
         if not self.can_start():
             print("Another process is already running, cannot start")
@@ -639,7 +735,40 @@ class Command(BaseCommand):
                 "logfile", app="maillog"
             )
         greylist = param_tools.get_global_parameter("greylist", raise_exception=False)
+        options["rrdcached"] = param_tools.get_global_parameter(
+            "rrdcached_address", raise_exception=False
+        )
+        if options["logfiles"]:
+            self.parse_logfiles(
+                options, param_tools.get_global_parameter("rrd_rootdir"), greylist
+            )
+            return
+        if options["socket"] is not None or options["logfile"] == "-":
+            # Positions are meaningless for these sources
+            options["checkpoint"] = False
         p = LogParser(
             options, param_tools.get_global_parameter("rrd_rootdir"), None, greylist
         )
-        p.process()
+        flush_options = {
+            "flush_interval": options["flush_interval"],
+            "flush_lines": options["flush_lines"],
+            "reload_interval": options["reload_interval"],
+        }
+        if options["socket"] is not None:
+            source = SocketSource(options["socket"])
+        elif options["logfile"] == "-":
+            source = StreamSource(sys.stdin)
+        elif options["follow"]:
+            source = None
+        else:
+            p.process()
+            return
+        # Make sure pending data are written when asked to stop
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            if source is None:
+                p.follow_logfile(**flush_options)
+            else:
+                p.follow(source, **flush_options)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,86 @@
+"""Log parser benchmark management command."""
+
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import benchmark
+
+
+class Command(BaseCommand):
+    """Parse a synthetic mail log and report the throughput."""
+
+    help = "Measure the throughput of the mail log parser"
+
+    def add_arguments(self, parser):
+        """Add command line arguments."""
+        parser.add_argument(
+            "--lines", type=int, default=2000000, help="Number of lines to generate"
+        )
+        parser.add_argument(
+            "--domains", type=int, default=100, help="Number of local domains"
+        )
+        parser.add_argument(
+            "--users", type=int, default=1000, help="Number of local users"
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=50,
+            help="Number of messages processed at the same time",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=None, help="Seed of the random generator"
+        )
+        parser.add_argument(
+            "--output",
+            default=None,
+            help="Keep the generated log in this file (reused if it exists)",
+            metavar="FILE",
+        )
+
+    def handle(self, *args, **options):
+        """Entry point."""
+        generator = benchmark.LogGenerator(
+            domains=options["domains"],
+            users=options["users"],
+            concurrency=options["concurrency"],
+            seed=options["seed"],
+        )
+        path = options["output"]
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".log")
+            os.close(fd)
+        try:
+            if options["output"] is None or not os.path.exists(path):
+                start = time.perf_counter()
+                generator.write(path, options["lines"])
+                self.stdout.write(
+                    "Generated {} lines in {:.2f}s".format(
+                        options["lines"], time.perf_counter() - start
+                    )
+                )
+            results = benchmark.run(path, generator.domains)
+        finally:
+            if options["output"] is None:
+                os.unlink(path)
+        self.stdout.write(
+            "Lines: {lines} in {duration:.2f}s ({throughput:.0f} lines/s)".format(
+                **results
+            )
+        )
+        self.stdout.write(
+            "Messages: {messages} ({pending} pending, {evicted} evicted)".format(
+                **results
+            )
+        )
+        self.stdout.write(
+            "Events: {}".format(
+                ", ".join(
+                    "{}={}".format(name, count)
+                    for name, count in sorted(results["events"].items())
+                )
+            )
+        )
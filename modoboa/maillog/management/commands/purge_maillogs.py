@@ -0,0 +1,83 @@
+"""Management command to remove old Maillog records."""
+
+import datetime
+import logging
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from modoboa.parameters import tools as param_tools
+
+from ... import retention
+from ... import sketches
+
+
+class Command(BaseCommand):
+    """Command class."""
+
+    help = "Remove message log records older than the retention period"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--days",
+            type=int,
+            help="Retention period in days (overrides the global parameter)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=retention.DEFAULT_CHUNK_SIZE,
+            help="Number of records deleted per transaction",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Delay (in seconds) between two chunks",
+        )
+        parser.add_argument(
+            "--debug", action="store_true", default=False, help="Activate debug output"
+        )
+        parser.add_argument(
+            "--verbose",
+            action="store_true",
+            default=False,
+            help="Display informational messages",
+        )
+
+    def __vprint(self, msg):
+        if not self.verbose:
+            return
+        print(msg)
+
+    def handle(self, *args, **options):
+        if options["debug"]:
+            log = logging.getLogger("django.db.backends")
+            log.setLevel(logging.DEBUG)
+            log.addHandler(logging.StreamHandler())
+        self.verbose = options["verbose"]
+
+        maximum_age = options["days"]
+        if maximum_age is None:
+            maximum_age = param_tools.get_global_parameter(
+                "maillog_maximum_age", app="maillog"
+            )
+        if not maximum_age:
+            self.__vprint("Retention disabled, nothing to do.")
+            return
+        now = timezone.now()
+        limit = now - datetime.timedelta(maximum_age)
+        self.__vprint("Deleting message logs older than %d days..." % maximum_age)
+        if retention.is_partitioned():
+            for name in retention.create_partitions(now):
+                self.__vprint("Partition %s created" % name)
+            for name in retention.drop_partitions(limit):
+                self.__vprint("Partition %s dropped" % name)
+        count = retention.delete_old_records(
+            limit, chunk_size=max(options["chunk_size"], 1), pause=options["sleep"]
+        )
+        self.__vprint("%d record(s) deleted." % count)
+        count = sketches.delete_old_sketches(int(limit.timestamp()))
+        self.__vprint("%d sketch(es) deleted." % count)
+        self.__vprint("Done.")
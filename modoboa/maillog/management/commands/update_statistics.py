@@ -1,16 +1,22 @@
 """Management command to update various statistics."""
 
+import datetime
 import os
 
-from dateutil.relativedelta import relativedelta
 import rrdtool
 
 from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.db.models.functions import Trunc
 from django.utils import timezone
 
 from modoboa.core import models as core_models
 from modoboa.parameters import tools as param_tools
 
+STEP = 3600
+# Maximum number of points sent to rrdtool at once
+UPDATE_CHUNK_SIZE = 1000
+
 
 class Command(BaseCommand):
     """Update statistics."""
@@ -27,58 +33,76 @@ class Command(BaseCommand):
 
     def _create_new_accounts_rrd_file(self, fname, start):
         """Create RRD file."""
-        step = 3600
         ds_name = "new_accounts"
-        params = ["DS:{}:ABSOLUTE:{}:0:U".format(ds_name, step * 2)]
+        params = ["DS:{}:ABSOLUTE:{}:0:U".format(ds_name, STEP * 2)]
         params += [
             "RRA:AVERAGE:0.5:1:48",  # 48 hours with a 1h granularity
             "RRA:AVERAGE:0.5:24:31",  # 31 days with a 1d granularity
             "RRA:AVERAGE:0.5:168:52",  # 52 weeks with a 1w granularity
             "RRA:AVERAGE:0.5:5208:24",  # 24 months with a 1m granularity
         ]
-        rrdtool.create(str(fname), "--start", str(start), "--step", str(step), *params)
+        rrdtool.create(str(fname), "--start", str(start), "--step", str(STEP), *params)
+
+    def get_hourly_counts(self):
+        """Yield the number of accounts created per hour, in order.
+
+        Hours without new accounts are skipped. Each count is associated
+        with the end of its hour, which is the timestamp of the RRD
+        point.
+        """
+        qset = (
+            core_models.User.objects.annotate(
+                hour=Trunc("date_joined", "hour", tzinfo=datetime.timezone.utc)
+            )
+            .values("hour")
+            .annotate(count=Count("pk"))
+            .order_by("hour")
+        )
+        for row in qset.iterator():
+            yield int(row["hour"].timestamp()) + STEP, row["count"]
 
     def update_account_creation_stats(self, rebuild=False):
         """Look for newly created accounts."""
         db_path = os.path.join(self.rootdir, "new_accounts.rrd")
-        data = []
+        end = timezone.now().replace(minute=0, second=0, microsecond=0)
         if not rebuild:
-            end = timezone.now().replace(minute=0, second=0, microsecond=0)
-            start = end - relativedelta(hours=1)
+            start = end - datetime.timedelta(hours=1)
             new_accounts = core_models.User.objects.filter(
                 date_joined__gte=start, date_joined__lt=end
             ).count()
-            data.append("{}:{}".format(int(end.strftime("%s")), new_accounts * 60))
-        else:
-            existing_stats = {}
-            start = None
-            for user in core_models.User.objects.all().order_by("date_joined"):
-                hour = user.date_joined.replace(
-                    minute=0, second=0, microsecond=0
-                ) + relativedelta(hours=1)
-                if start is None:
-                    start = hour
-                hour = int(hour.strftime("%s"))
-                if hour not in existing_stats:
-                    existing_stats[hour] = 0
-                existing_stats[hour] += 1
-            end = timezone.now().replace(
-                minute=0, second=0, microsecond=0
-            ) + relativedelta(hours=1)
-            if os.path.exists(db_path):
-                os.unlink(db_path)
-            hour = start
-            while hour <= end:
-                new_accounts = existing_stats.get(int(hour.strftime("%s")), 0)
-                data.append("{}:{}".format(int(hour.strftime("%s")), new_accounts * 60))
-                hour += relativedelta(hours=1)
-        if not os.path.exists(db_path):
-            self._create_new_accounts_rrd_file(
-                db_path, int((start - relativedelta(hours=1)).strftime("%s"))
-            )
-        rrdtool.update(str(db_path), *data)
+            end = int(end.timestamp())
+            if not os.path.exists(db_path):
+                self._create_new_accounts_rrd_file(db_path, end - 2 * STEP)
+            rrdtool.update(str(db_path), "{}:{}".format(end, new_accounts * 60))
+            return
+        end = int(end.timestamp()) + STEP
+        counts = self.get_hourly_counts()
+        pending = next(counts, None)
+        start = pending[0] if pending else end
+        if os.path.exists(db_path):
+            os.unlink(db_path)
+        self._create_new_accounts_rrd_file(db_path, start - STEP)
+        # Every hour gets a point, so updates are sent by chunks
+        data = []
+        for hour in range(start, end + 1, STEP):
+            new_accounts = 0
+            if pending and pending[0] == hour:
+                new_accounts = pending[1]
+                pending = next(counts, None)
+            data.append("{}:{}".format(hour, new_accounts * 60))
+            if len(data) >= UPDATE_CHUNK_SIZE:
+                rrdtool.update(str(db_path), *data)
+                data = []
+        if data:
+            rrdtool.update(str(db_path), *data)
 
     def handle(self, *args, **options):
         """Entry point."""
+        backend = param_tools.get_global_parameter(
+            "statistics_backend", raise_exception=False
+        )
+        if backend == "sql":
+            # Account creation graphics are computed from users
+            return
         self.rootdir = param_tools.get_global_parameter("rrd_rootdir")
         self.update_account_creation_stats(options["rebuild"])
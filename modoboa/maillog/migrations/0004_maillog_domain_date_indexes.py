@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-17 08:16
+
+from django.db import migrations, models
+
+from modoboa.lib.db_utils import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ("maillog", "0003_auto_20211108_1652"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="maillog",
+            index=models.Index(
+                fields=["from_domain", "date"], name="maillog_mai_from_do_a5bd52_idx"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="maillog",
+            index=models.Index(
+                fields=["to_domain", "date"], name="maillog_mai_to_doma_3939b7_idx"
+            ),
+        ),
+    ]
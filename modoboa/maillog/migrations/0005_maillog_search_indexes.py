@@ -0,0 +1,102 @@
+# Generated by Django 4.2.30 on 2026-10-17 08:30
+
+from django.db import DatabaseError, migrations, models
+
+from modoboa.lib.db_utils import AddIndexConcurrently
+
+PREFIX_INDEXES = {
+    "maillog_sender_prefix": "sender",
+    "maillog_rcpt_prefix": "rcpt",
+    "maillog_original_rcpt_prefix": "original_rcpt",
+}
+
+TRIGRAM_INDEXES = {
+    "maillog_queue_id_trgm": "queue_id",
+    "maillog_sender_trgm": "sender",
+    "maillog_rcpt_trgm": "rcpt",
+    "maillog_original_rcpt_trgm": "original_rcpt",
+}
+
+
+def create_prefix_indexes(apps, schema_editor):
+    """Create indexes used by case-insensitive prefix searches.
+
+    Indexed expressions match the ones used by Django for istartswith
+    lookups, which depend on the database engine.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        sql = (
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON maillog_maillog "
+            "(UPPER({}::text) text_pattern_ops)"
+        )
+    elif vendor == "sqlite":
+        sql = "CREATE INDEX IF NOT EXISTS {} ON maillog_maillog ({} COLLATE NOCASE)"
+    else:
+        sql = "CREATE INDEX {} ON maillog_maillog ({})"
+    with schema_editor.connection.cursor() as cursor:
+        for name, column in PREFIX_INDEXES.items():
+            cursor.execute(sql.format(name, column))
+
+
+def drop_prefix_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        sql = "DROP INDEX CONCURRENTLY IF EXISTS {}"
+    elif vendor == "sqlite":
+        sql = "DROP INDEX IF EXISTS {}"
+    else:
+        sql = "DROP INDEX {} ON maillog_maillog"
+    with schema_editor.connection.cursor() as cursor:
+        for name in PREFIX_INDEXES:
+            cursor.execute(sql.format(name))
+
+
+def create_trigram_indexes(apps, schema_editor):
+    """Create trigram indexes used by substring searches.
+
+    Indexed expressions match the ones used by Django for icontains
+    lookups. Nothing is done when the pg_trgm extension cannot be
+    created.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except DatabaseError:
+            return
+        for name, column in TRIGRAM_INDEXES.items():
+            cursor.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON maillog_maillog "
+                "USING gin (UPPER({}::text) gin_trgm_ops)".format(name, column)
+            )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        for name in TRIGRAM_INDEXES:
+            cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ("maillog", "0004_maillog_domain_date_indexes"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="maillog",
+            index=models.Index(fields=["queue_id"], name="maillog_queue_id_idx"),
+        ),
+        migrations.RunPython(create_prefix_indexes, drop_prefix_indexes),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
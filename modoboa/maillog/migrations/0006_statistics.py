@@ -0,0 +1,100 @@
+# Generated by Django 4.2.30 on 2026-10-17 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("maillog", "0005_maillog_search_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MinuteStatistics",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                ("timestamp", models.BigIntegerField()),
+                ("sent", models.BigIntegerField(default=0)),
+                ("recv", models.BigIntegerField(default=0)),
+                ("bounced", models.BigIntegerField(default=0)),
+                ("reject", models.BigIntegerField(default=0)),
+                ("spam", models.BigIntegerField(default=0)),
+                ("virus", models.BigIntegerField(default=0)),
+                ("greylist", models.BigIntegerField(default=0)),
+                ("size_sent", models.BigIntegerField(default=0)),
+                ("size_recv", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "abstract": False,
+                "unique_together": {("name", "timestamp")},
+            },
+        ),
+        migrations.CreateModel(
+            name="HourStatistics",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                ("timestamp", models.BigIntegerField()),
+                ("sent", models.BigIntegerField(default=0)),
+                ("recv", models.BigIntegerField(default=0)),
+                ("bounced", models.BigIntegerField(default=0)),
+                ("reject", models.BigIntegerField(default=0)),
+                ("spam", models.BigIntegerField(default=0)),
+                ("virus", models.BigIntegerField(default=0)),
+                ("greylist", models.BigIntegerField(default=0)),
+                ("size_sent", models.BigIntegerField(default=0)),
+                ("size_recv", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "abstract": False,
+                "unique_together": {("name", "timestamp")},
+            },
+        ),
+        migrations.CreateModel(
+            name="DayStatistics",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                ("timestamp", models.BigIntegerField()),
+                ("sent", models.BigIntegerField(default=0)),
+                ("recv", models.BigIntegerField(default=0)),
+                ("bounced", models.BigIntegerField(default=0)),
+                ("reject", models.BigIntegerField(default=0)),
+                ("spam", models.BigIntegerField(default=0)),
+                ("virus", models.BigIntegerField(default=0)),
+                ("greylist", models.BigIntegerField(default=0)),
+                ("size_sent", models.BigIntegerField(default=0)),
+                ("size_recv", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "abstract": False,
+                "unique_together": {("name", "timestamp")},
+            },
+        ),
+    ]
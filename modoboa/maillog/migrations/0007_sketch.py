@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-17 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("maillog", "0006_statistics"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Sketch",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("senders", "Senders"),
+                            ("recipients", "Recipients"),
+                            ("rejected_clients", "Rejected client domains"),
+                            ("bounce_sources", "Bounce sources"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("timestamp", models.BigIntegerField(db_index=True)),
+                ("items", models.JSONField(default=list)),
+            ],
+            options={
+                "unique_together": {("name", "kind", "timestamp")},
+            },
+        ),
+    ]
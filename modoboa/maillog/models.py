@@ -2,6 +2,8 @@
 
 from django.db import models
 
+from . import constants
+
 
 class Maillog(models.Model):
     """A model to store message logs."""
@@ -29,3 +31,62 @@ class Maillog(models.Model):
 
     class Meta:
         ordering = ["date"]
+        indexes = [
+            models.Index(fields=["from_domain", "date"]),
+            models.Index(fields=["to_domain", "date"]),
+            models.Index(fields=["queue_id"], name="maillog_queue_id_idx"),
+        ]
+
+
+class Statistics(models.Model):
+    """Counters of a domain (or global) over a period.
+
+    Used by the SQL statistics store.
+    """
+
+    name = models.CharField(max_length=100)
+    # Start of the period
+    timestamp = models.BigIntegerField()
+
+    sent = models.BigIntegerField(default=0)
+    recv = models.BigIntegerField(default=0)
+    bounced = models.BigIntegerField(default=0)
+    reject = models.BigIntegerField(default=0)
+    spam = models.BigIntegerField(default=0)
+    virus = models.BigIntegerField(default=0)
+    greylist = models.BigIntegerField(default=0)
+    size_sent = models.BigIntegerField(default=0)
+    size_recv = models.BigIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+        unique_together = (("name", "timestamp"),)
+
+
+class MinuteStatistics(Statistics):
+    """Counters per minute."""
+
+
+class HourStatistics(Statistics):
+    """Counters per hour."""
+
+
+class DayStatistics(Statistics):
+    """Counters per day."""
+
+
+class Sketch(models.Model):
+    """Most frequent items of a domain (or global) over a window.
+
+    See the sketches module.
+    """
+
+    name = models.CharField(max_length=100)
+    kind = models.CharField(max_length=20, choices=constants.SKETCH_KINDS)
+    # Start of the window
+    timestamp = models.BigIntegerField(db_index=True)
+    # [item, count, error] entries
+    items = models.JSONField(default=list)
+
+    class Meta:
+        unique_together = (("name", "kind", "timestamp"),)
@@ -1,28 +1,56 @@
 """Parsing tools for maillog related files."""
 
-import io
 import re
 import time
 
+from django.conf import settings
+
 from modoboa.admin import models as admin_models
 from modoboa.lib.email_utils import split_mailbox
 
-from . import utils
+from . import lib
+from .checkpoint import open_logfile
+from .pending import DEFAULT_MAX_SIZE, DEFAULT_TTL, PendingMessages
+from .sketches import get_client_domain
 
 
 class MaillogParser:
-    """Main parser class for maillog file."""
+    """Main parser class for maillog file.
+
+    The parser only extracts events from log lines, what to do with
+    them is up to subclasses (see the new_domain_event,
+    new_mailbox_event, new_sketch_event and new_message_processed
+    methods).
+    """
 
-    def __init__(self, year=None, greylist=False, verbose=False, debug=False):
-        """Constructor."""
+    def __init__(
+        self, year=None, greylist=False, verbose=False, debug=False, template=None
+    ):
+        """Constructor.
+
+        When template (another parser) is given, the domains it has
+        loaded are reused so the database is not accessed.
+        """
         self.debug = debug
         self.verbose = verbose
 
-        self.domains = []
-        self._load_domain_list()
+        self.domains = set()
+        self.domain_ids = {}
+        if template is None:
+            self._load_domain_list()
+        else:
+            self.domains = template.domains
+            self.domain_ids = template.domain_ids
 
-        self.workdict = {}
-        self.lupdates = {}
+        self.workdict = PendingMessages(
+            getattr(settings, "MAILLOG_MAX_PENDING_MESSAGES", DEFAULT_MAX_SIZE),
+            getattr(settings, "MAILLOG_PENDING_MESSAGE_TTL", DEFAULT_TTL),
+        )
+        # Lines older than this timestamp are ignored
+        self.skip_before = None
+        # Timestamp of the last parsed line
+        self.orig_ts = None
+        self.lines = 0
 
         self.__year = year
         curtime = time.localtime()
@@ -37,14 +65,25 @@ class MaillogParser:
         ]
         self._date_expressions = [re.compile(v) for v in self._date_expressions]
         self.date_expr = None
+        # Timestamp of the minute of the last parsed date (converting
+        # a date is expensive, it is only done once per minute)
+        self._minute = None
+        self._minute_ts = 0
         self._regex = {
-            "line": r"\s+([-\w\.]+)\s+(\w+)/?(\w*)[[](\d+)[]]:\s+(.*)",
+            "line": r"\s+([-\w\.]+)\s+(\w+)/?(\w*)\[(\d+)\]:\s+(.*)",
             "id": r"(\w+): (.*)",
             "reject": r"reject: .*from=<.*>,? to=<[^@]+@([^>]+)>",
+            "client": r"from ([^\[\s]*)\[([^\]]+)\]",
             "message-id": r"message-id=<([^>]*)>",
             "from+size": r"from=<([^>]*)>, size=(\d+)",
             "to+status": r"to=<([^>]*)>.*status=(\S+)",
             "orig_to": r"orig_to=<([^>]*)>.*",
+            "amavis": r"(?P<result>INFECTED|SPAM|SPAMMY) .* <[^>]+> -> <[^@]+@(?P<domain>[^>]+)>.*",  # noqa
+            "rmilter_line": r"<(?P<hash>[0-9a-f]{10})>; (?P<line>.*)",
+            "rmilter_msg_done": r"msg done: queue_id: <(?P<queue_id>[^>]+)>; message id: <(?P<message_id>[^>]+)>.*; from: <(?P<from>[^>]+)>; rcpt: <(?P<rcpt>[^>]+)>.*; spam scan: (?P<action>[^;]+); virus scan:",  # noqa
+            "rmilter_spam": r"mlfi_eom: (rejecting spam|add spam header to message according to spamd action)",  # noqa
+            "rmilter_virus": r"mlfi_eom:.* virus found",
+            "rmilter_greylist": (r"GREYLIST\([0-9]+\.[0-9]{2}\)\[greylisted[^\]]*\]"),
         }
         self._regex = {k: re.compile(v) for k, v in self._regex.items()}
         self._srs_regex = {
@@ -55,20 +94,35 @@ class MaillogParser:
         self._srs_regex = {
             k: re.compile(v, re.IGNORECASE) for k, v in self._srs_regex.items()
         }
+        # Program name -> handler
+        self._handlers = {
+            "amavis": self._parse_amavis,
+            "postfix": self._parse_postfix,
+            "rmilter": self._parse_rmilter,
+        }
 
         self.greylist = greylist
         if greylist:
             self._dprint("[settings] greylisting enabled")
 
     def _load_domain_list(self):
-        """Load the list of allowed domains."""
-        for dom in admin_models.Domain.objects.all():
-            domname = str(dom.name)
-            self.domains += [domname]
-            # Also add alias domains
-            for alias in dom.domainalias_set.all():
-                aliasname = str(alias.name)
-                self.domains += [aliasname]
+        """Load the list of allowed domains (and alias domains).
+
+        Can be called again to take new or removed domains into account.
+        """
+        domains = set()
+        domain_ids = {}
+        for pk, name in admin_models.Domain.objects.values_list("pk", "name"):
+            domname = str(name)
+            domains.add(domname)
+            domain_ids[domname] = pk
+        qset = admin_models.DomainAlias.objects.values_list("name", "target_id")
+        for name, target_id in qset:
+            aliasname = str(name)
+            domains.add(aliasname)
+            domain_ids.setdefault(aliasname, target_id)
+        self.domains = domains
+        self.domain_ids = domain_ids
 
     def _dprint(self, msg):
         """Print a debug message if required.
@@ -103,16 +157,15 @@ class MaillogParser:
 
     def _store_current_date(self, match):
         """Transform and store parsed date."""
-        ho = match.group("hour")
-        mi = match.group("min")
-        se = match.group("sec")
-        mo = match.group("month")
-        da = match.group("day")
-        try:
-            ye = match.group("year")
-        except IndexError:
-            ye = self.year(mo)
-        self.cur_t = utils.date_to_timestamp([ye, mo, da, ho, mi, se])
+        minute = match.group("month", "day", "hour", "min")
+        if "year" in match.re.groupindex:
+            minute += (match.group("year"),)
+        if minute != self._minute:
+            mo, da, ho, mi = minute[:4]
+            ye = minute[4] if len(minute) > 4 else self.year(mo)
+            self._minute = minute
+            self._minute_ts = lib.date_to_timestamp([ye, mo, da, ho, mi, "0"])
+        self.orig_ts = self._minute_ts + int(match.group("sec"))
 
     def _parse_date(self, line):
         """Try to match a date inside :kw:`line` and to convert it to
@@ -159,6 +212,8 @@ class MaillogParser:
         :param str mail_address
         :return a str
         """
+        if mail_address[:3].upper() != "SRS":
+            return mail_address
         m = self._srs_regex["reverse_srs0"].match(mail_address)
         m = self._srs_regex["reverse_srs1"].match(mail_address) if m is None else m
 
@@ -166,19 +221,126 @@ class MaillogParser:
             return "%s@%s" % m.group(2, 1)
         return mail_address
 
-    def new_domain_event(self, domain, name, size=None):
-        """Take action about new event for domain."""
+    def is_supported_status(self, status):
+        """Tell if messages with the given delivery status are handled."""
+        return True
+
+    def new_domain_event(self, domain, name, value=1):
+        """Take action about new event for domain.
+
+        :param str domain: domain name (might be None or a non local one)
+        :param str name: event name (sent, recv, reject, size_sent...)
+        :param int value: value to add to the event counter
+        """
+        pass
+
+    def new_mailbox_event(self, address, name, value=1):
+        """Take action about new event for an address of a local domain.
+
+        :param str address: email address (sender or recipient)
+        :param str name: event name (sent, recv, size_sent or size_recv)
+        :param int value: value to add to the event counter
+        """
+        pass
+
+    def new_sketch_event(self, kind, item, domains):
+        """Take action about an occurrence of a frequent item candidate.
+
+        :param str kind: kind of item (see constants.SKETCH_KINDS)
+        :param str item: the item (address, client domain...)
+        :param list domains: local domains the occurrence relates to
+        """
         pass
 
     def new_message_processed(
-        self, queue_id, msg_status, from_domain, to_domain, msg_to, msg_orig_to
+        self, queue_id, message, msg_status, from_domain, to_domain, msg_to, msg_orig_to
     ):
-        """Store new message in local database."""
+        """Store new message in local database.
+
+        :param str queue_id: queue id of the message
+        :param message: a PendingMessage instance (sender and size)
+        """
         pass
 
+    def _parse_amavis(self, log, host, pid, subprog):
+        """Parse an Amavis log entry.
+
+        :param str log: logged message
+        :param str host: hostname
+        :param str pid: process ID
+        :return: True on success
+        """
+        if " -> " not in log:
+            return False
+        m = self._regex["amavis"].search(log)
+        if m is not None:
+            dom = m.group("domain")
+            spam_result = m.group("result")
+            if dom is not None and dom in self.domains:
+                if spam_result == "INFECTED":
+                    self.new_domain_event(dom, "virus")
+                elif spam_result in ["SPAM", "SPAMMY"]:
+                    self.new_domain_event(dom, "spam")
+                return True
+
+        return False
+
+    def _parse_rmilter(self, log, host, pid, subprog):
+        """Parse an Rmilter log entry.
+
+        :param str log: logged message
+        :param str host: hostname
+        :param str pid: process ID
+        :return: True on success
+        """
+        if not log.startswith("<"):
+            return False
+        m = self._regex["rmilter_line"].match(log)
+        if m is None:
+            return False
+        rmilter_hash, msg = m.groups()
+        workdict_key = "rmilter_" + rmilter_hash
+
+        if msg.startswith("mlfi_eom:"):
+            # Virus check must come before spam check due to pattern
+            # similarity.
+            m = self._regex["rmilter_virus"].match(msg)
+            if m is not None:
+                self.workdict.add(workdict_key, self.orig_ts, action="virus")
+                return True
+            m = self._regex["rmilter_spam"].match(msg)
+            if m is not None:
+                self.workdict.add(workdict_key, self.orig_ts, action="spam")
+                return True
+
+        # Greylisting
+        if self.greylist and "GREYLIST(" in msg:
+            m = self._regex["rmilter_greylist"].search(msg)
+            if m is not None:
+                self.workdict.add(workdict_key, self.orig_ts, action="greylist")
+                return True
+
+        # Gather information about message sender and queue ID
+        if not msg.startswith("msg done:"):
+            return False
+        m = self._regex["rmilter_msg_done"].match(msg)
+        if m is not None:
+            dom = split_mailbox(m.group("rcpt"))[1]
+
+            # Nothing else will be logged for this message
+            message = self.workdict.pop(workdict_key)
+            if message is not None and message.action is not None:
+                self.new_domain_event(dom, message.action)
+            return True
+
+        return False
+
     def _parse_postfix(self, log, host, pid, subprog):
         """Parse a log entry generated by Postfix.
 
+        Substrings are checked before regular expressions are used
+        since most lines do not match them.
+
         :param str log: logged message
         :param str host: hostname
         :param str pid: process ID
@@ -192,65 +354,109 @@ class MaillogParser:
 
         # Handle rejected mails.
         if queue_id == "NOQUEUE":
-            m = self._regex["reject"].match(msg)
+            m = None
+            if msg.startswith("reject: "):
+                m = self._regex["reject"].match(msg)
             dom = m.group(1) if m is not None else None
             if dom in self.domains:
                 condition = self.greylist and (
                     "Greylisted" in msg or (subprog == "postscreen" and " 450 " in msg)
                 )
                 self.new_domain_event(dom, "greylist" if condition else "reject")
+                if not condition:
+                    m = self._regex["client"].search(msg)
+                    if m is not None:
+                        self.new_sketch_event(
+                            "rejected_clients", get_client_domain(*m.groups()), [dom]
+                        )
             return True
 
-        # Message acknowledged.
-        m = self._regex["message-id"].search(msg)
-        if m is not None:
-            self.workdict[queue_id] = {"from": m.group(1), "size": 0}
+        # Message removed from the queue, nothing else will be logged.
+        if msg == "removed":
+            self.workdict.pop(queue_id)
             return True
 
+        # Message acknowledged.
+        if "message-id=<" in msg:
+            m = self._regex["message-id"].search(msg)
+            if m is not None:
+                self.workdict.add(queue_id, self.orig_ts, sender=m.group(1))
+                return True
+
         # Message enqueued.
-        m = self._regex["from+size"].search(msg)
-        if m is not None:
-            self.workdict[queue_id] = {
-                "from": self.reverse_srs(m.group(1)),
-                "size": int(m.group(2)),
-            }
-            return True
+        if ", size=" in msg:
+            m = self._regex["from+size"].search(msg)
+            if m is not None:
+                self.workdict.add(
+                    queue_id,
+                    self.orig_ts,
+                    sender=self.reverse_srs(m.group(1)),
+                    size=int(m.group(2)),
+                )
+                return True
 
         # Message disposition.
+        if "status=" not in msg:
+            return False
         m = self._regex["to+status"].search(msg)
         if m is None:
             return False
-        (msg_to, msg_status) = m.groups()
-        if queue_id not in self.workdict:
+        msg_to, msg_status = m.groups()
+        message = self.workdict.get(queue_id, self.orig_ts)
+        if message is None:
             self._dprint(
                 "[parser] inconsistent mail (%s: %s), skipping" % (queue_id, msg_to)
             )
             return True
+        if not self.is_supported_status(msg_status):
+            self._dprint("[parser] unsupported status %s, skipping" % msg_status)
+            return True
 
         # orig_to is optional.
-        m = self._regex["orig_to"].search(msg)
-        msg_orig_to = m.group(1) if m is not None else None
+        msg_orig_to = None
+        if "orig_to=<" in msg:
+            m = self._regex["orig_to"].search(msg)
+            msg_orig_to = m.group(1) if m is not None else None
 
         # Handle local "from" domains.
-        from_domain = split_mailbox(self.workdict[queue_id]["from"])[1]
+        from_domain = split_mailbox(message.sender)[1]
         if from_domain is not None and from_domain in self.domains:
-            self.new_domain_event(from_domain, "sent", self.workdict[queue_id]["size"])
+            self.new_domain_event(from_domain, "sent")
+            self.new_domain_event(from_domain, "size_sent", message.size)
+            self.new_mailbox_event(message.sender, "sent")
+            self.new_mailbox_event(message.sender, "size_sent", message.size)
 
         # Handle local "to" domains.
         to_domain = None
+        to_address = msg_to
         condition = msg_orig_to is not None and not self.is_srs_forward(msg_orig_to)
         if condition:
             to_domain = split_mailbox(msg_orig_to)[1]
+            to_address = msg_orig_to
         if to_domain is None:
             to_domain = split_mailbox(msg_to)[1]
+            to_address = msg_to
+
+        if msg_status == "sent":
+            self.new_domain_event(to_domain, "recv")
+            self.new_domain_event(to_domain, "size_recv", message.size)
+            if to_domain in self.domains:
+                self.new_mailbox_event(to_address, "recv")
+                self.new_mailbox_event(to_address, "size_recv", message.size)
+        else:
+            self.new_domain_event(to_domain, msg_status)
 
+        local_domains = sorted({from_domain, to_domain} & self.domains)
+        sender = (message.sender or "").lower() or "<>"
         if msg_status == "sent":
-            msg_status = "recv"
-        self.new_domain_event(to_domain, "recv", self.workdict[queue_id]["size"])
+            self.new_sketch_event("senders", sender, local_domains)
+            self.new_sketch_event("recipients", to_address.lower(), local_domains)
+        elif msg_status == "bounced":
+            self.new_sketch_event("bounce_sources", sender, local_domains)
 
         # Store log entry
         self.new_message_processed(
-            queue_id, msg_status, from_domain, to_domain, msg_to, msg_orig_to
+            queue_id, message, msg_status, from_domain, to_domain, msg_to, msg_orig_to
         )
 
         return True
@@ -260,30 +466,31 @@ class MaillogParser:
 
         :param str line: log line
         """
+        self.lines += 1
         line = self._parse_date(line)
         if line is None:
             return
+        if self.skip_before is not None and self.orig_ts < self.skip_before:
+            return
         m = self._regex["line"].match(line)
         if not m:
             return
         host, prog, subprog, pid, log = m.groups()
 
-        try:
-            parser = getattr(self, "_parse_{}".format(prog))
-            if not parser(log, host, pid, subprog):
-                self._dprint("[parser] ignoring %r log: %r" % (prog, log))
-        except AttributeError:
-            self._dprint('[parser] no log handler for "%r": %r'.format(prog, log))
+        handler = self._handlers.get(prog)
+        if handler is None:
+            self._dprint('[parser] no log handler for "{}": {}'.format(prog, log))
+        elif not handler(log, host, pid, subprog):
+            self._dprint("[parser] ignoring %r log: %r" % (prog, log))
 
     def parse(self, logfile):
-        """Process the log file."""
+        """Process the log file (possibly compressed), line by line."""
         try:
-            fp = io.open(logfile, encoding="utf-8")
+            fp = open_logfile(logfile)
         except IOError as errno:
             self._dprint("%s" % errno)
             return
 
-        for line in fp.readlines():
-            self._parse_line(line)
-
-        fp.close()
+        with fp:
+            for line in fp:
+                self._parse_line(line.decode("utf-8", errors="ignore"))
@@ -0,0 +1,100 @@
+"""Messages being processed by the mail system.
+
+Log parsers need to remember a few attributes (sender, size...) of a
+message between the moment it is queued and the moment it is
+delivered. Since the end of a message is not always logged (lost
+lines, log rotation...), the number of messages kept is bounded: least
+recently seen ones are evicted when they have not been seen for too
+long or when there are too many of them.
+"""
+
+from collections import OrderedDict
+
+# Postfix gives up delivering a message after 5 days by default
+# (maximal_queue_lifetime) and each attempt refreshes it
+DEFAULT_TTL = 6 * 24 * 3600
+DEFAULT_MAX_SIZE = 100000
+
+
+class PendingMessage:
+    """Attributes of a message being processed."""
+
+    __slots__ = ("sender", "size", "action", "timestamp")
+
+    def __init__(self, sender=None, size=0, action=None, timestamp=None):
+        """Constructor."""
+        self.sender = sender
+        self.size = size
+        self.action = action
+        self.timestamp = timestamp
+
+
+class PendingMessages:
+    """Pending messages indexed by queue id (or any other key).
+
+    Messages are kept in the order they were last seen so the oldest
+    ones are the first to be evicted. Timestamps are the ones found in
+    logs, not the current time.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        """Constructor.
+
+        :param int max_size: maximum number of messages to keep
+        :param int ttl: delay (in seconds) after which a message that
+                        has not been seen is evicted
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.messages = OrderedDict()
+        # Number of messages evicted because they were too old
+        self.expired = 0
+        # Number of messages evicted because there were too many
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __contains__(self, key):
+        return key in self.messages
+
+    def add(self, key, timestamp, sender=None, size=0, action=None):
+        """Add (or replace) a message."""
+        self.messages[key] = PendingMessage(sender, size, action, timestamp)
+        self.messages.move_to_end(key)
+        if timestamp is not None:
+            self.expire(timestamp)
+        while len(self.messages) > self.max_size:
+            self.messages.popitem(last=False)
+            self.dropped += 1
+
+    def get(self, key, timestamp=None):
+        """Return a message (or None) and mark it as recently seen."""
+        message = self.messages.get(key)
+        if message is None:
+            return None
+        self.messages.move_to_end(key)
+        if timestamp is not None and (
+            message.timestamp is None or timestamp > message.timestamp
+        ):
+            message.timestamp = timestamp
+        return message
+
+    def pop(self, key):
+        """Remove a message and return it (or None)."""
+        return self.messages.pop(key, None)
+
+    def expire(self, timestamp):
+        """Evict messages not seen since timestamp - ttl."""
+        limit = timestamp - self.ttl
+        while self.messages:
+            message = next(iter(self.messages.values()))
+            if message.timestamp is None or message.timestamp >= limit:
+                break
+            self.messages.popitem(last=False)
+            self.expired += 1
+
+    @property
+    def evicted(self):
+        """Total number of evicted messages."""
+        return self.expired + self.dropped
@@ -0,0 +1,165 @@
+"""Maillog retention.
+
+Old records are removed in small chunks, each one in its own
+transaction, so the table is never locked for long and the amount of
+data written at once stays bounded.
+
+On PostgreSQL, the table can also be declared as partitioned by range
+of ``date`` (one partition per month): expired partitions are then
+detached and dropped, which is much cheaper than deleting their rows.
+"""
+
+import datetime
+import re
+import time
+
+from django.db import connection
+from django.utils import dateparse, timezone
+
+from . import models
+
+DEFAULT_CHUNK_SIZE = 5000
+
+PARTITION_BOUNDS_REGEX = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def parse_bound(value):
+    """Convert a partition bound to an aware datetime (or None)."""
+    date = dateparse.parse_datetime(value)
+    if date is None:
+        day = dateparse.parse_date(value)
+        if day is None:
+            return None
+        date = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, datetime.timezone.utc)
+    return date
+
+
+def is_partitioned():
+    """Check if the maillog table is partitioned (PostgreSQL only)."""
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table pt "
+            "JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = %s AND pg_table_is_visible(c.oid)",
+            [models.Maillog._meta.db_table],
+        )
+        return cursor.fetchone() is not None
+
+
+def get_partitions():
+    """Return the (name, start, end) partitions of the maillog table.
+
+    Default partitions and partitions using MINVALUE or MAXVALUE bounds
+    are ignored.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s AND pg_table_is_visible(p.oid) "
+            "ORDER BY c.relname",
+            [models.Maillog._meta.db_table],
+        )
+        rows = cursor.fetchall()
+    result = []
+    for name, bounds in rows:
+        match = PARTITION_BOUNDS_REGEX.search(bounds or "")
+        if not match:
+            continue
+        start, end = parse_bound(match.group(1)), parse_bound(match.group(2))
+        if start is None or end is None:
+            continue
+        result.append((name, start, end))
+    return result
+
+
+def drop_partitions(limit):
+    """Drop partitions only containing records older than limit.
+
+    Return the names of dropped partitions.
+    """
+    table = connection.ops.quote_name(models.Maillog._meta.db_table)
+    dropped = []
+    for name, start, end in get_partitions():
+        if end > limit:
+            continue
+        partition = connection.ops.quote_name(name)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "ALTER TABLE {} DETACH PARTITION {}".format(table, partition)
+            )
+            cursor.execute("DROP TABLE {}".format(partition))
+        dropped.append(name)
+    return dropped
+
+
+def month_start(date):
+    """Return the first day of the month of date."""
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(date):
+    """Return the first day of the month following date."""
+    date = month_start(date)
+    return (date + datetime.timedelta(days=32)).replace(day=1)
+
+
+def create_partitions(date, count=2):
+    """Create missing monthly partitions, starting at the month after date.
+
+    The current month is skipped: its records may already be stored in
+    the default partition, which would prevent the creation.
+
+    Return the names of created partitions.
+    """
+    table = models.Maillog._meta.db_table
+    existing = [(start, end) for name, start, end in get_partitions()]
+    created = []
+    start = next_month(date.astimezone(datetime.timezone.utc))
+    for _i in range(count):
+        end = next_month(start)
+        overlap = [
+            bounds for bounds in existing if bounds[0] < end and bounds[1] > start
+        ]
+        if not overlap:
+            name = "{}_y{}m{:02d}".format(table, start.year, start.month)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "CREATE TABLE {} PARTITION OF {} "
+                    "FOR VALUES FROM (%s) TO (%s)".format(
+                        connection.ops.quote_name(name),
+                        connection.ops.quote_name(table),
+                    ),
+                    [start, end],
+                )
+            created.append(name)
+        start = end
+    return created
+
+
+def delete_old_records(limit, chunk_size=DEFAULT_CHUNK_SIZE, pause=0):
+    """Delete records older than limit, chunk_size rows at a time.
+
+    Each chunk is deleted in its own transaction. pause is a delay (in
+    seconds) to wait between two chunks.
+
+    Return the number of deleted records.
+    """
+    qset = models.Maillog.objects.filter(date__lt=limit)
+    total = 0
+    while True:
+        pks = list(qset.order_by("date").values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            break
+        total += models.Maillog.objects.filter(pk__in=pks).delete()[0]
+        if len(pks) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return total
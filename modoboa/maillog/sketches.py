@@ -0,0 +1,244 @@
+"""Heavy hitters.
+
+The most frequent senders, recipients, rejected clients and bounce
+sources are tracked by the log parser using Space-Saving sketches: a
+sketch keeps at most ``capacity`` items, so memory is bounded whatever
+the number of distinct items. Frequent items are always kept, and each
+count is over-estimated by at most its ``error``.
+
+Sketches are computed per time window (see ``get_window``), for every
+local domain involved and globally. They are mergeable, so partial
+windows written by successive flushes (or computed by parallel
+parsers) can be combined, as well as windows to cover a longer period.
+"""
+
+import heapq
+import ipaddress
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from . import models
+from .stores import to_timestamp
+
+# Number of items kept by a sketch
+DEFAULT_CAPACITY = 100
+# Duration of a window (in seconds)
+DEFAULT_WINDOW = 3600
+
+
+def get_capacity():
+    """Return the number of items kept by a sketch."""
+    return getattr(settings, "MAILLOG_SKETCH_CAPACITY", DEFAULT_CAPACITY)
+
+
+def get_window_size():
+    """Return the duration of a window."""
+    return getattr(settings, "MAILLOG_SKETCH_WINDOW", DEFAULT_WINDOW)
+
+
+def get_window(timestamp):
+    """Return the start of the window containing timestamp."""
+    return timestamp - timestamp % get_window_size()
+
+
+def get_client_domain(hostname, address):
+    """Return the domain of a SMTP client.
+
+    The first label of the host name is removed (``mx1.example.com``
+    becomes ``example.com``). The address is used when the host name is
+    not known.
+    """
+    if not hostname or hostname == "unknown":
+        return address
+    try:
+        ipaddress.ip_address(hostname.strip("[]"))
+    except ValueError:
+        pass
+    else:
+        return hostname.strip("[]")
+    labels = hostname.lower().rstrip(".").split(".")
+    if len(labels) > 2:
+        labels = labels[1:]
+    return ".".join(labels)
+
+
+class SpaceSaving:
+    """Space-Saving sketch.
+
+    See "Efficient Computation of Frequent and Top-k Elements in Data
+    Streams" (Metwally, Agrawal and El Abbadi).
+    """
+
+    def __init__(self, capacity=None, items=None):
+        """Constructor.
+
+        :param int capacity: maximum number of items kept
+        :param list items: initial [item, count, error] entries
+        """
+        self.capacity = capacity or get_capacity()
+        # item -> [count, error]
+        self.counters = {}
+        # One (count, item) entry per item, count might be outdated
+        # (lower than the actual one)
+        self._heap = []
+        for item, count, error in items or []:
+            self.counters[item] = [count, error]
+        self._truncate()
+
+    def __len__(self):
+        return len(self.counters)
+
+    def _truncate(self):
+        """Only keep the items with the highest counts."""
+        if len(self.counters) > self.capacity:
+            kept = heapq.nlargest(
+                self.capacity, self.counters.items(), key=lambda item: item[1][0]
+            )
+            self.counters = dict(kept)
+        self._heap = [(counter[0], item) for item, counter in self.counters.items()]
+        heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        """Remove the item with the lowest count and return its count."""
+        while True:
+            count, item = heapq.heappop(self._heap)
+            counter = self.counters[item]
+            if counter[0] == count:
+                del self.counters[item]
+                return count
+            heapq.heappush(self._heap, (counter[0], item))
+
+    def add(self, item, weight=1):
+        """Count an occurrence of item."""
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+            return
+        error = 0
+        if len(self.counters) >= self.capacity:
+            # The new item replaces the least frequent one
+            error = self._pop_min()
+        self.counters[item] = [error + weight, error]
+        heapq.heappush(self._heap, (error + weight, item))
+
+    def get_minimum(self):
+        """Return the count of an item which is not tracked."""
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(counter[0] for counter in self.counters.values())
+
+    def merge(self, other):
+        """Add the items of another sketch.
+
+        Items tracked by only one sketch might have been counted by the
+        other one up to its minimum count.
+        """
+        minimum, other_minimum = self.get_minimum(), other.get_minimum()
+        for item, counter in self.counters.items():
+            if item not in other.counters:
+                counter[0] += other_minimum
+                counter[1] += other_minimum
+        for item, (count, error) in other.counters.items():
+            counter = self.counters.get(item)
+            if counter is None:
+                self.counters[item] = [count + minimum, error + minimum]
+            else:
+                counter[0] += count
+                counter[1] += error
+        self._truncate()
+
+    def top(self, limit=10):
+        """Return the most frequent items as [item, count, error] lists."""
+        entries = heapq.nlargest(
+            limit, self.counters.items(), key=lambda item: (item[1][0], item[0])
+        )
+        return [[item, count, error] for item, (count, error) in entries]
+
+    def to_list(self):
+        """Return every item (see top)."""
+        return self.top(len(self.counters))
+
+
+def merge_recorded_sketches(sketches, windows):
+    """Merge sketches with the recorded ones, which are locked.
+
+    :return: the Sketch instances to create and the ones to update
+    """
+    qset = models.Sketch.objects.select_for_update().filter(timestamp__in=windows)
+    existing = {(sketch.timestamp, sketch.name, sketch.kind): sketch for sketch in qset}
+    to_create = []
+    to_update = []
+    for key, sketch in sketches.items():
+        record = existing.get(key)
+        if record is None:
+            to_create.append(
+                models.Sketch(
+                    timestamp=key[0],
+                    name=key[1],
+                    kind=key[2],
+                    items=sketch.to_list(),
+                )
+            )
+            continue
+        merged = SpaceSaving(sketch.capacity, record.items)
+        merged.merge(sketch)
+        record.items = merged.to_list()
+        to_update.append(record)
+    return to_create, to_update
+
+
+def save_sketches(sketches):
+    """Merge sketches with the recorded ones.
+
+    :param dict sketches: SpaceSaving instances indexed by
+                          (window, name, kind) tuples
+    """
+    if not sketches:
+        return
+    windows = {window for window, name, kind in sketches}
+    with transaction.atomic():
+        while True:
+            to_create, to_update = merge_recorded_sketches(sketches, windows)
+            try:
+                with transaction.atomic():
+                    models.Sketch.objects.bulk_create(to_create)
+            except IntegrityError:
+                # Windows created by another parser in the meantime
+                # (select_for_update does not lock missing rows)
+                continue
+            break
+        models.Sketch.objects.bulk_update(to_update, ["items"])
+
+
+def get_top(name, kind, start, end, limit=10):
+    """Return the most frequent items of a period.
+
+    Windows overlapping the period are merged.
+
+    :param start: a timestamp or a relative time (see to_timestamp)
+    :return: a list of [item, count, error] lists
+    """
+    end = int(end)
+    start = to_timestamp(start, end)
+    qset = models.Sketch.objects.filter(
+        name=name, kind=kind, timestamp__gte=get_window(start), timestamp__lt=end
+    ).order_by("timestamp")
+    result = None
+    for record in qset.iterator():
+        sketch = SpaceSaving(items=record.items)
+        if result is None:
+            result = sketch
+        else:
+            result.merge(sketch)
+    if result is None:
+        return []
+    return result.top(limit)
+
+
+def delete_old_sketches(limit):
+    """Delete the sketches of windows started before limit (a timestamp).
+
+    Return the number of deleted sketches.
+    """
+    return models.Sketch.objects.filter(timestamp__lt=limit).delete()[0]
@@ -0,0 +1,103 @@
+"""Statistics stores.
+
+A store records the counters computed by the log parser (one set of
+counters per domain, plus a global one, every minute) and exports them
+as series of rates to draw graphics.
+"""
+
+from importlib import import_module
+import re
+
+from modoboa.parameters import tools as param_tools
+
+RELATIVE_TIME_REGEX = re.compile(r"^-(\d+)(day|week|month|year)$")
+RELATIVE_TIME_UNITS = {
+    "day": 24 * 3600,
+    "week": 7 * 24 * 3600,
+    "month": 31 * 24 * 3600,
+    "year": 366 * 24 * 3600,
+}
+
+
+def to_timestamp(value, end):
+    """Convert a time specification to a timestamp.
+
+    :param value: a timestamp or a relative time like ``-1day``
+    :param int end: the timestamp relative times refer to
+    """
+    match = RELATIVE_TIME_REGEX.match(str(value))
+    if match is None:
+        return int(value)
+    return int(end) - int(match.group(1)) * RELATIVE_TIME_UNITS[match.group(2)]
+
+
+class StatisticsStore:
+    """Base class of every statistics store."""
+
+    # Can series be exported from several threads at the same time?
+    concurrent_exports = False
+
+    def __init__(self, workdir=None, rrdcached=None, debug=False, verbose=False):
+        """Constructor.
+
+        :param str workdir: directory where files are stored
+        :param str rrdcached: address of a rrdcached daemon
+        """
+        self.workdir = workdir
+        self.rrdcached = rrdcached
+        self.debug = debug
+        self.verbose = verbose
+
+    def _dprint(self, msg):
+        if self.debug:
+            print(msg)
+
+    def update(self, name, points):
+        """Record counters.
+
+        :param str name: domain name (or global)
+        :param dict points: counters ({variable: value}) indexed by
+                            timestamps (start of each minute)
+        :return: the number of records written
+        """
+        raise NotImplementedError
+
+    def export(self, name, curves, start, end):
+        """Export series.
+
+        :param str name: domain name (or global)
+        :param list curves: list of Curve instances
+        :param start: start of the period (timestamp or relative time)
+        :param int end: end of the period (timestamp)
+        :return: a list of (timestamp, [value of each curve]) tuples
+        """
+        raise NotImplementedError
+
+
+def get_store_class(name):
+    """Return class for given store."""
+    store_module = import_module("modoboa.maillog.stores.{}".format(name))
+    try:
+        store_class = getattr(store_module, "{}Store".format(name.upper()))
+    except AttributeError:
+        return None
+    else:
+        return store_class
+
+
+def get_active_store(**kwargs):
+    """Return the store selected in global parameters."""
+    name = param_tools.get_global_parameter(
+        "statistics_backend", app="maillog", raise_exception=False
+    )
+    if not name:
+        name = "rrd"
+    if "workdir" not in kwargs:
+        kwargs["workdir"] = param_tools.get_global_parameter(
+            "rrd_rootdir", app="maillog"
+        )
+    if "rrdcached" not in kwargs:
+        kwargs["rrdcached"] = param_tools.get_global_parameter(
+            "rrdcached_address", app="maillog", raise_exception=False
+        )
+    return get_store_class(name)(**kwargs)
@@ -0,0 +1,220 @@
+"""RRD statistics store.
+
+One RRD file per domain is stored in the RRD directory. Exports are
+cached until the file is modified.
+"""
+
+import hashlib
+import os
+import re
+
+import rrdtool
+
+from django.core.cache import cache
+
+from . import RELATIVE_TIME_REGEX, StatisticsStore, to_timestamp
+
+rrdstep = 60
+# Maximum number of seconds between two updates before a value is
+# considered as unknown
+heartbeat = rrdstep * 2
+xpoints = 540
+points_per_sample = 3
+# Lifetime of cached exports (keys change when files are modified)
+CACHE_TIMEOUT = 24 * 3600
+
+
+class RRDStore(StatisticsStore):
+    """Store counters in RRD files."""
+
+    concurrent_exports = True
+
+    def __init__(self, *args, **kwargs):
+        """Constructor."""
+        super().__init__(*args, **kwargs)
+        # Timestamp of the last update of each file
+        self.lupdates = {}
+
+    def get_file_path(self, name):
+        """Return the path of the RRD file of name."""
+        return "%s/%s.rrd" % (self.workdir, name)
+
+    def init_rrd(self, fname, m, variables):
+        """init_rrd.
+
+        Set-up Data Sources (DS)
+        Set-up Round Robin Archives (RRA):
+        - day,week,month and year archives
+        - 2 types : AVERAGE and MAX
+
+        parameter : start time
+        return    : last epoch recorded
+        """
+        ds_type = "ABSOLUTE"
+        rows = xpoints / points_per_sample
+        realrows = int(rows * 1.1)  # ensure that the full range is covered
+        day_steps = int(3600 * 24 / (rrdstep * rows))
+        week_steps = day_steps * 7
+        month_steps = week_steps * 5
+        year_steps = month_steps * 12
+
+        # Set up data sources for our RRD
+        params = []
+        for v in variables:
+            params += ["DS:%s:%s:%s:0:U" % (v, ds_type, heartbeat)]
+
+        # Set up RRD to archive data
+        for cf in ["AVERAGE", "MAX"]:
+            for step in [day_steps, week_steps, month_steps, year_steps]:
+                params += ["RRA:%s:0.5:%s:%s" % (cf, step, realrows)]
+
+        # With those setup, we can now created the RRD
+        rrdtool.create(str(fname), "--start", str(m), "--step", str(rrdstep), *params)
+        return m
+
+    def add_datasource_to_rrd(self, fname, dsname):
+        """Add a new data source to an exisitng file.
+
+        Add missing Data Sources (DS) to existing Round Robin Archive (RRA):
+        See init_rrd for details.
+        """
+        ds_def = "DS:%s:ABSOLUTE:%s:0:U" % (dsname, heartbeat)
+        if self.rrdcached:
+            # Make sure pending updates are written before the file changes
+            rrdtool.flushcached("--daemon", self.rrdcached, fname)
+        rrdtool.tune(fname, ds_def)
+        self._dprint("[rrd] added DS %s to %s" % (dsname, fname))
+
+    def get_daemon_args(self):
+        """Return the arguments to use rrdcached (if configured)."""
+        if not self.rrdcached:
+            return []
+        return ["--daemon", self.rrdcached]
+
+    def add_points_to_rrd(self, fname, tpl, values):
+        """Try to add new points to RRD file (using a single update)."""
+        if self.verbose:
+            print("[rrd] VERBOSE update -t %s %s" % (tpl, " ".join(values)))
+        args = self.get_daemon_args() + ["-t", tpl] + values
+        try:
+            rrdtool.update(str(fname), *args)
+        except rrdtool.OperationalError as e:
+            op_match = re.match(r"unknown DS name '(\w+)'", str(e))
+            if op_match is None:
+                raise
+            self.add_datasource_to_rrd(str(fname), op_match.group(1))
+            rrdtool.update(str(fname), *args)
+
+    def update(self, name, points):
+        """Update RRD with the given points, using a single update.
+
+        Events already recorded in the RRD file are ignored.
+        """
+        fname = self.get_file_path(name)
+        times = sorted(points)
+        if not times:
+            return 0
+        variables = list(points[times[0]])
+
+        self._dprint("[rrd] updating %s" % fname)
+        if not os.path.exists(fname):
+            self.lupdates[fname] = self.init_rrd(fname, times[0] - rrdstep, variables)
+            self._dprint("[rrd] create new RRD file %s" % fname)
+        else:
+            if fname not in self.lupdates:
+                self.lupdates[fname] = rrdtool.last(str(fname), *self.get_daemon_args())
+
+        tpl = ":".join(variables)
+        zeros = ":".join("0" for v in variables)
+        last = self.lupdates[fname]
+        values = []
+        for m in times:
+            if m <= last:
+                if self.verbose:
+                    print("[rrd] VERBOSE events at %s already recorded in RRD" % m)
+                continue
+            if m > last + rrdstep:
+                # Nothing happened since the last update. The longer the
+                # interval between two updates, the less points we need
+                # to write, but it must not exceed the heartbeat or the
+                # period would be unknown instead of empty. The last
+                # one must end right before m so events at m are not
+                # spread over the whole gap.
+                values += [
+                    "%s:%s" % (p, zeros)
+                    for p in range(last + heartbeat, m - rrdstep, heartbeat)
+                ]
+                values.append("%s:%s" % (m - rrdstep, zeros))
+            values.append("%s:%s" % (m, ":".join(str(points[m][v]) for v in variables)))
+            last = m
+        if not values:
+            return 0
+        self.add_points_to_rrd(fname, tpl, values)
+        self.lupdates[fname] = last
+        return len(values)
+
+    def get_curve_args(self, name, curve):
+        """Convert a curve to the approriate RRDtool xport arguments."""
+        rrdfile = self.get_file_path(name)
+        return [
+            "DEF:%s=%s:%s:%s" % (curve.dsname, rrdfile, curve.dsname, curve.cfunc),
+            "CDEF:%(ds)spm=%(ds)s,UN,0,%(ds)s,IF,60,*" % {"ds": curve.dsname},
+            "XPORT:%spm" % curve.dsname,
+        ]
+
+    def get_cache_key(self, name, curves, start, end):
+        """Return the cache key of an export (None if file is missing).
+
+        Keys include the modification time of the file, so they change
+        as soon as new points are written.
+        """
+        fname = self.get_file_path(name)
+        if self.rrdcached:
+            # Pending updates must be written before checking the file
+            try:
+                rrdtool.flushcached("--daemon", self.rrdcached, fname)
+            except rrdtool.OperationalError:
+                return None
+        try:
+            mtime = os.stat(fname).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        signature = ",".join(
+            "{}:{}".format(curve.dsname, curve.cfunc) for curve in curves
+        )
+        key = "{}|{}|{}|{}|{}".format(fname, start, end, signature, mtime)
+        return "maillog:rrd:{}".format(hashlib.sha1(key.encode()).hexdigest())
+
+    def export(self, name, curves, start, end):
+        """Export data using rrdtool (results are cached)."""
+        end = int(end)
+        if RELATIVE_TIME_REGEX.match(str(start)):
+            # Consolidated rows of the archive used to draw the period
+            # do not change more often than this
+            resolution = max(
+                (end - to_timestamp(start, end)) // int(xpoints / points_per_sample),
+                rrdstep,
+            )
+            end -= end % resolution
+        key = self.get_cache_key(name, curves, start, end)
+        if key is None:
+            return []
+        result = cache.get(key)
+        if result is not None:
+            return result
+        args = ["--start", str(start), "--end", str(end)]
+        if self.rrdcached:
+            args += ["--daemon", self.rrdcached]
+        for curve in curves:
+            args += self.get_curve_args(name, curve)
+        try:
+            xport = rrdtool.xport(*args)
+        except rrdtool.OperationalError:
+            return []
+        meta = xport["meta"]
+        result = [
+            (meta["start"] + (index + 1) * meta["step"], list(row))
+            for index, row in enumerate(xport["data"])
+        ]
+        cache.set(key, result, CACHE_TIMEOUT)
+        return result
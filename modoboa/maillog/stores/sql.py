@@ -0,0 +1,182 @@
+"""SQL statistics store.
+
+Counters are stored in the database, per minute, per hour and per
+day. Each update increments existing rows (or creates them) so several
+parsers can write at the same time, as long as they do not parse the
+same lines. Minute and hour rows are removed once they are too old to
+be displayed.
+"""
+
+import datetime
+import math
+import time
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import Mod, TruncHour
+from django.utils import timezone
+
+from modoboa.core import models as core_models
+
+from .. import models
+from . import StatisticsStore, to_timestamp
+
+COUNTERS = [
+    "sent",
+    "recv",
+    "bounced",
+    "reject",
+    "spam",
+    "virus",
+    "greylist",
+    "size_sent",
+    "size_recv",
+]
+
+# Maximum number of points of an exported series
+MAX_POINTS = 180
+
+MINUTE = 60
+HOUR = 3600
+DAY = 24 * 3600
+
+# (model, duration of a row, retention in seconds), from the finest to
+# the coarsest
+ROLLUPS = [
+    (models.MinuteStatistics, MINUTE, 2 * DAY),
+    (models.HourStatistics, HOUR, 62 * DAY),
+    (models.DayStatistics, DAY, None),
+]
+
+# Delay between two removals of old rows
+CLEANUP_INTERVAL = HOUR
+
+# Account creation series are computed from users
+ACCOUNTS = "new_accounts"
+
+
+def get_upsert_query(table, columns):
+    """Return a query inserting a row or adding values to an existing one."""
+    quote = connection.ops.quote_name
+    names = ", ".join(quote(column) for column in ["name", "timestamp"] + columns)
+    placeholders = ", ".join(["%s"] * (len(columns) + 2))
+    query = "INSERT INTO {} ({}) VALUES ({}) ".format(quote(table), names, placeholders)
+    if connection.vendor == "mysql":
+        query += "ON DUPLICATE KEY UPDATE " + ", ".join(
+            "{0} = {0} + VALUES({0})".format(quote(column)) for column in columns
+        )
+    else:
+        query += "ON CONFLICT ({}, {}) DO UPDATE SET ".format(
+            quote("name"), quote("timestamp")
+        ) + ", ".join(
+            "{0} = {1}.{0} + EXCLUDED.{0}".format(quote(column), quote(table))
+            for column in columns
+        )
+    return query
+
+
+class SQLStore(StatisticsStore):
+    """Store counters in database tables."""
+
+    def __init__(self, *args, **kwargs):
+        """Constructor."""
+        super().__init__(*args, **kwargs)
+        self.last_cleanup = 0
+
+    def update(self, name, points):
+        """Add points to minute, hour and day counters."""
+        if not points:
+            return 0
+        rows = 0
+        with transaction.atomic():
+            for model, duration, retention in ROLLUPS:
+                rollup = {}
+                for timestamp, counters in points.items():
+                    timestamp -= timestamp % duration
+                    values = rollup.setdefault(timestamp, [0] * len(COUNTERS))
+                    for index, column in enumerate(COUNTERS):
+                        values[index] += counters.get(column, 0)
+                query = get_upsert_query(model._meta.db_table, COUNTERS)
+                params = [
+                    [name, timestamp] + values
+                    for timestamp, values in sorted(rollup.items())
+                ]
+                with connection.cursor() as cursor:
+                    cursor.executemany(query, params)
+                rows += len(params)
+        self._dprint("[stats] %d rows updated for %s" % (rows, name))
+        self.cleanup()
+        return rows
+
+    def cleanup(self, now=None):
+        """Remove rows which are too old to be displayed."""
+        if now is None:
+            now = int(time.time())
+        if now - self.last_cleanup < CLEANUP_INTERVAL:
+            return
+        self.last_cleanup = now
+        for model, duration, retention in ROLLUPS:
+            if retention is not None:
+                model.objects.filter(timestamp__lt=now - retention).delete()
+
+    def get_rollup(self, start, end):
+        """Return the rollup and the step to use for the given period."""
+        span = max(end - start, MINUTE)
+        now = int(time.time())
+        for model, duration, retention in ROLLUPS:
+            if retention is None or start >= now - retention:
+                break
+        step = max(math.ceil(span / MAX_POINTS / duration), 1) * duration
+        return model, step
+
+    def export(self, name, curves, start, end):
+        """Export rates (per minute, per hour for accounts)."""
+        end = int(end)
+        start = to_timestamp(start, end)
+        model, step = self.get_rollup(start, end)
+        if name == ACCOUNTS:
+            step = math.ceil(step / HOUR) * HOUR
+        first = start - start % step
+        if name == ACCOUNTS:
+            totals = self.get_account_totals(first, end, step)
+            scale = HOUR / step
+        else:
+            dsnames = [curve.dsname for curve in curves]
+            qset = (
+                model.objects.filter(name=name, timestamp__gte=first, timestamp__lt=end)
+                .annotate(
+                    bucket=F("timestamp") - Mod("timestamp", Value(step)),
+                )
+                .values("bucket")
+                .annotate(**{"total_" + dsname: Sum(dsname) for dsname in dsnames})
+                .order_by("bucket")
+            )
+            totals = {
+                row["bucket"]: [float(row["total_" + dsname]) for dsname in dsnames]
+                for row in qset
+            }
+            scale = MINUTE / step
+        zeros = [0] * len(curves)
+        return [
+            (bucket, [value * scale for value in totals.get(bucket, zeros)])
+            for bucket in range(first, end, step)
+        ]
+
+    def get_account_totals(self, start, end, step):
+        """Return the number of accounts created per period."""
+        tz = timezone.get_current_timezone()
+        qset = (
+            core_models.User.objects.filter(
+                date_joined__gte=datetime.datetime.fromtimestamp(start, tz),
+                date_joined__lt=datetime.datetime.fromtimestamp(end, tz),
+            )
+            .annotate(hour=TruncHour("date_joined"))
+            .values("hour")
+            .annotate(count=Count("pk"))
+        )
+        totals = {}
+        for row in qset:
+            timestamp = int(row["hour"].timestamp())
+            bucket = timestamp - timestamp % step
+            totals[bucket] = [totals.get(bucket, [0])[0] + row["count"]]
+        return totals
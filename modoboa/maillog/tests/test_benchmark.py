@@ -0,0 +1,44 @@
+"""Tests of the log parser benchmark."""
+
+import os
+import shutil
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from modoboa.maillog import benchmark
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    """Test cases for the benchmark tool."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def test_generator(self):
+        lines = list(benchmark.LogGenerator(seed=1).lines(1000))
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines, list(benchmark.LogGenerator(seed=1).lines(1000)))
+        self.assertTrue(any(": removed\n" in line for line in lines))
+
+    def test_run(self):
+        generator = benchmark.LogGenerator(domains=5, users=20, seed=1)
+        path = os.path.join(self.workdir, "mail.log")
+        generator.write(path, 5000)
+        results = benchmark.run(path, generator.domains)
+        self.assertEqual(results["lines"], 5000)
+        self.assertGreater(results["messages"], 0)
+        self.assertGreater(results["events"]["recv"], 0)
+        self.assertGreater(results["events"]["greylist"], 0)
+        # Messages are freed once removed
+        self.assertLessEqual(results["pending"], 50)
+
+    def test_command(self):
+        out = StringIO()
+        call_command(
+            "logparser_benchmark", "--lines", "2000", "--seed", "1", stdout=out
+        )
+        self.assertIn("Lines: 2000 in", out.getvalue())
@@ -0,0 +1,94 @@
+"""Tests of log line sources."""
+
+import os
+import shutil
+import socket
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from modoboa.maillog import follow
+
+
+class FollowTestCase(SimpleTestCase):
+    """Log line sources."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def test_line_buffer(self):
+        buf = follow.LineBuffer()
+        self.assertEqual(buf.feed(b"line 1\nline"), [b"line 1\n"])
+        self.assertEqual(buf.feed(b" 2\n"), [b"line 2\n"])
+        self.assertEqual(buf.pending, b"")
+
+    def test_file_source(self):
+        path = os.path.join(self.workdir, "mail.log")
+        with open(path, "wb") as fp:
+            fp.write(b"line 1\nline 2\nline")
+        source = follow.FileSource(path, offset=7)
+        self.addCleanup(source.close)
+        self.assertEqual(source.read(0), [b"line 2\n"])
+        self.assertEqual(source.read(0), [])
+        with open(path, "ab") as fp:
+            fp.write(b" 3\n")
+        self.assertEqual(source.read(0), [b"line 3\n"])
+        self.assertEqual(source.offset, 21)
+
+        # Rotation
+        os.rename(path, path + ".1")
+        with open(path + ".1", "ab") as fp:
+            fp.write(b"line 4\n")
+        with open(path, "wb") as fp:
+            fp.write(b"line 5\n")
+        self.assertEqual(source.read(0), [b"line 4\n"])
+        self.assertEqual(source.read(0), [b"line 5\n"])
+        self.assertEqual(source.offset, 7)
+
+        # Truncation
+        with open(path, "wb") as fp:
+            fp.write(b"6\n")
+        self.assertEqual(source.read(0), [b"6\n"])
+
+    @mock.patch.object(follow, "READ_SIZE", 4)
+    def test_file_source_chunks(self):
+        path = os.path.join(self.workdir, "mail.log")
+        with open(path, "wb") as fp:
+            fp.write(b"line 1\nline 2\n")
+        source = follow.FileSource(path)
+        self.addCleanup(source.close)
+        self.assertEqual(source.read(0), [b"line 1\n"])
+        self.assertEqual(source.read(0), [b"line 2\n"])
+        self.assertEqual(source.read(0), [])
+        self.assertEqual(source.offset, 14)
+
+    def test_stream_source(self):
+        rfd, wfd = os.pipe()
+        with os.fdopen(rfd, "rb") as reader:
+            source = follow.StreamSource(reader)
+            self.assertEqual(source.read(0), [])
+            os.write(wfd, b"line 1\nline 2")
+            os.close(wfd)
+            self.assertEqual(source.read(0), [b"line 1\n"])
+            self.assertEqual(source.read(0), [b"line 2\n"])
+            with self.assertRaises(EOFError):
+                source.read(0)
+
+    def test_socket_source(self):
+        path = os.path.join(self.workdir, "logparser.sock")
+        source = follow.SocketSource(path)
+        self.assertEqual(source.read(0.01), [])
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"<22>Oct 17 08:00:00 mail postfix/smtp[1]: msg 1", path)
+            sock.sendto(b"Oct 17 08:00:01 mail postfix/smtp[1]: msg 2\n", path)
+        self.assertEqual(
+            source.read(1),
+            [
+                b"Oct 17 08:00:00 mail postfix/smtp[1]: msg 1\n",
+                b"Oct 17 08:00:01 mail postfix/smtp[1]: msg 2\n",
+            ],
+        )
+        source.close()
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,97 @@
+"""Tests of per mailbox counters."""
+
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from modoboa.maillog import mailboxes
+
+HOUR = mailboxes.HOUR
+# Start of an hour
+NOW = 1700002800
+
+
+class MailboxCountersTestCase(SimpleTestCase):
+    """Mailbox counters."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_add_and_read(self):
+        counters = mailboxes.MailboxCounters(self.workdir, slots=24)
+        counters.add(
+            {
+                ("user@test.com", NOW): {"sent": 2, "size_sent": 300},
+                ("admin@test.com", NOW): {"sent": 1, "recv": 4},
+                ("user@test.com", NOW - HOUR): {"sent": 1},
+            }
+        )
+        counters.add({("user@test.com", NOW): {"sent": 1}})
+        counters.close()
+
+        counters = mailboxes.MailboxCounters(self.workdir, slots=24, readonly=True)
+        hours, values = counters.get_usage("user@test.com", NOW - 2 * HOUR, NOW + 1)
+        self.assertEqual(hours, [NOW - 2 * HOUR, NOW - HOUR, NOW])
+        self.assertEqual(values["sent"], [0, 1, 3])
+        self.assertEqual(values["size_sent"], [0, 0, 300])
+        self.assertEqual(
+            counters.get_top("sent", "-1day", NOW + 1),
+            [("user@test.com", 4), ("admin@test.com", 1)],
+        )
+        self.assertEqual(
+            counters.get_top("sent", NOW, NOW + 1, limit=1),
+            [("user@test.com", 3)],
+        )
+        self.assertEqual(
+            counters.get_top("recv", NOW, NOW + 1, domains=["test2.com"]), []
+        )
+        counters.close()
+
+    def test_rotation(self):
+        counters = mailboxes.MailboxCounters(self.workdir, slots=3)
+        counters.add({("user@test.com", NOW): {"recv": 1}})
+        # Same slot, 3 hours later: previous values are dropped
+        counters.add({("user@test.com", NOW + 3 * HOUR): {"recv": 5}})
+        # Too old to be kept
+        counters.add({("user@test.com", NOW): {"recv": 1}})
+        hours, values = counters.get_usage("user@test.com", NOW, NOW + 4 * HOUR)
+        self.assertEqual(hours, [NOW + HOUR, NOW + 2 * HOUR, NOW + 3 * HOUR])
+        self.assertEqual(values["recv"], [0, 0, 5])
+        counters.close()
+
+    @mock.patch.object(mailboxes, "GROWTH", 2)
+    def test_growth(self):
+        counters = mailboxes.MailboxCounters(self.workdir, slots=2)
+        counters.add(
+            {("user{}@test.com".format(i), NOW): {"sent": i} for i in range(1, 6)}
+        )
+        counters.close()
+        counters = mailboxes.MailboxCounters(self.workdir, slots=2)
+        self.assertEqual(counters.capacity, 6)
+        self.assertEqual(
+            counters.get_top("sent", NOW, NOW + 1, limit=2),
+            [("user5@test.com", 5), ("user4@test.com", 4)],
+        )
+        counters.close()
+
+    def test_missing_files(self):
+        counters = mailboxes.MailboxCounters(self.workdir, readonly=True)
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, "mailboxes")))
+        self.assertEqual(counters.get_top("sent", "-1day", NOW), [])
+        hours, values = counters.get_usage("user@test.com", NOW - HOUR, NOW)
+        self.assertEqual(values["sent"], [0])
+
+    def test_slots_change(self):
+        counters = mailboxes.MailboxCounters(self.workdir, slots=2)
+        counters.add({("user@test.com", NOW): {"sent": 1}})
+        counters.close()
+        counters = mailboxes.MailboxCounters(self.workdir, slots=4)
+        self.assertEqual(counters.addresses, [])
+        self.assertEqual(counters.get_top("sent", NOW, NOW + 1), [])
+        counters.close()
@@ -0,0 +1,45 @@
+"""Tests of pending messages storage."""
+
+from django.test import SimpleTestCase
+
+from modoboa.maillog import pending
+
+
+class PendingMessagesTestCase(SimpleTestCase):
+    """Pending messages."""
+
+    def test_add_get_pop(self):
+        messages = pending.PendingMessages()
+        messages.add("A", 100, sender="user@test.com", size=10)
+        message = messages.get("A", 110)
+        self.assertEqual(message.sender, "user@test.com")
+        self.assertEqual(message.size, 10)
+        self.assertEqual(message.timestamp, 110)
+        self.assertIsNone(messages.get("B"))
+        self.assertIs(messages.pop("A"), message)
+        self.assertEqual(len(messages), 0)
+        self.assertIsNone(messages.pop("A"))
+
+    def test_expire(self):
+        messages = pending.PendingMessages(ttl=60)
+        messages.add("A", 100)
+        messages.add("B", 120)
+        # Seeing A again keeps it alive
+        messages.get("A", 150)
+        messages.add("C", 200)
+        self.assertNotIn("B", messages)
+        self.assertIn("A", messages)
+        self.assertEqual(messages.expired, 1)
+        messages.add("D", 300)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages.evicted, 3)
+
+    def test_max_size(self):
+        messages = pending.PendingMessages(max_size=2)
+        messages.add("A", 100)
+        messages.add("B", 101)
+        messages.get("A", 102)
+        messages.add("C", 103)
+        self.assertEqual(list(messages.messages), ["A", "C"])
+        self.assertEqual(messages.dropped, 1)
+        self.assertEqual(messages.expired, 0)
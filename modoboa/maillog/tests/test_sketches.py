@@ -0,0 +1,105 @@
+"""Tests of heavy hitters sketches."""
+
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from modoboa.maillog import models, sketches
+
+# Start of an hour
+NOW = 1700002800
+
+
+class SpaceSavingTestCase(SimpleTestCase):
+    """Space-Saving sketch."""
+
+    def test_exact_counts(self):
+        sketch = sketches.SpaceSaving(3)
+        for item in ["a", "b", "a", "c", "a", "b"]:
+            sketch.add(item)
+        self.assertEqual(sketch.top(2), [["a", 3, 0], ["b", 2, 0]])
+        self.assertEqual(sketch.get_minimum(), 1)
+
+    def test_bounded_memory(self):
+        sketch = sketches.SpaceSaving(10)
+        for i in range(1000):
+            sketch.add("frequent")
+            sketch.add("rare{}".format(i))
+        self.assertEqual(len(sketch), 10)
+        item, count, error = sketch.top(1)[0]
+        self.assertEqual(item, "frequent")
+        self.assertEqual(count - error, 1000)
+        # Counts are over-estimated by at most error
+        for item, count, error in sketch.to_list()[1:]:
+            self.assertGreaterEqual(count - error, 0)
+            self.assertLessEqual(count - error, 1)
+
+    def test_merge(self):
+        first = sketches.SpaceSaving(2, [["a", 5, 0], ["b", 3, 0]])
+        second = sketches.SpaceSaving(2)
+        for item in ["a", "c", "c"]:
+            second.add(item)
+        first.merge(second)
+        self.assertEqual(first.to_list(), [["a", 6, 0], ["c", 5, 3]])
+
+    def test_get_client_domain(self):
+        self.assertEqual(
+            sketches.get_client_domain("mx1.example.com", "192.0.2.1"), "example.com"
+        )
+        self.assertEqual(
+            sketches.get_client_domain("example.com", "192.0.2.1"), "example.com"
+        )
+        self.assertEqual(
+            sketches.get_client_domain("unknown", "192.0.2.1"), "192.0.2.1"
+        )
+        self.assertEqual(sketches.get_client_domain("", "192.0.2.1"), "192.0.2.1")
+
+
+class SaveSketchesTestCase(TestCase):
+    """Recorded sketches."""
+
+    @override_settings(MAILLOG_SKETCH_WINDOW=3600)
+    def test_save_and_get_top(self):
+        sketch = sketches.SpaceSaving(10)
+        sketch.add("user@test.com", 2)
+        sketches.save_sketches({(NOW, "test.com", "senders"): sketch})
+        sketch = sketches.SpaceSaving(10)
+        sketch.add("user@test.com")
+        sketch.add("admin@test.com")
+        sketches.save_sketches({(NOW, "test.com", "senders"): sketch})
+        self.assertEqual(models.Sketch.objects.count(), 1)
+        sketch = sketches.SpaceSaving(10)
+        sketch.add("admin@test.com", 5)
+        sketches.save_sketches({(NOW + 3600, "test.com", "senders"): sketch})
+
+        self.assertEqual(
+            sketches.get_top("test.com", "senders", NOW, NOW + 3600),
+            [["user@test.com", 3, 0], ["admin@test.com", 1, 0]],
+        )
+        self.assertEqual(
+            sketches.get_top("test.com", "senders", "-1day", NOW + 7200, limit=1),
+            [["admin@test.com", 6, 0]],
+        )
+        self.assertEqual(sketches.get_top("test.com", "recipients", NOW, NOW + 1), [])
+        self.assertEqual(sketches.delete_old_sketches(NOW + 1), 1)
+
+    def test_save_concurrent_creation(self):
+        merge = sketches.merge_recorded_sketches
+
+        def merge_then_create(*args):
+            result = merge(*args)
+            if not models.Sketch.objects.exists():
+                # Another parser creates the same window meanwhile
+                models.Sketch.objects.create(
+                    timestamp=NOW, name="test.com", kind="senders", items=[["a", 2, 0]]
+                )
+            return result
+
+        sketch = sketches.SpaceSaving(10)
+        sketch.add("a")
+        sketch.add("b")
+        with mock.patch.object(
+            sketches, "merge_recorded_sketches", side_effect=merge_then_create
+        ):
+            sketches.save_sketches({(NOW, "test.com", "senders"): sketch})
+        self.assertEqual(models.Sketch.objects.get().items, [["a", 3, 0], ["b", 1, 0]])
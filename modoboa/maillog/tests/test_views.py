@@ -1,18 +1,29 @@
 """modoboa-stats tests."""
 
 import datetime
+import gzip
+from io import StringIO
+import json
 import os
 import shutil
 import tempfile
+import time
+from unittest import mock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
+from django.db.models import Sum
 from django.urls import reverse
 from django.test import override_settings
+from django.utils import timezone
 
 from modoboa.admin import factories as admin_factories
 from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase
+from modoboa.maillog import factories, mailboxes, models, sketches
+from modoboa.maillog.management.commands import logparser, update_statistics
+from modoboa.maillog.stores import rrd
 
 
 class RunCommandsMixin(object):
@@ -29,11 +40,15 @@ class RunCommandsMixin(object):
         if os.path.exists(pid_file):
             os.remove(pid_file)
 
-    def run_logparser(self):
-        """Run logparser command."""
+    def get_log_content(self):
+        """Return the content of the test log file."""
         path = os.path.join(os.path.dirname(__file__), "mail.log")
         with open(path) as fp:
-            content = fp.read() % {"day": datetime.date.today().strftime("%b %d")}
+            return fp.read() % {"day": datetime.date.today().strftime("%b %d")}
+
+    def run_logparser(self):
+        """Run logparser command."""
+        content = self.get_log_content()
         path = os.path.join(self.workdir, "mail.log")
         with open(path, "w") as fp:
             fp.write(content)
@@ -127,6 +142,44 @@ class ViewsTestCase(RunCommandsMixin, ModoTestCase):
 
         response = self.ajax_get("{}&searchquery=test2.com".format(url), status=403)
 
+    def test_graphs_cache(self):
+        """Check exported series are cached until files change."""
+        cache.clear()
+        self.run_logparser()
+        url = "{}?gset=mailtraffic".format(reverse("maillog:graph_list"))
+        with mock.patch.object(
+            rrd.rrdtool, "xport", wraps=rrd.rrdtool.xport
+        ) as xport_mock:
+            self.ajax_get(url)
+            count = xport_mock.call_count
+            self.assertTrue(count)
+            self.ajax_get(url)
+            self.assertEqual(xport_mock.call_count, count)
+
+            # New points are written
+            path = os.path.join(self.workdir, "global.rrd")
+            mtime = os.stat(path).st_mtime + 60
+            os.utime(path, (mtime, mtime))
+            self.ajax_get(url)
+            self.assertGreater(xport_mock.call_count, count)
+
+    def test_graphs_sql_store(self):
+        """Test graphs views with the SQL statistics store."""
+        self.set_global_parameter("statistics_backend", "sql")
+        self.run_logparser()
+        url = reverse("maillog:graph_list")
+        for period in ["day", "week", "month", "year"]:
+            response = self.ajax_get(
+                "{}?gset=mailtraffic&period={}".format(url, period)
+            )
+            self.assertIn("averagetraffic", response["graphs"])
+        series = response["graphs"]["averagetraffic"]["series"]
+        self.assertTrue(any(point["y"] for point in series[0]["data"]))
+
+        response = self.ajax_get("{}?gset=accountgraphicset".format(url))
+        data = response["graphs"]["accountcreationgraphic"]["series"][0]["data"]
+        self.assertEqual(data[-1]["y"], 5.0)
+
     def test_get_domain_list(self):
         """Test get_domain_list view."""
         url = reverse("maillog:domain_list")
@@ -151,6 +204,274 @@ class ManagementCommandsTestCase(RunCommandsMixin, ModoTestCase):
             path = os.path.join(self.workdir, "{}.rrd".format(d))
             self.assertTrue(os.path.exists(path))
 
+    def test_logparser_maillog(self):
+        """Test Maillog entries recorded by logparser."""
+        self.run_logparser()
+        qset = models.Maillog.objects.all()
+        count = qset.count()
+        self.assertEqual(count, 20)
+        self.assertEqual(
+            qset.filter(to_domain__name="test.com", status="received").count(), 12
+        )
+        # Entries are not recorded twice
+        os.remove(f"{settings.PID_FILE_STORAGE_PATH}/modoboa_logparser.pid")
+        self.run_logparser()
+        self.assertEqual(qset.count(), count)
+
+    def test_logparser_checkpoint(self):
+        """Test incremental parsing."""
+        lines = self.get_log_content().splitlines(True)
+        path = os.path.join(self.workdir, "mail.log")
+        pid_file = f"{settings.PID_FILE_STORAGE_PATH}/modoboa_logparser.pid"
+        self.set_global_parameter("logfile", path)
+        qset = models.Maillog.objects.all()
+
+        with open(path, "w") as fp:
+            fp.write("".join(lines[:33]))
+            # Incomplete line
+            fp.write(lines[33].rstrip("\n"))
+        call_command("logparser")
+        self.assertEqual(qset.count(), 2)
+        with open(os.path.join(self.workdir, "logparser_checkpoints.json")) as fp:
+            checkpoint = json.load(fp)[path]
+        self.assertEqual(checkpoint["offset"], len("".join(lines[:33]).encode()))
+
+        # Write the end of the line and rotate (and compress) the file
+        with open(path, "a") as fp:
+            fp.write("\n" + "".join(lines[34:293]))
+        with open(path, "rb") as fp, gzip.open(path + ".1.gz", "wb") as gzfp:
+            gzfp.write(fp.read())
+        os.remove(path)
+        with open(path, "w") as fp:
+            fp.write("".join(lines[293:]))
+        os.remove(pid_file)
+        call_command("logparser")
+        self.assertEqual(qset.count(), 20)
+
+        # Nothing new
+        os.remove(pid_file)
+        call_command("logparser")
+        self.assertEqual(qset.count(), 20)
+
+    @override_settings(MAILLOG_MAX_PENDING_MESSAGES=2)
+    def test_logparser_pending_messages(self):
+        """Check that pending messages are freed once removed."""
+        path = os.path.join(self.workdir, "mail.log")
+        with open(path, "w") as fp:
+            fp.write(self.get_log_content())
+        options = {"logfile": path, "debug": False, "verbose": False}
+        parser = logparser.LogParser(options, self.workdir)
+        parser.process()
+        self.assertEqual(len(parser.workdict), 0)
+        self.assertEqual(parser.workdict.evicted, 0)
+        self.assertEqual(models.Maillog.objects.count(), 20)
+
+    def test_logparser_files(self):
+        """Test logparser with several (compressed) files."""
+        lines = self.get_log_content().splitlines(True)
+        path = os.path.join(self.workdir, "mail.log")
+        with gzip.open(path + ".1.gz", "wt") as fp:
+            fp.write("".join(lines[:293]))
+        with open(path, "w") as fp:
+            fp.write("".join(lines[293:]))
+        qset = models.Maillog.objects.order_by("pk").values_list(
+            "date", "queue_id", "rcpt", "status"
+        )
+        out = StringIO()
+        call_command("logparser", path + "*", "--jobs", "2", stdout=out)
+        self.assertIn("lines parsed from 2 file(s)", out.getvalue())
+        rows = list(qset)
+        self.assertTrue(rows)
+        # Same result without workers
+        models.Maillog.objects.all().delete()
+        os.remove(f"{settings.PID_FILE_STORAGE_PATH}/modoboa_logparser.pid")
+        call_command("logparser", path + ".1.gz", path, stdout=out)
+        self.assertEqual(list(qset), rows)
+        # Files are parsed (and written) from the oldest one
+        models.Maillog.objects.all().delete()
+        os.remove(f"{settings.PID_FILE_STORAGE_PATH}/modoboa_logparser.pid")
+        flushes = []
+        flush_maillogs = logparser.LogParser.flush_maillogs
+
+        def record_flush(parser):
+            flushes.append(len(parser.maillogs))
+            return flush_maillogs(parser)
+
+        with mock.patch.object(
+            logparser.LogParser,
+            "flush_maillogs",
+            autospec=True,
+            side_effect=record_flush,
+        ):
+            call_command("logparser", path, path + ".1.gz", stdout=out)
+        self.assertEqual(list(qset), rows)
+        self.assertEqual(len([count for count in flushes if count]), 2)
+
+    def test_logparser_rrd_updates(self):
+        """Check that points are written with a single update per file."""
+        with mock.patch.object(
+            rrd.rrdtool, "update", wraps=rrd.rrdtool.update
+        ) as update:
+            self.run_logparser()
+        fnames = [call.args[0] for call in update.call_args_list]
+        self.assertEqual(len(fnames), len(set(fnames)))
+        self.assertIn("{}/test.com.rrd".format(self.workdir), fnames)
+        # Gaps are filled using as few points as the heartbeat allows
+        index = fnames.index("{}/global.rrd".format(self.workdir))
+        args = update.call_args_list[index].args
+        timestamps = [int(value.split(":")[0]) for value in args[3:]]
+        for previous, current in zip(timestamps, timestamps[1:]):
+            self.assertLessEqual(current - previous, rrd.heartbeat)
+
+    def test_logparser_stdin(self):
+        """Test logparser reading standard input."""
+        path = os.path.join(self.workdir, "mail.log")
+        with open(path, "w") as fp:
+            fp.write(self.get_log_content())
+        with open(path) as fp, mock.patch("sys.stdin", fp):
+            call_command("logparser", "--logfile", "-", "--flush-lines", "100")
+        self.assertEqual(models.Maillog.objects.count(), 20)
+        for d in ["global", "test.com"]:
+            path = os.path.join(self.workdir, "{}.rrd".format(d))
+            self.assertTrue(os.path.exists(path))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.workdir, "logparser_checkpoints.json"))
+        )
+
+    def test_logparser_follow_flush(self):
+        """Check that minutes are only written once they are over."""
+        lines = [line.encode() + b"\n" for line in self.get_log_content().splitlines()]
+
+        class Source:
+            def read(self, timeout):
+                if not lines:
+                    raise EOFError
+                return [lines.pop(0)]
+
+            def close(self):
+                pass
+
+        options = {"logfile": None, "verbose": False, "debug": False}
+        parser = logparser.LogParser(options, self.workdir)
+        written = []
+        update = parser.store.update
+
+        def record_update(name, points):
+            written.extend((name, t) for t in points)
+            return update(name, points)
+
+        # Catching up on a backlog
+        now = time.time() + 2 * 24 * 3600
+        with mock.patch.object(
+            parser.store, "update", side_effect=record_update
+        ), mock.patch.object(logparser.time, "time", return_value=now):
+            parser.follow(Source(), flush_lines=1)
+        self.assertEqual(len(written), len(set(written)))
+
+    def test_logparser_follow_new_domain(self):
+        """Check that domains created while following are recorded."""
+        day = datetime.date.today().strftime("%b %d")
+        lines = [
+            "{} 11:00:20 server postfix/qmgr[26163]: B0320E00C3: "
+            "from=<sender@example.org>, size=1000, nrcpt=1 (queue active)",
+            "{} 11:00:20 server postfix/lmtp[28946]: B0320E00C3: "
+            "to=<user@new.test>, relay=local, delay=0.32, "
+            "delays=0.11/0.01/0.01/0.2, dsn=2.0.0, status=sent (250 Saved)",
+            "{} 11:00:20 server postfix/qmgr[26163]: B0320E00C3: removed",
+        ]
+        lines = [line.format(day).encode() + b"\n" for line in lines]
+
+        class Source:
+            started = False
+
+            def read(self, timeout):
+                if not self.started:
+                    # Domain created after the parser has started
+                    self.started = True
+                    admin_factories.DomainFactory(name="new.test")
+                    return []
+                if not lines:
+                    raise EOFError
+                return [lines.pop(0)]
+
+            def close(self):
+                pass
+
+        options = {"logfile": None, "verbose": False, "debug": False}
+        parser = logparser.LogParser(options, self.workdir)
+        parser.follow(Source(), flush_interval=0, reload_interval=0)
+        maillog = models.Maillog.objects.get(queue_id="B0320E00C3")
+        self.assertEqual(maillog.to_domain.name, "new.test")
+        self.assertTrue(os.path.exists(os.path.join(self.workdir, "new.test.rrd")))
+
+    def test_logparser_sql_store(self):
+        """Test logparser with the SQL statistics store."""
+        self.set_global_parameter("statistics_backend", "sql")
+        self.run_logparser()
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, "global.rrd")))
+        totals = []
+        for model in [
+            models.MinuteStatistics,
+            models.HourStatistics,
+            models.DayStatistics,
+        ]:
+            totals.append(
+                model.objects.filter(name="global").aggregate(
+                    sent=Sum("sent"), recv=Sum("recv"), size=Sum("size_recv")
+                )
+            )
+        self.assertTrue(totals[0]["recv"])
+        self.assertEqual(totals[0], totals[1])
+        self.assertEqual(totals[0], totals[2])
+        self.assertTrue(models.MinuteStatistics.objects.filter(name="test.com"))
+
+        # Counters are incremented by the next runs
+        os.remove(f"{settings.PID_FILE_STORAGE_PATH}/modoboa_logparser.pid")
+        call_command("logparser", "--no-checkpoint")
+        total = models.DayStatistics.objects.filter(name="global").aggregate(
+            recv=Sum("recv")
+        )
+        self.assertEqual(total["recv"], totals[0]["recv"] * 2)
+
+    def test_logparser_mailbox_counters(self):
+        """Check per mailbox counters."""
+        self.run_logparser()
+        expected = {}
+        qset = models.Maillog.objects.filter(status="received").values_list(
+            "rcpt", "original_rcpt"
+        )
+        for rcpt, original_rcpt in qset:
+            address = (original_rcpt or rcpt).lower()
+            if address in ["admin@test.com", "user@test.com"]:
+                expected[address] = expected.get(address, 0) + 1
+        self.assertTrue(expected)
+        counters = mailboxes.MailboxCounters(self.workdir, readonly=True)
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        start = int(today.timestamp())
+        top = counters.get_top("recv", start, start + 24 * 3600)
+        self.assertEqual(dict(top), expected)
+        counters.close()
+
+    def test_logparser_sketches(self):
+        """Check top senders, recipients and rejected clients."""
+        self.run_logparser()
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        start = int(today.timestamp())
+        end = start + 24 * 3600
+        expected = {}
+        qset = models.Maillog.objects.filter(
+            status__in=["sent", "received"]
+        ).values_list("sender", flat=True)
+        for sender in qset:
+            sender = sender.lower() or "<>"
+            expected[sender] = expected.get(sender, 0) + 1
+        top = sketches.get_top("global", "senders", start, end, limit=1000)
+        self.assertEqual({item: count for item, count, error in top}, expected)
+        self.assertFalse(any(error for item, count, error in top))
+        top = sketches.get_top("test2.com", "rejected_clients", "-1day", end)
+        self.assertTrue(top)
+        self.assertEqual(sum(count for item, count, error in top), 4)
+
     def test_logparser_with_greylist(self):
         """Test logparser when greylist activated."""
         self.set_global_parameter("greylist", True)
@@ -167,6 +488,40 @@ class ManagementCommandsTestCase(RunCommandsMixin, ModoTestCase):
         self.run_update_statistics(rebuild=True)
         self.assertTrue(os.path.exists(path))
 
+    def test_update_statistics_rebuild_chunks(self):
+        """Check a rebuild covering many hours."""
+        core_models.User.objects.update(
+            date_joined=timezone.now() - datetime.timedelta(days=3)
+        )
+        with mock.patch.object(update_statistics, "UPDATE_CHUNK_SIZE", 10):
+            self.run_update_statistics(rebuild=True)
+        path = os.path.join(self.workdir, "new_accounts.rrd")
+        end = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.assertEqual(
+            rrd.rrdtool.last(path), int(end.timestamp()) + update_statistics.STEP
+        )
+
+    def test_purge_maillogs(self):
+        """Test purge_maillogs command."""
+        domain = admin_factories.DomainFactory(name="purge.test")
+        now = timezone.now()
+        for days in [1, 100, 400, 500, 600]:
+            factories.MaillogFactory(
+                date=now - datetime.timedelta(days), from_domain=domain, to_domain=None
+            )
+        models.Sketch.objects.create(
+            name="global", kind="senders", timestamp=int(now.timestamp()) - 400 * 86400
+        )
+        call_command("purge_maillogs", "--chunk-size", "1")
+        qset = models.Maillog.objects.filter(from_domain=domain)
+        self.assertEqual(qset.count(), 2)
+        self.assertFalse(models.Sketch.objects.exists())
+        call_command("purge_maillogs", "--days", "30")
+        self.assertEqual(qset.count(), 1)
+        self.set_global_parameter("maillog_maximum_age", 0)
+        call_command("purge_maillogs")
+        self.assertEqual(qset.count(), 1)
+
     def test_locking(self):
         with open(f"{settings.PID_FILE_STORAGE_PATH}/modoboa_logparser.pid", "w") as fp:
             fp.write(f"{os.getpid()}\n")
@@ -0,0 +1,236 @@
+"""Load generator for the policy daemon.
+
+Open many concurrent connections, send policy delegation requests (as
+postfix would do) and measure how long the daemon takes to answer.
+
+Generated senders use the ``.invalid`` top level domain so they never
+conflict with real accounts. A part of them (and of their domains) get
+a sending limit, directly stored in redis, which is removed once the
+benchmark is over.
+"""
+
+import asyncio
+import math
+import random
+import time
+
+from . import constants, core, utils
+
+REQUEST_TEMPLATE = (
+    "request=smtpd_access_policy\n"
+    "protocol_state=RCPT\n"
+    "protocol_name=ESMTP\n"
+    "client_address={client_address}\n"
+    "client_name=client{client}.example.net\n"
+    "reverse_client_name=client{client}.example.net\n"
+    "helo_name=client{client}.example.net\n"
+    "sender={sender}\n"
+    "recipient={recipient}\n"
+    "recipient_count=0\n"
+    "queue_id=\n"
+    "instance={instance}\n"
+    "size={size}\n"
+    "etrn_domain=\n"
+    "stress=\n"
+    "sasl_method={sasl_method}\n"
+    "sasl_username={sasl_username}\n"
+    "sasl_sender=\n"
+    "ccert_subject=\n"
+    "ccert_issuer=\n"
+    "ccert_fingerprint=\n"
+    "encryption_protocol=TLSv1.3\n"
+    "encryption_cipher=TLS_AES_256_GCM_SHA384\n"
+    "encryption_keysize=256\n"
+    "policy_context=\n"
+    "server_address=192.0.2.1\n"
+    "server_port=587\n"
+    "\n"
+)
+
+
+def percentile(values, percent):
+    """Return the given percentile of sorted values (nearest rank)."""
+    if not values:
+        return None
+    rank = max(int(math.ceil(percent / 100 * len(values))), 1)
+    return values[rank - 1]
+
+
+class Scenario:
+    """Senders and requests sent during a benchmark."""
+
+    def __init__(
+        self,
+        senders=1000,
+        domains=100,
+        limited_ratio=0.5,
+        unauthenticated_ratio=0.0,
+        limit=1000000,
+        seed=None,
+    ):
+        """Constructor.
+
+        :param int senders: number of distinct authenticated senders
+        :param int domains: number of domains senders belong to
+        :param float limited_ratio: part of senders and domains with a limit
+        :param float unauthenticated_ratio: part of requests sent without
+                                            authentication
+        :param int limit: sending limit given to limited senders and domains
+        :param seed: seed of the random generator
+        """
+        self.random = random.Random(seed)
+        self.limit = limit
+        self.unauthenticated_ratio = unauthenticated_ratio
+        self.domains = ["bench{}.invalid".format(i) for i in range(max(domains, 1))]
+        self.senders = [
+            "user{}@{}".format(i, self.domains[i % len(self.domains)])
+            for i in range(max(senders, 1))
+        ]
+        self.limited = self.senders[: int(len(self.senders) * limited_ratio)] + (
+            self.domains[: int(len(self.domains) * limited_ratio)]
+        )
+
+    def build_request(self):
+        """Return a new request."""
+        client = self.random.randrange(1, 255)
+        if self.random.random() < self.unauthenticated_ratio:
+            sender = "sender{}@example.org".format(self.random.randrange(1000))
+            sasl_method = sasl_username = ""
+        else:
+            sender = sasl_username = self.random.choice(self.senders)
+            sasl_method = "PLAIN"
+        return REQUEST_TEMPLATE.format(
+            client_address="198.51.100.{}".format(client),
+            client=client,
+            sender=sender,
+            recipient="rcpt{}@example.com".format(self.random.randrange(10000)),
+            instance="{:x}.{:x}.0".format(
+                self.random.getrandbits(16), self.random.getrandbits(32)
+            ),
+            size=self.random.randrange(1000, 1000000),
+            sasl_method=sasl_method,
+            sasl_username=sasl_username,
+        ).encode()
+
+    def build_requests(self, count):
+        """Return a list of requests."""
+        return [self.build_request() for i in range(count)]
+
+    async def setup(self, rclient):
+        """Define the limits of limited senders and domains."""
+        if not self.limited:
+            return
+        mapping = {name: self.limit for name in self.limited}
+        if utils.get_counter_mode() == constants.COUNTER_MODE_WINDOW:
+            await rclient.hset(constants.REDIS_LIMITS_HASHNAME, mapping=mapping)
+        else:
+            await rclient.hset(constants.REDIS_HASHNAME, mapping=mapping)
+
+    async def cleanup(self, rclient):
+        """Remove everything created by setup."""
+        if not self.limited:
+            return
+        await rclient.hdel(constants.REDIS_HASHNAME, *self.limited)
+        await rclient.hdel(constants.REDIS_LIMITS_HASHNAME, *self.limited)
+        window = utils.get_current_window()[0]
+        await rclient.delete(
+            *[utils.get_window_counter_key(window, name) for name in self.limited]
+        )
+
+
+class Benchmark:
+    """Send requests to a policy daemon and measure latencies."""
+
+    def __init__(
+        self, host, port, requests, connections=50, requests_per_connection=100
+    ):
+        """Constructor.
+
+        :param str host: address of the policy daemon
+        :param int port: port of the policy daemon
+        :param list requests: requests to send
+        :param int connections: number of concurrent connections
+        :param int requests_per_connection: number of requests sent before
+                                            a connection is reopened
+        """
+        self.host = host
+        self.port = port
+        self.requests = requests
+        self.connections = connections
+        self.requests_per_connection = requests_per_connection
+        self.position = 0
+        self.latencies = []
+        self.actions = {}
+        self.errors = 0
+
+    def next_request(self):
+        """Return the next request to send, None if none is left."""
+        if self.position >= len(self.requests):
+            return None
+        request = self.requests[self.position]
+        self.position += 1
+        return request
+
+    async def client(self):
+        """Send requests until none is left, like a postfix process."""
+        request = self.next_request()
+        while request is not None:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                self.errors += 1
+                request = self.next_request()
+                continue
+            try:
+                for counter in range(self.requests_per_connection):
+                    start = time.perf_counter()
+                    writer.write(request)
+                    await writer.drain()
+                    response = await reader.readuntil(b"\n\n")
+                    self.latencies.append(time.perf_counter() - start)
+                    action = response.decode().split("=", 1)[-1].split()[0]
+                    self.actions[action] = self.actions.get(action, 0) + 1
+                    request = self.next_request()
+                    if request is None:
+                        break
+            except (OSError, asyncio.IncompleteReadError):
+                self.errors += 1
+                request = self.next_request()
+            finally:
+                writer.close()
+
+    async def run(self):
+        """Run the benchmark and return results."""
+        start = time.perf_counter()
+        await asyncio.gather(*[self.client() for i in range(self.connections)])
+        duration = time.perf_counter() - start
+        latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "duration": duration,
+            "throughput": len(latencies) / duration if duration else 0,
+            "actions": self.actions,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        }
+
+
+async def start_local_daemon(host="127.0.0.1"):
+    """Start a policy daemon in the current event loop.
+
+    :return: the server and the port it listens on
+    """
+    core.get_redis_client()
+    core.start_leases_coro()
+    server = await asyncio.start_server(core.new_connection, host, 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def stop_local_daemon(server):
+    """Stop a daemon started by start_local_daemon."""
+    server.close()
+    await server.wait_closed()
+    await core.release_leases()
@@ -1,3 +1,26 @@
 """App. related constants."""
 
 REDIS_HASHNAME = "messages_count"
+# Incremented each time counters are reset (used by leases)
+REDIS_GENERATION_KEY = "messages_count_generation"
+# Message limits, used to initialize windowed counters
+REDIS_LIMITS_HASHNAME = "messages_limit"
+# Prefix of the keys used by windowed counters
+REDIS_WINDOW_PREFIX = "messages_sent"
+# Channel used to publish changes of policy related attributes
+REDIS_POLICY_CHANNEL = "policy_changes"
+# Prefix of the keys telling a limit reached notification was sent today
+REDIS_NOTIFICATION_PREFIX = "limit_notified"
+
+# Counters are stored in a hash and reset every night
+COUNTER_MODE_HASH = "hash"
+# Same as hash but each daemon instance leases batches of tokens and
+# decides locally
+COUNTER_MODE_LEASE = "lease"
+# One counter per time window, expiring when the window ends
+COUNTER_MODE_WINDOW = "window"
+
+COUNTER_WINDOWS = {
+    "day": "%Y%m%d",
+    "hour": "%Y%m%d%H",
+}
@@ -2,27 +2,23 @@
 
 from asgiref.sync import sync_to_async
 import asyncio
-import concurrent.futures
-from email.message import EmailMessage
 import logging
 
-import aiosmtplib
 from dateutil.relativedelta import relativedelta
 from redis import asyncio as aioredis
 
 from django.conf import settings
-from django.db import connections
-from django.template.loader import render_to_string
+from django.db import DatabaseError, connections
 from django.utils import timezone
-from django.utils import translation
-from django.utils.translation import gettext as _, gettext_lazy
 
 from modoboa.admin import constants as admin_constants
 from modoboa.admin import models as admin_models
-from modoboa.core import models as core_models
 from modoboa.lib.email_utils import split_mailbox
 
-from . import constants
+from . import constants, metrics, scripts, utils
+from .leases import LeaseManager
+from .notifications import NotificationDispatcher
+from .snapshot import PolicySnapshot
 
 logger = logging.getLogger("modoboa.policyd")
 
@@ -30,6 +26,133 @@ logger = logging.getLogger("modoboa.policyd")
 SUCCESS_ACTION = b"dunno"
 FAILURE_ACTION = b"defer_if_permit Daily limit reached, retry later"
 
+# Delay (in seconds) given to a request to be answered
+REQUEST_TIMEOUT = 5
+# Default delay (in seconds) after which an idle connection is closed
+IDLE_TIMEOUT = 300
+# Default number of requests accepted on a single connection
+MAX_REQUESTS = 1000
+
+_redis_client = None
+_scripts = {}
+_lease_manager = None
+_notification_dispatcher = None
+_policy_snapshot = None
+_connections = set()
+_idle_connections = set()
+_stopping = False
+
+
+def get_redis_client():
+    """Return the Redis client shared by all connections.
+
+    It relies on a connection pool which is created on first call, so
+    it must be called from the process (and event loop) that will use
+    it.
+    """
+    if _redis_client is None:
+        pool = aioredis.BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=getattr(settings, "POLICYD_REDIS_MAX_CONNECTIONS", 50),
+            encoding="utf-8",
+            decode_responses=True,
+        )
+        set_redis_client(aioredis.Redis(connection_pool=pool))
+    return _redis_client
+
+
+def set_redis_client(client):
+    """Define the Redis client shared by all connections.
+
+    Useful to provide another client (a fake one for example).
+    """
+    global _redis_client
+    _redis_client = client
+    for name in [
+        "CHECK_AND_DECREMENT_LIMITS",
+        "CHECK_AND_INCREMENT_WINDOW_COUNTERS",
+    ]:
+        _scripts[name] = client.register_script(getattr(scripts, name))
+
+
+def get_lease_manager():
+    """Return the manager of local token leases."""
+    global _lease_manager
+    if _lease_manager is None:
+        _lease_manager = LeaseManager(
+            get_redis_client(),
+            getattr(settings, "POLICYD_LEASE_SIZE", 10),
+            getattr(settings, "POLICYD_LEASE_DURATION", 30),
+        )
+    return _lease_manager
+
+
+async def release_leases():
+    """Give unused leased tokens back."""
+    global _lease_manager
+    if _lease_manager is None:
+        return
+    await _lease_manager.release()
+    _lease_manager = None
+
+
+def get_notification_dispatcher():
+    """Return the dispatcher of limit reached notifications."""
+    global _notification_dispatcher
+    if _notification_dispatcher is None:
+        _notification_dispatcher = NotificationDispatcher(
+            get_redis_client(),
+            max_pending=getattr(settings, "POLICYD_MAX_PENDING_NOTIFICATIONS", 100),
+        )
+    return _notification_dispatcher
+
+
+async def close_notification_dispatcher():
+    """Send pending notifications and close dispatcher."""
+    global _notification_dispatcher
+    if _notification_dispatcher is None:
+        return
+    await _notification_dispatcher.close()
+    _notification_dispatcher = None
+
+
+async def close_redis_client():
+    """Close the shared Redis client and its connection pool."""
+    global _redis_client
+    if _redis_client is None:
+        return
+    await _redis_client.connection_pool.disconnect()
+    _redis_client = None
+    _scripts.clear()
+
+
+class Deadline:
+    """Context manager to limit the execution time of a block.
+
+    When the delay expires, the current task is cancelled and
+    :exc:`asyncio.TimeoutError` is raised. It is lighter than
+    :func:`asyncio.wait_for` which creates a new task for each call.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.expired = False
+
+    def __enter__(self):
+        loop = asyncio.get_running_loop()
+        self.handle = loop.call_later(self.delay, self.expire, asyncio.current_task())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.handle.cancel()
+        if exc_type is asyncio.CancelledError and self.expired:
+            raise asyncio.TimeoutError from exc_value
+        return False
+
+    def expire(self, task):
+        self.expired = True
+        task.cancel()
+
 
 def close_db_connections(func, *args, **kwargs):
     """
@@ -70,73 +193,40 @@ async def run_at(dt, coro, *args):
     return await coro(*args)
 
 
-@close_db_connections
-def get_local_config():
-    """Return local configuration."""
-    return core_models.LocalConfig.objects.first()
-
+async def check_limits(names):
+    """Check and update the counters associated to names.
 
-@close_db_connections
-def get_notification_recipients():
-    """Return superadmins with a mailbox."""
-    return core_models.User.objects.filter(is_superuser=True, mailbox__isnull=False)
+    Everything is done atomically by a server-side script, using a
+    single round trip. Depending on the counter mode, remaining
+    messages are either stored in a hash (reset every night) or
+    computed from the limit and a counter of sent messages which
+    expires at the end of the current window. In lease mode, redis is
+    only queried when local leases need to be renewed.
 
-
-@close_db_connections
-def create_alarm(ltype, name):
-    """Create a new alarm."""
-    title = _("Daily sending limit reached")
-    internal_name = "sending_limit"
-    if ltype == "domain":
-        domain = admin_models.Domain.objects.get(name=name)
-        domain.alarms.create(title=title, internal_name=internal_name)
+    :param list names: list of counter names (domain, account...)
+    :return: a tuple (allowed, counters) where counters is a list
+             containing the remaining value of each counter (None if
+             there is no limit defined)
+    """
+    mode = utils.get_counter_mode()
+    if mode == constants.COUNTER_MODE_LEASE:
+        return await get_lease_manager().check(names)
+    get_redis_client()
+    if mode == constants.COUNTER_MODE_WINDOW:
+        window, window_end = utils.get_current_window()
+        keys = [constants.REDIS_LIMITS_HASHNAME] + [
+            utils.get_window_counter_key(window, name) for name in names
+        ]
+        with metrics.REDIS_DURATION.time():
+            result = await _scripts["CHECK_AND_INCREMENT_WINDOW_COUNTERS"](
+                keys=keys, args=[window_end] + names
+            )
     else:
-        localpart, domain = split_mailbox(name)
-        mailbox = admin_models.Mailbox.objects.get(
-            address=localpart, domain__name=domain
-        )
-        mailbox.alarms.create(
-            domain=mailbox.domain, title=title, internal_name=internal_name
-        )
-
-
-async def notify_limit_reached(ltype, name):
-    """Send a notification to super admins about item."""
-    ltype_translations = {
-        "account": gettext_lazy("account"),
-        "domain": gettext_lazy("domain"),
-    }
-    # We're going to execute sync code so we need an executor
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
-    loop = asyncio.get_event_loop()
-    futures = [
-        loop.run_in_executor(executor, get_local_config),
-        loop.run_in_executor(executor, get_notification_recipients),
-        loop.run_in_executor(executor, create_alarm, ltype, name),
-    ]
-    lc, recipients, junk = await asyncio.gather(*futures)
-    sender = lc.parameters.get_value("sender_address", app="core")
-    for recipient in recipients:
-        with translation.override(recipient.language):
-            content = render_to_string(
-                "policyd/notifications/limit_reached.html",
-                {"ltype": ltype_translations[ltype], "name": name},
+        with metrics.REDIS_DURATION.time():
+            result = await _scripts["CHECK_AND_DECREMENT_LIMITS"](
+                keys=[constants.REDIS_HASHNAME], args=names
             )
-            subject = _("[modoboa] Sending limit reached")
-        msg = EmailMessage()
-        msg["From"] = sender
-        msg["To"] = recipient.email
-        msg["Subject"] = subject
-        msg.set_content(content)
-        await aiosmtplib.send(msg)
-
-
-async def decrement_limit(rclient, ltype, name):
-    """Decrement the given limit by one."""
-    new_counter = await rclient.hincrby(constants.REDIS_HASHNAME, name, -1)
-    if new_counter <= 0:
-        logger.info("Limit reached for {} {}".format(ltype, name))
-        asyncio.ensure_future(notify_limit_reached(ltype, name))
+    return bool(result[0]), result[1:]
 
 
 async def apply_policies(attributes):
@@ -144,74 +234,117 @@ async def apply_policies(attributes):
     sasl_username = attributes.get("sasl_username")
     if not sasl_username:
         return SUCCESS_ACTION
-    rclient = aioredis.from_url(
-        settings.REDIS_URL, encoding="utf-8", decode_responses=True
-    )
-    decr_domain = False
-    decr_user = False
     localpart, domain = split_mailbox(sasl_username)
-    if await rclient.hexists(constants.REDIS_HASHNAME, domain):
-        counter = await rclient.hget(constants.REDIS_HASHNAME, domain)
-        logger.info("Domain {} current counter: {}".format(domain, counter))
-        if int(counter) <= 0:
-            return FAILURE_ACTION
-        decr_domain = True
-    if await rclient.hexists(constants.REDIS_HASHNAME, sasl_username):
-        counter = await rclient.hget(constants.REDIS_HASHNAME, sasl_username)
-        logger.info("Account {} current counter: {}".format(sasl_username, counter))
-        if int(counter) <= 0:
-            return FAILURE_ACTION
-        decr_user = True
-    if decr_domain:
-        await decrement_limit(rclient, "domain", domain)
-    if decr_user:
-        await decrement_limit(rclient, "account", sasl_username)
-    await rclient.close()
+    limits = [("account", sasl_username)]
+    if domain:
+        limits.insert(0, ("domain", domain))
+    allowed, counters = await check_limits([name for ltype, name in limits])
+    for (ltype, name), counter in zip(limits, counters):
+        if counter is None:
+            continue
+        logger.info(
+            "{} {} remaining counter: {}".format(ltype.capitalize(), name, counter)
+        )
+        if allowed and counter <= 0:
+            logger.info("Limit reached for {} {}".format(ltype, name))
+            get_notification_dispatcher().notify(ltype, name)
+    if not allowed:
+        return FAILURE_ACTION
     logger.debug("Let it pass")
     return SUCCESS_ACTION
 
 
-async def handle_connection(reader, writer):
-    """Coroutine to handle a new connection to the server."""
+def parse_request(data):
+    """Extract attributes from a policy delegation request."""
+    attributes = {}
+    for line in data.decode().split("\n"):
+        if not line:
+            continue
+        try:
+            name, value = line.split("=", 1)
+        except ValueError:
+            continue
+        attributes[name] = value
+    return attributes
+
+
+async def handle_request(data):
+    """Return the action to send back for the given request."""
     action = SUCCESS_ACTION
-    try:
-        logger.debug("Reading data")
-        data = await reader.readuntil(b"\n\n")
-    except asyncio.IncompleteReadError:
-        pass
-    else:
-        attributes = {}
-        for line in data.decode().split("\n"):
-            if not line:
-                continue
-            try:
-                name, value = line.split("=")
-            except ValueError:
-                continue
-            attributes[name] = value
-        state = attributes.get("protocol_state")
-        if state == "RCPT":
-            logger.debug("Applying policies")
+    attributes = parse_request(data)
+    state = attributes.get("protocol_state")
+    if state == "RCPT":
+        logger.debug("Applying policies")
+        with metrics.DECISION_DURATION.time():
             action = await apply_policies(attributes)
-            logger.debug("Done")
-    logger.debug("Sending action %s", action)
-    writer.write(b"action=" + action + b"\n\n")
-    await writer.drain()
+        logger.debug("Done")
+    metrics.REQUESTS.inc(state=state or "", action=action.split(b" ", 1)[0].decode())
+    return action
+
 
+async def handle_connection(reader, writer, idle_timeout, max_requests):
+    """Coroutine to handle requests received on a connection.
 
-async def new_connection(reader, writer):
+    Postfix keeps connections open and reuses them for several
+    requests, so we loop until the client goes away, stays idle for
+    too long or reaches the maximum number of requests.
+    """
+    task = asyncio.current_task()
+    for counter in range(max_requests):
+        _idle_connections.add(task)
+        try:
+            logger.debug("Reading data")
+            with Deadline(idle_timeout):
+                data = await reader.readuntil(b"\n\n")
+        except asyncio.IncompleteReadError:
+            return
+        except asyncio.TimeoutError:
+            logger.debug("Connection idle for too long, closing")
+            return
+        finally:
+            _idle_connections.discard(task)
+        with Deadline(REQUEST_TIMEOUT):
+            action = await handle_request(data)
+            logger.debug("Sending action %s", action)
+            writer.write(b"action=" + action + b"\n\n")
+            await writer.drain()
+        if _stopping:
+            return
+
+
+async def new_connection(
+    reader, writer, idle_timeout=IDLE_TIMEOUT, max_requests=MAX_REQUESTS
+):
+    task = asyncio.current_task()
+    _connections.add(task)
+    metrics.OPEN_CONNECTIONS.inc()
     try:
-        await asyncio.wait_for(handle_connection(reader, writer), timeout=5)
-    except asyncio.TimeoutError as err:
-        logger.warning("Timeout received while handling connection: %s", err)
+        await handle_connection(reader, writer, idle_timeout, max_requests)
+    except asyncio.TimeoutError:
+        logger.warning("Timeout received while handling request")
+        metrics.CONNECTION_TIMEOUTS.inc()
     finally:
+        metrics.OPEN_CONNECTIONS.dec()
         writer.close()
         if hasattr(writer, "wait_closed"):
             # Python 3.7+ only
             await writer.wait_closed()
+        _connections.discard(task)
         logger.info("exit")
 
 
+async def close_connections(timeout):
+    """Close idle connections and wait for the other ones to terminate."""
+    global _stopping
+    _stopping = True
+    for task in _idle_connections:
+        task.cancel()
+    if not _connections:
+        return
+    logger.info("Waiting for %d connection(s) to terminate", len(_connections))
+    await asyncio.wait(list(_connections), timeout=timeout)
+
+
 def get_next_execution_dt():
     """Return next execution date and time."""
     return (timezone.now() + relativedelta(days=1)).replace(hour=0, minute=0, second=0)
@@ -253,23 +386,138 @@ def get_mailboxes_to_reset():
     return list(qset)
 
 
-async def reset_counters():
-    """Reset all counters."""
-    rclient = aioredis.from_url(
-        settings.REDIS_URL, encoding="utf-8", decode_responses=True
+@sync_to_async
+@close_db_connections
+def close_limit_alarms():
+    """Close all opened alarms about sending limits."""
+    admin_models.Alarm.objects.filter(
+        internal_name="limit_reached", status=admin_constants.ALARM_OPENED
+    ).update(status=admin_constants.ALARM_CLOSED, closed=timezone.now())
+
+
+@sync_to_async
+@close_db_connections
+def get_message_limits():
+    """Return the message limit of each domain and mailbox."""
+    limits = dict(
+        admin_models.Domain.objects.filter(message_limit__isnull=False).values_list(
+            "name", "message_limit"
+        )
     )
-    logger.info("Resetting all counters")
-    for domain in await get_domains_to_reset():
-        await rclient.hset(constants.REDIS_HASHNAME, domain.name, domain.message_limit)
-    for mb in await get_mailboxes_to_reset():
-        await rclient.hset(constants.REDIS_HASHNAME, mb.full_address, mb.message_limit)
-    await rclient.close()
+    qset = admin_models.Mailbox.objects.filter(message_limit__isnull=False)
+    for address, domain, limit in qset.values_list(
+        "address", "domain__name", "message_limit"
+    ):
+        limits["{}@{}".format(address, domain)] = limit
+    return limits
+
+
+async def load_message_limits():
+    """Load message limits used by windowed counters."""
+    rclient = get_redis_client()
+    limits = await get_message_limits()
+    logger.info("Loading {} message limit(s)".format(len(limits)))
+    async with rclient.pipeline(transaction=True) as pipe:
+        pipe.delete(constants.REDIS_LIMITS_HASHNAME)
+        if limits:
+            pipe.hset(constants.REDIS_LIMITS_HASHNAME, mapping=limits)
+        await pipe.execute()
+
+
+async def reset_counters():
+    """Reset all counters.
+
+    Windowed counters expire by themselves so we only close alarms.
+    """
+    if utils.get_counter_mode() == constants.COUNTER_MODE_WINDOW:
+        logger.info("Closing sending limit alarms")
+        await close_limit_alarms()
+    else:
+        rclient = get_redis_client()
+        logger.info("Resetting all counters")
+        counters = {}
+        for domain in await get_domains_to_reset():
+            counters[domain.name] = domain.message_limit
+        for mb in await get_mailboxes_to_reset():
+            counters[mb.full_address] = mb.message_limit
+        if counters:
+            await rclient.hset(constants.REDIS_HASHNAME, mapping=counters)
+            await rclient.hset(constants.REDIS_LIMITS_HASHNAME, mapping=counters)
+        # Invalidate tokens leased before reset
+        await rclient.incr(constants.REDIS_GENERATION_KEY)
     # reschedule
     asyncio.ensure_future(run_at(get_next_execution_dt(), reset_counters))
 
 
+def start_leases_coro():
+    """Start the coroutine releasing expired leases, if needed."""
+    if utils.get_counter_mode() == constants.COUNTER_MODE_LEASE:
+        asyncio.ensure_future(get_lease_manager().run())
+
+
+def get_policy_snapshot():
+    """Return the snapshot of policy related attributes."""
+    global _policy_snapshot
+    if _policy_snapshot is None:
+        _policy_snapshot = PolicySnapshot()
+    return _policy_snapshot
+
+
+@sync_to_async
+@close_db_connections
+def load_policy_snapshot():
+    """Load the policy snapshot from the database."""
+    get_policy_snapshot().load()
+
+
+@sync_to_async
+def refresh_policy_snapshot(event):
+    """Apply a change event to the policy snapshot.
+
+    The database connection is kept open between two events. If it
+    has been lost, a new one is used to try again.
+    """
+    try:
+        get_policy_snapshot().refresh(event)
+    except DatabaseError:
+        for conn in connections.all():
+            conn.close()
+        get_policy_snapshot().refresh(event)
+
+
+async def follow_policy_changes():
+    """Load the policy snapshot and keep it up to date."""
+    while True:
+        pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+        try:
+            # Subscribe first so changes made while loading are not lost
+            await pubsub.subscribe(constants.REDIS_POLICY_CHANNEL)
+            await load_policy_snapshot()
+            logger.debug("Policy snapshot loaded")
+            async for message in pubsub.listen():
+                try:
+                    await refresh_policy_snapshot(message["data"])
+                except DatabaseError:
+                    logger.exception("Failed to apply policy change")
+        except aioredis.ConnectionError:
+            logger.warning("Connection to redis lost, policy snapshot will be reloaded")
+        except DatabaseError:
+            logger.exception("Failed to load policy snapshot")
+        finally:
+            await pubsub.reset()
+        await asyncio.sleep(1)
+
+
+def start_policy_snapshot_coro():
+    """Start the coroutine maintaining the policy snapshot, if needed."""
+    if utils.is_policy_snapshot_enabled():
+        asyncio.ensure_future(follow_policy_changes())
+
+
 def start_reset_counters_coro():
     """Start coroutine."""
+    if utils.get_counter_mode() == constants.COUNTER_MODE_WINDOW:
+        asyncio.ensure_future(load_message_limits())
     first_time = (timezone.now() + relativedelta(days=1)).replace(
         hour=0, minute=0, second=0
     )
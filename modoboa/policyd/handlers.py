@@ -1,14 +1,85 @@
 """App related signal handlers."""
 
-import redis
+import weakref
 
-from django.conf import settings
+from django.db import transaction
 from django.db.models import signals
 from django.dispatch import receiver
 
 from modoboa.admin import models as admin_models
+from modoboa.core import models as core_models
 
-from . import constants
+from . import constants, utils
+
+
+class Operation:
+    """A redis command waiting for the transaction to be committed.
+
+    Each operation is registered as an on_commit callback. When the
+    savepoint it belongs to is rolled back, Django discards the callback
+    and so releases the operation.
+    """
+
+    def __init__(self, command, args):
+        """Constructor."""
+        self.command = command
+        self.args = args
+
+    def __call__(self):
+        """Nothing to do: operations are sent by PendingOperations."""
+
+
+class PendingOperations:
+    """Operations of a transaction, sent using a single pipeline."""
+
+    def __init__(self):
+        """Constructor."""
+        self.operations = []
+        self.flushed = False
+
+    def add(self, operation):
+        """Add a new operation (released if it is rolled back)."""
+        self.operations.append(weakref.ref(operation))
+
+    def __call__(self):
+        """Send all operations which are still scheduled, in order."""
+        self.flushed = True
+        operations = [ref() for ref in self.operations]
+        self.operations = []
+        pipeline = utils.get_redis_connection().pipeline(transaction=False)
+        for operation in operations:
+            if operation is not None:
+                getattr(pipeline, operation.command)(*operation.args)
+        pipeline.execute()
+
+
+def get_pending_operations(connection):
+    """Return the operations of the current transaction.
+
+    A single flush callback is registered per transaction, before the
+    operations themselves: it is discarded with the whole transaction
+    (or with the savepoint it was registered in), in which case a new
+    one is created.
+    """
+    ref = getattr(connection, "policyd_pending_operations", None)
+    pending = ref() if ref is not None else None
+    if pending is None or pending.flushed:
+        pending = PendingOperations()
+        connection.policyd_pending_operations = weakref.ref(pending)
+        transaction.on_commit(pending)
+    return pending
+
+
+def add_operation(command, *args):
+    """Send a redis command once the current transaction is committed."""
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        # Autocommit mode, send it immediately
+        getattr(utils.get_redis_connection(), command)(*args)
+        return
+    operation = Operation(command, args)
+    get_pending_operations(connection).add(operation)
+    transaction.on_commit(operation)
 
 
 def set_message_limit(instance, key):
@@ -16,19 +87,17 @@ def set_message_limit(instance, key):
     old_message_limit = instance._loaded_values.get("message_limit")
     if old_message_limit == instance.message_limit:
         return
-    rclient = redis.Redis(
-        host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_QUOTA_DB
-    )
     if instance.message_limit is None:
         # delete existing key
-        if rclient.hexists(constants.REDIS_HASHNAME, key):
-            rclient.hdel(constants.REDIS_HASHNAME, key)
+        add_operation("hdel", constants.REDIS_HASHNAME, key)
+        add_operation("hdel", constants.REDIS_LIMITS_HASHNAME, key)
         return
     if old_message_limit is not None:
         diff = instance.message_limit - old_message_limit
     else:
         diff = instance.message_limit
-    rclient.hincrby(constants.REDIS_HASHNAME, key, diff)
+    add_operation("hset", constants.REDIS_LIMITS_HASHNAME, key, instance.message_limit)
+    add_operation("hincrby", constants.REDIS_HASHNAME, key, diff)
 
 
 @receiver(signals.post_save, sender=admin_models.Domain)
@@ -41,3 +110,82 @@ def set_domain_message_limit(sender, instance, created, **kwargs):
 def set_mailbox_message_limit(sender, instance, created, **kwargs):
     """Store mailbox message limit in Redis."""
     set_message_limit(instance, instance.full_address)
+
+
+def publish_policy_change(event):
+    """Tell running daemons that policy attributes have changed.
+
+    The event is published once the current transaction is committed
+    (only if daemons maintain a policy snapshot).
+    """
+    if not utils.is_policy_snapshot_enabled():
+        return
+    add_operation("publish", constants.REDIS_POLICY_CHANNEL, event)
+
+
+def has_changed(instance, field):
+    """Tell if a field has been modified since instance was loaded."""
+    if field not in instance._loaded_values:
+        return True
+    return instance._loaded_values[field] != getattr(instance, field)
+
+
+@receiver(signals.post_save, sender=admin_models.Domain)
+def publish_domain_change(sender, instance, created, **kwargs):
+    """Publish domain changes."""
+    if not created and instance.oldname != instance.name:
+        # Addresses of all mailboxes have changed
+        publish_policy_change("reload")
+        return
+    if created or has_changed(instance, "enabled"):
+        publish_policy_change("domain:{}".format(instance.name))
+
+
+@receiver(signals.post_delete, sender=admin_models.Domain)
+def publish_domain_removal(sender, instance, **kwargs):
+    """Publish domain removal."""
+    publish_policy_change("domain:{}".format(instance.name))
+
+
+@receiver(signals.post_save, sender=admin_models.Mailbox)
+def publish_mailbox_change(sender, instance, created, **kwargs):
+    """Publish mailbox changes."""
+    if not created and instance.old_full_address != instance.full_address:
+        publish_policy_change("mailbox:{}".format(instance.old_full_address))
+    elif not created and not has_changed(instance, "is_send_only"):
+        return
+    publish_policy_change("mailbox:{}".format(instance.full_address))
+
+
+@receiver(signals.post_delete, sender=admin_models.Mailbox)
+def publish_mailbox_removal(sender, instance, **kwargs):
+    """Publish mailbox removal."""
+    publish_policy_change("mailbox:{}".format(instance.full_address))
+
+
+@receiver(signals.post_save, sender=admin_models.SenderAddress)
+@receiver(signals.post_delete, sender=admin_models.SenderAddress)
+def publish_sender_address_change(sender, instance, **kwargs):
+    """Publish changes of extra sender addresses."""
+    publish_policy_change("mailbox:{}".format(instance.mailbox.full_address))
+
+
+@receiver(signals.post_init, sender=core_models.User)
+def remember_account_status(sender, instance, **kwargs):
+    """Remember the status of an account (unless deferred)."""
+    instance._policyd_is_active = instance.__dict__.get("is_active")
+
+
+@receiver(signals.post_save, sender=core_models.User)
+def publish_account_change(sender, instance, created, update_fields, **kwargs):
+    """Publish account changes (status)."""
+    if created or not utils.is_policy_snapshot_enabled():
+        return
+    if update_fields is not None and "is_active" not in update_fields:
+        # last_login updates for example
+        return
+    if instance._policyd_is_active == instance.is_active:
+        return
+    instance._policyd_is_active = instance.is_active
+    if hasattr(instance, "mailbox"):
+        publish_policy_change("mailbox:{}".format(instance.mailbox.full_address))
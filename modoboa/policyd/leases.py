@@ -0,0 +1,160 @@
+"""Local leases of sending tokens.
+
+When several daemon instances share the same redis server, asking
+redis for each recipient can be expensive. Instead, each instance
+leases small batches of tokens per domain or account and takes
+decisions locally until its lease is exhausted or expires. Unused
+tokens are given back when a lease expires.
+
+Leased tokens can't be used by other instances, so a limit might be
+reported as reached while up to ``size * instances`` tokens are still
+leased somewhere. In the other direction, tokens leased just before
+counters are reset can still be used until their lease expires, so a
+limit can be exceeded by at most ``size`` messages per instance.
+"""
+
+import asyncio
+import logging
+
+from . import constants, metrics, scripts
+
+logger = logging.getLogger("modoboa.policyd")
+
+
+class Lease:
+    """Tokens leased for a counter."""
+
+    __slots__ = ("tokens", "limited", "remaining", "generation", "expires_at")
+
+    def __init__(self, tokens, remaining, generation, expires_at):
+        """Constructor.
+
+        :param tokens: number of leased tokens, None if no limit is defined
+        :param remaining: value of the shared counter after the lease
+        :param generation: generation of counters
+        :param expires_at: loop time at which the lease expires
+        """
+        self.limited = tokens is not None
+        self.tokens = tokens or 0
+        self.remaining = remaining or 0
+        self.generation = generation
+        self.expires_at = expires_at
+
+    @property
+    def exhausted(self):
+        """Tell if the shared counter was empty when lease was granted."""
+        return self.limited and not self.tokens and self.remaining <= 0
+
+
+class LeaseManager:
+    """Manage the leases of a daemon instance."""
+
+    def __init__(self, rclient, size, duration):
+        """Constructor.
+
+        :param rclient: redis client
+        :param int size: maximum number of tokens leased per counter
+        :param int duration: lease duration (in seconds)
+        """
+        self.rclient = rclient
+        self.size = size
+        self.duration = duration
+        self.leases = {}
+        self.generation = None
+        self._lease_script = rclient.register_script(scripts.LEASE_TOKENS)
+        self._return_script = rclient.register_script(scripts.RETURN_TOKENS)
+
+    def needs_lease(self, name, now):
+        """Tell if a new lease is required for name."""
+        lease = self.leases.get(name)
+        if lease is None or lease.expires_at <= now:
+            return True
+        return lease.limited and not lease.tokens and not lease.exhausted
+
+    async def acquire(self, names):
+        """Lease tokens for the given names."""
+        with metrics.REDIS_DURATION.time():
+            result = await self._lease_script(
+                keys=[constants.REDIS_HASHNAME, constants.REDIS_GENERATION_KEY],
+                args=[self.size] + names,
+            )
+        generation = result[0]
+        if generation != self.generation:
+            # Counters have been reset, our tokens are not valid anymore
+            self.leases = {}
+            self.generation = generation
+        now = asyncio.get_running_loop().time()
+        expired = {}
+        for index, name in enumerate(names):
+            tokens, remaining = result[index * 2 + 1 : index * 2 + 3]
+            lease = self.leases.get(name)
+            if lease is not None and lease.tokens:
+                if lease.expires_at > now:
+                    # Another request leased tokens in the meantime
+                    tokens = (tokens or 0) + lease.tokens
+                else:
+                    expired[name] = lease.tokens
+            self.leases[name] = Lease(
+                tokens, remaining, generation, now + self.duration
+            )
+        if expired:
+            await self.give_back(generation, expired)
+
+    async def check(self, names):
+        """Check and consume a token for each name.
+
+        :return: a tuple (allowed, counters) where counters is a list
+                 containing the estimated remaining value of each
+                 counter (None if there is no limit defined)
+        """
+        now = asyncio.get_running_loop().time()
+        missing = [name for name in names if self.needs_lease(name, now)]
+        while missing:
+            await self.acquire(missing)
+            # Leases are dropped when counters have been reset
+            missing = [name for name in names if name not in self.leases]
+        leases = [self.leases[name] for name in names]
+        allowed = all(lease.tokens > 0 for lease in leases if lease.limited)
+        counters = []
+        for lease in leases:
+            if not lease.limited:
+                counters.append(None)
+                continue
+            if allowed:
+                lease.tokens -= 1
+            counters.append(lease.tokens + lease.remaining)
+        return allowed, counters
+
+    async def give_back(self, generation, tokens):
+        """Give unused tokens back."""
+        args = [generation]
+        for name, count in tokens.items():
+            args += [name, count]
+        with metrics.REDIS_DURATION.time():
+            await self._return_script(
+                keys=[constants.REDIS_HASHNAME, constants.REDIS_GENERATION_KEY],
+                args=args,
+            )
+
+    async def release(self, expired_only=False):
+        """Release leases and give unused tokens back."""
+        now = asyncio.get_running_loop().time()
+        tokens = {}
+        for name, lease in list(self.leases.items()):
+            if expired_only and lease.expires_at > now:
+                continue
+            del self.leases[name]
+            if lease.tokens and lease.generation == self.generation:
+                tokens[name] = lease.tokens
+        if tokens:
+            logger.debug("Giving back unused tokens for %d counter(s)", len(tokens))
+            await self.give_back(self.generation, tokens)
+
+    async def run(self):
+        """Periodically release expired leases."""
+        while True:
+            await asyncio.sleep(self.duration)
+            try:
+                await self.release(expired_only=True)
+            except Exception:
+                logger.exception("Failed to release expired leases")
@@ -6,16 +6,26 @@ import functools
 import logging
 import signal
 
+from django import db
 from django.core.management.base import BaseCommand
 
-from ... import core
+from ... import core, metrics
+from ...supervisor import Supervisor
 
 logger = logging.getLogger("modoboa.policyd")
 
 
-def ask_exit(signame, loop):
-    """Stop event loop."""
-    loop.stop()
+def ask_exit(signame, loop, servers, timeout):
+    """Stop accepting connections then stop event loop.
+
+    Listening sockets (including the metrics one) are released
+    immediately so a new worker can take over during a reload.
+    """
+    logger.info("Received {}, stopping...".format(signame))
+    for server in servers:
+        server.close()
+    future = asyncio.ensure_future(core.close_connections(timeout))
+    future.add_done_callback(lambda f: loop.stop())
 
 
 class Command(BaseCommand):
@@ -27,22 +37,96 @@ class Command(BaseCommand):
         """Add command line arguments."""
         parser.add_argument("--host", type=str, default="localhost")
         parser.add_argument("--port", type=int, default=9999)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes sharing the listening socket",
+        )
+        parser.add_argument(
+            "--idle-timeout",
+            type=int,
+            default=core.IDLE_TIMEOUT,
+            help="Delay (in seconds) after which an idle connection is closed",
+        )
+        parser.add_argument(
+            "--max-requests",
+            type=int,
+            default=core.MAX_REQUESTS,
+            help="Maximum number of requests accepted on a single connection",
+        )
+        parser.add_argument(
+            "--graceful-timeout",
+            type=int,
+            default=10,
+            help="Delay (in seconds) given to pending requests on shutdown",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=None,
+            help=(
+                "Expose metrics on this port (when several workers are "
+                "started, worker N listens on port + N)"
+            ),
+        )
+        parser.add_argument(
+            "--metrics-host",
+            type=str,
+            default="localhost",
+            help="Address the metrics listener is bound to",
+        )
         parser.add_argument("--debug", action="store_true", help="Enable debug mode")
 
-    def handle(self, *args, **options):
-        """Entry point."""
-        loop = asyncio.get_event_loop()
+    def serve(self, options, index=0):
+        """Run the event loop until asked to stop."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
         coro = asyncio.start_server(
-            core.new_connection, options["host"], options["port"]
+            functools.partial(
+                core.new_connection,
+                idle_timeout=options["idle_timeout"],
+                max_requests=options["max_requests"],
+            ),
+            options["host"],
+            options["port"],
+            reuse_port=options["workers"] > 1,
         )
         server = loop.run_until_complete(coro)
+        # Create the connection pool shared by all connections
+        core.get_redis_client()
+        core.start_leases_coro()
+        core.start_policy_snapshot_coro()
+
+        metrics_server = None
+        if options["metrics_port"] is not None:
+            metrics_server = loop.run_until_complete(
+                asyncio.start_server(
+                    metrics.handle_connection,
+                    options["metrics_host"],
+                    options["metrics_port"] + index,
+                    # Shared with the worker replacing this one during
+                    # a reload
+                    reuse_port=options["workers"] > 1,
+                )
+            )
+            logger.info(
+                "Exposing metrics on {}".format(metrics_server.sockets[0].getsockname())
+            )
 
-        # Schedule reset task
-        core.start_reset_counters_coro()
+        # Schedule reset task (only in the first worker)
+        if index == 0:
+            core.start_reset_counters_coro()
 
+        servers = [server]
+        if metrics_server is not None:
+            servers.append(metrics_server)
         for signame in {"SIGINT", "SIGTERM"}:
             loop.add_signal_handler(
-                getattr(signal, signame), functools.partial(ask_exit, signame, loop)
+                getattr(signal, signame),
+                functools.partial(
+                    ask_exit, signame, loop, servers, options["graceful_timeout"]
+                ),
             )
 
         logger.info("Serving on {}".format(server.sockets[0].getsockname()))
@@ -57,6 +141,11 @@ class Command(BaseCommand):
         # Close the server
         server.close()
         loop.run_until_complete(server.wait_closed())
+        if metrics_server is not None:
+            metrics_server.close()
+            loop.run_until_complete(metrics_server.wait_closed())
+        # Send pending notifications
+        loop.run_until_complete(core.close_notification_dispatcher())
         # Cancel pending tasks
         for task in asyncio.all_tasks(loop):
             task.cancel()
@@ -64,4 +153,22 @@ class Command(BaseCommand):
             # raises asyncio.CancelledError that we can suppress
             with suppress(asyncio.CancelledError):
                 loop.run_until_complete(task)
+        loop.run_until_complete(core.release_leases())
+        loop.run_until_complete(core.close_redis_client())
         loop.close()
+
+    def handle(self, *args, **options):
+        """Entry point."""
+        if options["workers"] <= 1:
+            self.serve(options)
+            return
+        # Connections must not be shared with workers
+        db.connections.close_all()
+        # Workers are given a bit more time than their own timeout
+        # to exit.
+        supervisor = Supervisor(
+            lambda index: self.serve(options, index),
+            options["workers"],
+            options["graceful_timeout"] + 1,
+        )
+        supervisor.run()
@@ -0,0 +1,137 @@
+"""Policy daemon benchmark management command."""
+
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import benchmark, core
+
+
+class Command(BaseCommand):
+    """Send policy requests to a daemon and report latencies."""
+
+    help = "Measure the throughput and latency of the policy daemon"
+
+    def add_arguments(self, parser):
+        """Add command line arguments."""
+        parser.add_argument(
+            "--host", type=str, default="localhost", help="Address of the daemon"
+        )
+        parser.add_argument("--port", type=int, default=9999, help="Port of the daemon")
+        parser.add_argument(
+            "--in-process",
+            action="store_true",
+            help="Start a daemon inside this process instead of using a running one",
+        )
+        parser.add_argument(
+            "--fake-redis",
+            action="store_true",
+            help="Use an in-memory fake redis (requires fakeredis, implies "
+            "--in-process)",
+        )
+        parser.add_argument(
+            "--requests", type=int, default=10000, help="Number of requests to send"
+        )
+        parser.add_argument(
+            "--connections",
+            type=int,
+            default=50,
+            help="Number of concurrent connections",
+        )
+        parser.add_argument(
+            "--requests-per-connection",
+            type=int,
+            default=100,
+            help="Number of requests sent before a connection is reopened",
+        )
+        parser.add_argument(
+            "--senders", type=int, default=1000, help="Number of distinct senders"
+        )
+        parser.add_argument(
+            "--domains", type=int, default=100, help="Number of sender domains"
+        )
+        parser.add_argument(
+            "--limited-ratio",
+            type=float,
+            default=0.5,
+            help="Part of senders and domains having a sending limit",
+        )
+        parser.add_argument(
+            "--unauthenticated-ratio",
+            type=float,
+            default=0.0,
+            help="Part of requests sent without authentication",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=1000000,
+            help="Sending limit of limited senders and domains",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=None, help="Seed of the random generator"
+        )
+
+    async def run(self, options):
+        """Prepare and run the benchmark."""
+        if options["fake_redis"]:
+            try:
+                from fakeredis import aioredis as fake_aioredis
+            except ImportError as exc:
+                raise CommandError("fakeredis is required to use --fake-redis") from exc
+            core.set_redis_client(fake_aioredis.FakeRedis(decode_responses=True))
+        scenario = benchmark.Scenario(
+            senders=options["senders"],
+            domains=options["domains"],
+            limited_ratio=options["limited_ratio"],
+            unauthenticated_ratio=options["unauthenticated_ratio"],
+            limit=options["limit"],
+            seed=options["seed"],
+        )
+        requests = scenario.build_requests(options["requests"])
+        rclient = core.get_redis_client()
+        await scenario.setup(rclient)
+        server = None
+        host, port = options["host"], options["port"]
+        try:
+            if options["in_process"] or options["fake_redis"]:
+                host = "127.0.0.1"
+                server, port = await benchmark.start_local_daemon(host)
+            bench = benchmark.Benchmark(
+                host,
+                port,
+                requests,
+                connections=options["connections"],
+                requests_per_connection=options["requests_per_connection"],
+            )
+            results = await bench.run()
+        finally:
+            if server is not None:
+                await benchmark.stop_local_daemon(server)
+            await scenario.cleanup(rclient)
+            await core.close_redis_client()
+        return results
+
+    def handle(self, *args, **options):
+        """Entry point."""
+        results = asyncio.run(self.run(options))
+        self.stdout.write(
+            "Requests: {requests} ({errors} errors) in {duration:.2f}s".format(
+                **results
+            )
+        )
+        self.stdout.write("Throughput: {throughput:.0f} requests/s".format(**results))
+        if results["requests"]:
+            self.stdout.write(
+                "Latency: p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms max={:.2f}ms".format(
+                    *[results[name] * 1000 for name in ["p50", "p95", "p99", "max"]]
+                )
+            )
+        self.stdout.write(
+            "Actions: {}".format(
+                ", ".join(
+                    "{}={}".format(action, count)
+                    for action, count in sorted(results["actions"].items())
+                )
+            )
+        )
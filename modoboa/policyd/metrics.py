@@ -0,0 +1,249 @@
+"""Metrics of the policy daemon.
+
+Metrics are exposed using the Prometheus text exposition format.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger("modoboa.policyd")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+)
+
+REGISTRY = []
+
+
+def escape_label_value(value):
+    """Escape a label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    """Format a label set."""
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(name, escape_label_value(value)) for name, value in labels
+        )
+    )
+
+
+def format_value(value):
+    """Format a sample value."""
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """Base class for metrics."""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """Constructor."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def get_key(self, labels):
+        """Return the key of a label set."""
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "Expected labels {}, got {}".format(self.labelnames, tuple(labels))
+            )
+        return tuple(labels[name] for name in self.labelnames)
+
+    def get_samples(self):
+        """Return a list of (suffix, labels, value) tuples."""
+        return [
+            ("", list(zip(self.labelnames, key)), value)
+            for key, value in self.values.items()
+        ]
+
+    def render(self):
+        """Return the text representation of this metric."""
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type_name),
+        ]
+        for suffix, labels, value in self.get_samples():
+            lines.append(
+                "{}{}{} {}".format(
+                    self.name, suffix, format_labels(labels), format_value(value)
+                )
+            )
+        return "\n".join(lines)
+
+    def reset(self):
+        """Reset all values."""
+        self.values = {}
+
+
+class Counter(Metric):
+    """A value which can only increase."""
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value which can go up and down."""
+
+    type_name = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.labelnames:
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.values[self.get_key(labels)] = value
+
+    def reset(self):
+        super().reset()
+        if not self.labelnames:
+            self.values[()] = 0
+
+
+class Histogram(Metric):
+    """Distribution of observed values."""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        if key not in self.values:
+            self.values[key] = {
+                "buckets": [0] * len(self.buckets),
+                "sum": 0,
+                "count": 0,
+            }
+        data = self.values[key]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                data["buckets"][index] += 1
+        data["sum"] += value
+        data["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the execution time of a block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_samples(self):
+        samples = []
+        for key, data in self.values.items():
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, data["buckets"]):
+                samples.append(
+                    ("_bucket", labels + [("le", format_value(bound))], count)
+                )
+            samples.append(("_sum", labels, data["sum"]))
+            samples.append(("_count", labels, data["count"]))
+        return samples
+
+
+def render():
+    """Return all metrics in text format."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+async def handle_connection(reader, writer):
+    """Answer a metrics request (HTTP)."""
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        request = b""
+    except asyncio.TimeoutError:
+        logger.warning("Timeout received while reading metrics request")
+        request = b""
+    try:
+        method, path = request.decode("latin-1").split(" ", 2)[:2]
+    except ValueError:
+        method, path = None, None
+    if method == "GET" and path.split("?")[0] == "/metrics":
+        status = "200 OK"
+        body = render().encode()
+    else:
+        status = "404 Not Found"
+        body = b"Not Found\n"
+    writer.write(
+        "HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+            status, CONTENT_TYPE, len(body)
+        ).encode()
+        + body
+    )
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+REQUESTS = Counter(
+    "policyd_requests_total",
+    "Number of policy requests handled, by protocol state and action.",
+    ["state", "action"],
+)
+DECISION_DURATION = Histogram(
+    "policyd_decision_duration_seconds",
+    "Time spent to take decisions about policy requests.",
+)
+REDIS_DURATION = Histogram(
+    "policyd_redis_duration_seconds",
+    "Duration of round trips to redis.",
+)
+OPEN_CONNECTIONS = Gauge(
+    "policyd_open_connections",
+    "Number of open connections.",
+)
+CONNECTION_TIMEOUTS = Counter(
+    "policyd_connection_timeouts_total",
+    "Number of requests which timed out.",
+)
+LIMIT_REACHED_NOTIFICATIONS = Counter(
+    "policyd_limit_reached_notifications_total",
+    "Number of limit reached notifications, by limit type.",
+    ["type"],
+)
@@ -0,0 +1,220 @@
+"""Limit reached notifications."""
+
+import asyncio
+import concurrent.futures
+import datetime
+from email.message import EmailMessage
+import logging
+
+import aiosmtplib
+
+from django.db import DatabaseError, connections
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils import translation
+from django.utils.translation import gettext as _, gettext_lazy
+
+from modoboa.admin import models as admin_models
+from modoboa.core import models as core_models
+from modoboa.lib.email_utils import split_mailbox
+
+from . import constants, metrics
+
+logger = logging.getLogger("modoboa.policyd")
+
+
+def create_alarm(ltype, name):
+    """Create a new alarm."""
+    title = _("Daily sending limit reached")
+    internal_name = "sending_limit"
+    if ltype == "domain":
+        domain = admin_models.Domain.objects.get(name=name)
+        domain.alarms.create(title=title, internal_name=internal_name)
+    else:
+        localpart, domain = split_mailbox(name)
+        mailbox = admin_models.Mailbox.objects.get(
+            address=localpart, domain__name=domain
+        )
+        mailbox.alarms.create(
+            domain=mailbox.domain, title=title, internal_name=internal_name
+        )
+
+
+def prepare_notifications(items):
+    """Create alarms and build notification messages for items.
+
+    Executed in a dedicated thread which keeps its database connection
+    open between calls.
+
+    :param list items: list of (type, name) tuples
+    :return: a list of EmailMessage
+    """
+    ltype_translations = {
+        "account": gettext_lazy("account"),
+        "domain": gettext_lazy("domain"),
+    }
+    known_items = []
+    try:
+        for ltype, name in items:
+            try:
+                create_alarm(ltype, name)
+            except (
+                admin_models.Domain.DoesNotExist,
+                admin_models.Mailbox.DoesNotExist,
+            ):
+                logger.warning("Can't create alarm for unknown %s %s", ltype, name)
+                continue
+            known_items.append((ltype, name))
+        if not known_items:
+            return []
+        lc = core_models.LocalConfig.objects.first()
+        recipients = list(
+            core_models.User.objects.filter(is_superuser=True, mailbox__isnull=False)
+        )
+    except DatabaseError:
+        # Connection might be broken, a new one will be opened next time
+        for conn in connections.all():
+            conn.close()
+        raise
+    sender = lc.parameters.get_value("sender_address", app="core")
+    messages = []
+    for recipient in recipients:
+        for ltype, name in known_items:
+            with translation.override(recipient.language):
+                content = render_to_string(
+                    "policyd/notifications/limit_reached.html",
+                    {"ltype": ltype_translations[ltype], "name": name},
+                )
+                subject = _("[modoboa] Sending limit reached")
+            msg = EmailMessage()
+            msg["From"] = sender
+            msg["To"] = recipient.email
+            msg["Subject"] = subject
+            msg.set_content(content)
+            messages.append(msg)
+    return messages
+
+
+def close_thread_connections():
+    """Close database connections opened by the current thread."""
+    for conn in connections.all():
+        conn.close()
+
+
+class NotificationDispatcher:
+    """Send limit reached notifications to super administrators.
+
+    A notification is sent only once per limit and per day: a marker
+    expiring at midnight is stored in Redis, so it is shared by all
+    workers and survives reloads (each process also remembers what it
+    has already queued). Pending notifications are processed in batches
+    by a single task, using a long-lived thread (to keep the same
+    database connection) and a single SMTP session per batch. When too
+    many notifications are pending, new ones are dropped so policy
+    requests are never slowed down.
+    """
+
+    def __init__(
+        self, rclient, max_pending=100, smtp_hostname="localhost", smtp_port=25
+    ):
+        """Constructor.
+
+        :param rclient: redis client
+        """
+        self.rclient = rclient
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.smtp_hostname = smtp_hostname
+        self.smtp_port = smtp_port
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.day = None
+        self.seen = set()
+        self.task = None
+
+    def notify(self, ltype, name):
+        """Queue a new notification.
+
+        :return: True if notification has been queued, False otherwise
+        """
+        today = timezone.localdate()
+        if today != self.day:
+            self.day = today
+            self.seen = set()
+        if (ltype, name) in self.seen:
+            return False
+        try:
+            self.queue.put_nowait((ltype, name))
+        except asyncio.QueueFull:
+            logger.warning(
+                "Too many pending notifications, dropping the one for %s %s",
+                ltype,
+                name,
+            )
+            return False
+        self.seen.add((ltype, name))
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return True
+
+    async def claim(self, items):
+        """Return the items which have not been notified today yet.
+
+        Markers are set for the returned items.
+        """
+        today = timezone.localdate()
+        tomorrow = today + datetime.timedelta(days=1)
+        midnight = timezone.make_aware(
+            datetime.datetime.combine(tomorrow, datetime.time())
+        )
+        ttl = max(int((midnight - timezone.now()).total_seconds()), 1)
+        async with self.rclient.pipeline(transaction=False) as pipeline:
+            for ltype, name in items:
+                key = "{}:{}:{}:{}".format(
+                    constants.REDIS_NOTIFICATION_PREFIX,
+                    today.strftime("%Y%m%d"),
+                    ltype,
+                    name,
+                )
+                pipeline.set(key, 1, nx=True, ex=ttl)
+            results = await pipeline.execute()
+        return [item for item, claimed in zip(items, results) if claimed]
+
+    async def send_messages(self, messages):
+        """Send messages using a single SMTP session."""
+        if not messages:
+            return
+        smtp = aiosmtplib.SMTP(hostname=self.smtp_hostname, port=self.smtp_port)
+        async with smtp:
+            for msg in messages:
+                await smtp.send_message(msg)
+
+    async def process(self, items):
+        """Process a batch of notifications."""
+        loop = asyncio.get_running_loop()
+        messages = await loop.run_in_executor(
+            self.executor, prepare_notifications, items
+        )
+        await self.send_messages(messages)
+
+    async def run(self):
+        """Process pending notifications."""
+        while not self.queue.empty():
+            items = []
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            try:
+                items = await self.claim(items)
+                if not items:
+                    continue
+                for ltype, name in items:
+                    metrics.LIMIT_REACHED_NOTIFICATIONS.inc(type=ltype)
+                await self.process(items)
+            except Exception:
+                logger.exception("Failed to send limit reached notifications")
+
+    async def close(self):
+        """Wait for pending notifications and release resources."""
+        if self.task is not None and not self.task.done():
+            await self.task
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, close_thread_connections)
+        self.executor.shutdown(wait=False)
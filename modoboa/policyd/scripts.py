@@ -0,0 +1,132 @@
+"""Lua scripts executed server-side by Redis."""
+
+# Check and decrement sending counters in a single round trip.
+#
+# KEYS[1]: name of the hash storing counters
+# ARGV: names of the counters to check (domain, account...)
+#
+# Counters that do not exist are ignored. If one of the existing
+# counters is exhausted, nothing is decremented. Return a list
+# starting with 1 (allowed) or 0 (denied), followed by the (remaining)
+# value of each counter or nil when it does not exist.
+CHECK_AND_DECREMENT_LIMITS = """
+local allowed = 1
+local counters = {}
+for i = 1, #ARGV do
+  local value = redis.call("HGET", KEYS[1], ARGV[i])
+  if value then
+    value = tonumber(value)
+    if value <= 0 then
+      allowed = 0
+    end
+    counters[i] = value
+  else
+    counters[i] = false
+  end
+end
+if allowed == 1 then
+  for i = 1, #ARGV do
+    if counters[i] then
+      counters[i] = redis.call("HINCRBY", KEYS[1], ARGV[i], -1)
+    end
+  end
+end
+table.insert(counters, 1, allowed)
+return counters
+"""
+
+# Check and increment windowed counters in a single round trip.
+#
+# KEYS[1]: name of the hash storing message limits
+# KEYS[2..n]: counter key of each name for the current window
+# ARGV[1]: timestamp at which the current window ends
+# ARGV[2..n]: names of the counters to check (domain, account...)
+#
+# Names without limit are ignored. A counter key is created (with an
+# expiration) when the first message is sent during the window. If one
+# of the limits is reached, nothing is incremented. The returned value
+# has the same format as the one of CHECK_AND_DECREMENT_LIMITS.
+CHECK_AND_INCREMENT_WINDOW_COUNTERS = """
+local allowed = 1
+local limits = {}
+local counters = {}
+for i = 2, #ARGV do
+  local limit = redis.call("HGET", KEYS[1], ARGV[i])
+  if limit then
+    limits[i] = tonumber(limit)
+    counters[i - 1] = limits[i] - tonumber(redis.call("GET", KEYS[i]) or "0")
+    if counters[i - 1] <= 0 then
+      allowed = 0
+    end
+  else
+    counters[i - 1] = false
+  end
+end
+if allowed == 1 then
+  for i = 2, #ARGV do
+    if limits[i] then
+      local sent = redis.call("INCR", KEYS[i])
+      if sent == 1 then
+        redis.call("EXPIREAT", KEYS[i], ARGV[1])
+      end
+      counters[i - 1] = limits[i] - sent
+    end
+  end
+end
+table.insert(counters, 1, allowed)
+return counters
+"""
+
+# Lease sending tokens from counters stored in a hash.
+#
+# KEYS[1]: name of the hash storing counters
+# KEYS[2]: name of the key storing counters generation
+# ARGV[1]: maximum number of tokens to lease per counter
+# ARGV[2..n]: names of the counters (domain, account...)
+#
+# Return a list starting with the current generation (incremented
+# each time counters are reset), followed by two values per name: the
+# number of leased tokens and the value of the counter after the
+# lease (both nil if the counter does not exist).
+LEASE_TOKENS = """
+local generation = tonumber(redis.call("GET", KEYS[2]) or "0")
+local result = {generation}
+for i = 2, #ARGV do
+  local value = redis.call("HGET", KEYS[1], ARGV[i])
+  if value then
+    value = tonumber(value)
+    local granted = math.max(math.min(value, tonumber(ARGV[1])), 0)
+    if granted > 0 then
+      value = redis.call("HINCRBY", KEYS[1], ARGV[i], -granted)
+    end
+    table.insert(result, granted)
+    table.insert(result, value)
+  else
+    table.insert(result, false)
+    table.insert(result, false)
+  end
+end
+return result
+"""
+
+# Give unused leased tokens back.
+#
+# KEYS[1]: name of the hash storing counters
+# KEYS[2]: name of the key storing counters generation
+# ARGV[1]: generation of the leases
+# ARGV[2..n]: pairs of counter name and number of tokens
+#
+# Tokens leased before counters were reset are dropped. Return 1 if
+# tokens were given back, 0 otherwise.
+RETURN_TOKENS = """
+local generation = tonumber(redis.call("GET", KEYS[2]) or "0")
+if generation ~= tonumber(ARGV[1]) then
+  return 0
+end
+for i = 2, #ARGV, 2 do
+  if redis.call("HEXISTS", KEYS[1], ARGV[i]) == 1 then
+    redis.call("HINCRBY", KEYS[1], ARGV[i], ARGV[i + 1])
+  end
+end
+return 1
+"""
@@ -0,0 +1,160 @@
+"""In-memory snapshot of policy related attributes.
+
+The snapshot contains the attributes of domains and mailboxes that
+policy checks might need (domain status, send-only mailboxes, extra
+sender addresses...), so they can be evaluated without querying the
+database.
+
+It is loaded once at startup and then kept up to date using change
+events published on a redis channel by the signal handlers of this
+application. An event is a string with one of the following formats:
+
+* ``domain:<name>``: reload the given domain
+* ``mailbox:<address>``: reload the given mailbox
+* ``reload``: reload everything (used when a domain is renamed)
+
+Methods of this class access the database, so they must be called
+from a thread when running inside the event loop.
+
+No check uses the snapshot yet, so it is only maintained (and events
+only published) when the ``POLICYD_POLICY_SNAPSHOT`` setting is True.
+"""
+
+import sys
+
+from modoboa.admin import models as admin_models
+from modoboa.lib.email_utils import split_mailbox
+
+MAILBOX_ACTIVE = 1
+MAILBOX_SEND_ONLY = 2
+
+
+def get_mailbox_flags(is_active, is_send_only):
+    """Return the flags of a mailbox."""
+    flags = 0
+    if is_active:
+        flags |= MAILBOX_ACTIVE
+    if is_send_only:
+        flags |= MAILBOX_SEND_ONLY
+    return flags
+
+
+class PolicySnapshot:
+    """Policy related attributes of domains and mailboxes."""
+
+    def __init__(self):
+        """Constructor."""
+        # Domain name -> enabled
+        self.domains = {}
+        # Mailbox address -> flags
+        self.mailboxes = {}
+        # Mailbox address -> frozenset of extra sender addresses (only
+        # for mailboxes having some)
+        self.sender_addresses = {}
+
+    def load(self):
+        """Load everything from the database."""
+        domains = {
+            sys.intern(name): enabled
+            for name, enabled in admin_models.Domain.objects.values_list(
+                "name", "enabled"
+            )
+        }
+        mailboxes = {}
+        qset = admin_models.Mailbox.objects.values_list(
+            "address", "domain__name", "user__is_active", "is_send_only"
+        )
+        for address, domain, is_active, is_send_only in qset.iterator(chunk_size=5000):
+            mailboxes["{}@{}".format(address, domain)] = get_mailbox_flags(
+                is_active, is_send_only
+            )
+        sender_addresses = {}
+        qset = admin_models.SenderAddress.objects.values_list(
+            "mailbox__address", "mailbox__domain__name", "address"
+        )
+        for address, domain, sender in qset.iterator(chunk_size=5000):
+            sender_addresses.setdefault("{}@{}".format(address, domain), set()).add(
+                sender
+            )
+        self.domains = domains
+        self.mailboxes = mailboxes
+        self.sender_addresses = {
+            address: frozenset(senders) for address, senders in sender_addresses.items()
+        }
+
+    def refresh_domain(self, name):
+        """Reload the attributes of a domain."""
+        enabled = (
+            admin_models.Domain.objects.filter(name=name)
+            .values_list("enabled", flat=True)
+            .first()
+        )
+        if enabled is None:
+            self.domains.pop(name, None)
+        else:
+            self.domains[sys.intern(name)] = enabled
+
+    def refresh_mailbox(self, address):
+        """Reload the attributes of a mailbox."""
+        localpart, domain = split_mailbox(address)
+        row = (
+            admin_models.Mailbox.objects.filter(address=localpart, domain__name=domain)
+            .values_list("pk", "user__is_active", "is_send_only")
+            .first()
+        )
+        if row is None:
+            self.mailboxes.pop(address, None)
+            self.sender_addresses.pop(address, None)
+            return
+        self.mailboxes[address] = get_mailbox_flags(row[1], row[2])
+        senders = frozenset(
+            admin_models.SenderAddress.objects.filter(mailbox=row[0]).values_list(
+                "address", flat=True
+            )
+        )
+        if senders:
+            self.sender_addresses[address] = senders
+        else:
+            self.sender_addresses.pop(address, None)
+
+    def refresh(self, event):
+        """Apply a change event."""
+        kind, _sep, key = event.partition(":")
+        if kind == "domain":
+            self.refresh_domain(key)
+        elif kind == "mailbox":
+            self.refresh_mailbox(key)
+        else:
+            self.load()
+
+    def is_domain_enabled(self, name):
+        """Tell if domain is enabled (None if unknown)."""
+        return self.domains.get(name)
+
+    def get_mailbox_flags(self, address):
+        """Return the flags of a mailbox (None if unknown)."""
+        return self.mailboxes.get(address)
+
+    def is_mailbox_active(self, address):
+        """Tell if mailbox exists and is active."""
+        return bool(self.mailboxes.get(address, 0) & MAILBOX_ACTIVE)
+
+    def is_send_only(self, address):
+        """Tell if mailbox is a send-only one."""
+        return bool(self.mailboxes.get(address, 0) & MAILBOX_SEND_ONLY)
+
+    def is_sender_allowed(self, login, sender):
+        """Tell if login is allowed to use sender as envelope sender.
+
+        Only the address of the mailbox and its extra sender addresses
+        (including ``@domain`` wildcards) are considered, not aliases.
+        """
+        if sender == login:
+            return True
+        allowed = self.sender_addresses.get(login)
+        if not allowed:
+            return False
+        if sender in allowed:
+            return True
+        domain = sender.rpartition("@")[2]
+        return "@{}".format(domain) in allowed
@@ -0,0 +1,173 @@
+"""Pre-fork supervisor for the policy daemon."""
+
+import errno
+import logging
+import os
+import select
+import signal
+import time
+
+logger = logging.getLogger("modoboa.policyd")
+
+
+class Supervisor:
+    """Spawn and watch a fixed number of worker processes.
+
+    Workers are forked from the current process and are expected to
+    share the same listening address (using SO_REUSEPORT). A dead
+    worker is automatically replaced.
+
+    Signals:
+
+    * SIGHUP: spawn a new generation of workers then gracefully stop
+      the old one (zero-downtime reload)
+    * SIGINT/SIGTERM: gracefully stop all workers and exit
+    """
+
+    # Minimum delay (in seconds) between two spawns of the same worker
+    respawn_delay = 1
+
+    def __init__(self, target, workers, graceful_timeout=10):
+        """Constructor.
+
+        :param target: callable executed by each worker, it receives
+                       the worker index (from 0 to workers - 1)
+        :param int workers: number of workers to maintain
+        :param int graceful_timeout: delay given to workers to exit
+        """
+        self.target = target
+        self.workers_count = workers
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}
+        self.retiring = {}
+        self.spawned_at = {}
+        self.signals = []
+        self.stopping = False
+
+    def spawn_worker(self, index):
+        """Fork a new worker process."""
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = index
+            self.spawned_at[index] = time.monotonic()
+            logger.info("Worker %d started (pid: %d)", index, pid)
+            return
+        # We are inside the worker
+        code = 0
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            os.close(self.wakeup_fds[0])
+            os.close(self.wakeup_fds[1])
+            self.target(index)
+        except Exception:
+            logger.exception("Worker %d crashed", index)
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def spawn_workers(self):
+        """Spawn missing workers."""
+        running = set(self.workers.values())
+        now = time.monotonic()
+        for index in range(self.workers_count):
+            if index in running:
+                continue
+            if now - self.spawned_at.get(index, 0) < self.respawn_delay:
+                continue
+            self.spawn_worker(index)
+
+    def kill_workers(self, pids, signum=signal.SIGTERM):
+        """Send a signal to the given workers."""
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    raise
+
+    def reap_workers(self):
+        """Collect exited workers."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid in self.retiring:
+                del self.retiring[pid]
+                continue
+            index = self.workers.pop(pid, None)
+            if index is not None and not self.stopping:
+                logger.warning(
+                    "Worker %d (pid: %d) exited unexpectedly with status %d",
+                    index,
+                    pid,
+                    status,
+                )
+
+    def reload(self):
+        """Replace all workers by new ones."""
+        logger.info("Reloading workers")
+        old_workers = self.workers
+        self.workers = {}
+        self.spawned_at = {}
+        self.spawn_workers()
+        self.retiring.update(old_workers)
+        self.kill_workers(old_workers.keys())
+
+    def stop(self):
+        """Gracefully stop all workers."""
+        self.stopping = True
+        logger.info("Stopping workers")
+        pids = list(self.workers.keys()) + list(self.retiring.keys())
+        self.kill_workers(pids)
+        limit = time.monotonic() + self.graceful_timeout
+        while time.monotonic() < limit:
+            self.reap_workers()
+            if not self.workers and not self.retiring:
+                return
+            time.sleep(0.1)
+        pids = list(self.workers.keys()) + list(self.retiring.keys())
+        logger.warning("Killing %d remaining worker(s)", len(pids))
+        self.kill_workers(pids, signal.SIGKILL)
+        self.reap_workers()
+
+    def handle_signal(self, signum, frame):
+        """Queue received signal."""
+        self.signals.append(signum)
+
+    def run(self):
+        """Supervisor main loop."""
+        self.wakeup_fds = os.pipe()
+        for fd in self.wakeup_fds:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup_fds[1])
+        for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+            signal.signal(signum, self.handle_signal)
+        self.spawn_workers()
+        try:
+            while True:
+                select.select([self.wakeup_fds[0]], [], [], self.respawn_delay)
+                try:
+                    while os.read(self.wakeup_fds[0], 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                while self.signals:
+                    signum = self.signals.pop(0)
+                    if signum in (signal.SIGINT, signal.SIGTERM):
+                        self.stop()
+                        return
+                    if signum == signal.SIGHUP:
+                        self.reload()
+                self.reap_workers()
+                self.spawn_workers()
+        finally:
+            signal.set_wakeup_fd(-1)
+            os.close(self.wakeup_fds[0])
+            os.close(self.wakeup_fds[1])
@@ -2,18 +2,25 @@
 
 import asyncio
 from aiosmtplib import send
+from asgiref.sync import async_to_sync
+from unittest import mock
 from unittest.mock import AsyncMock
 from multiprocessing import Process
+import os
+import signal
 import socket
 import time
 
 import redis
+from redis import asyncio as aioredis
 
 from django import db
 from django.conf import settings
 from django.core.management import call_command
-from django.test import TransactionTestCase
+from django.db import DatabaseError, transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
 from modoboa.admin import factories as admin_factories
 from modoboa.admin import models as admin_models
@@ -21,11 +28,11 @@ from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase, ParametersMixin
 from modoboa.policyd import core as policyd_core
 
-from . import constants
+from . import benchmark, constants, metrics, notifications, snapshot, utils
 
 
-def start_policy_daemon():
-    call_command("policy_daemon")
+def start_policy_daemon(*args):
+    call_command("policy_daemon", *args)
 
 
 class RedisTestCaseMixin:
@@ -39,7 +46,19 @@ class RedisTestCaseMixin:
             db=settings.REDIS_QUOTA_DB,
         )
         self.rclient.set_response_callback("HGET", int)
-        self.rclient.delete(constants.REDIS_HASHNAME)
+        self.rclient.delete(
+            constants.REDIS_HASHNAME,
+            constants.REDIS_GENERATION_KEY,
+            constants.REDIS_LIMITS_HASHNAME,
+        )
+        for prefix in [
+            constants.REDIS_WINDOW_PREFIX,
+            constants.REDIS_NOTIFICATION_PREFIX,
+        ]:
+            for key in self.rclient.scan_iter(prefix + ":*"):
+                self.rclient.delete(key)
+        # Operations buffered by setUpTestData are never committed
+        transaction.get_connection().policyd_pending_operations = None
 
 
 class PolicyDaemonTestCase(RedisTestCaseMixin, ParametersMixin, TransactionTestCase):
@@ -89,9 +108,9 @@ class PolicyDaemonTestCase(RedisTestCaseMixin, ParametersMixin, TransactionTestC
         self.process.terminate()
         self.process.join()
 
-    def connect_to_daemon(self):
+    def connect_to_daemon(self, port=9999):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(("127.0.0.1", 9999))
+        s.connect(("127.0.0.1", port))
         return s
 
     def test_daemon_starts(self):
@@ -101,6 +120,137 @@ class PolicyDaemonTestCase(RedisTestCaseMixin, ParametersMixin, TransactionTestC
         self.assertEqual(res, b"action=dunno\n\n")
         s.close()
 
+    def test_persistent_connection(self):
+        self.set_domain_limit("test.com", 2)
+        s = self.connect_to_daemon()
+        request = b"protocol_state=RCPT\nsasl_username=user@test.com\n\n"
+        for i in range(2):
+            s.send(request)
+            self.assertEqual(s.recv(1024), b"action=dunno\n\n")
+        s.send(request)
+        self.assertEqual(
+            s.recv(1024), b"action=defer_if_permit Daily limit reached, retry later\n\n"
+        )
+        s.close()
+
+    def test_max_requests_per_connection(self):
+        process = Process(
+            target=start_policy_daemon, args=("--port", "9998", "--max-requests", "2")
+        )
+        process.start()
+        try:
+            # Wait a bit for the daemon to start
+            time.sleep(0.5)
+            s = self.connect_to_daemon(9998)
+            for i in range(2):
+                s.send(b"protocol_state=RCPT\n\n")
+                self.assertEqual(s.recv(1024), b"action=dunno\n\n")
+            # Connection is closed by the daemon
+            self.assertEqual(s.recv(1024), b"")
+            s.close()
+        finally:
+            process.terminate()
+            process.join()
+
+    def get_metrics(self, port):
+        """Return the response of the metrics listener."""
+        s = self.connect_to_daemon(port)
+        s.send(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            response += data
+        s.close()
+        return response
+
+    def test_metrics(self):
+        process = Process(
+            target=start_policy_daemon,
+            args=("--port", "9998", "--metrics-port", "9997"),
+        )
+        process.start()
+        try:
+            # Wait a bit for the daemon to start
+            time.sleep(0.5)
+            s = self.connect_to_daemon(9998)
+            s.send(b"protocol_state=RCPT\n\n")
+            self.assertEqual(s.recv(1024), b"action=dunno\n\n")
+            s.close()
+
+            response = self.get_metrics(9997)
+        finally:
+            process.terminate()
+            process.join()
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK"))
+        self.assertIn(
+            b'policyd_requests_total{state="RCPT",action="dunno"} 1', response
+        )
+        self.assertIn(b"policyd_decision_duration_seconds_count 1", response)
+        self.assertIn(b"policyd_open_connections 0", response)
+
+    def test_daemon_with_workers(self):
+        process = Process(
+            target=start_policy_daemon, args=("--port", "9998", "--workers", "2")
+        )
+        process.start()
+        try:
+            # Wait a bit for workers to start
+            time.sleep(1)
+            for i in range(4):
+                s = self.connect_to_daemon(9998)
+                s.send(b"protocol_state=RCPT\n\n")
+                self.assertEqual(s.recv(1024), b"action=dunno\n\n")
+                s.close()
+
+            # Reload workers, service must not be interrupted
+            os.kill(process.pid, signal.SIGHUP)
+            for i in range(10):
+                s = self.connect_to_daemon(9998)
+                s.send(b"protocol_state=RCPT\n\n")
+                self.assertEqual(s.recv(1024), b"action=dunno\n\n")
+                s.close()
+                time.sleep(0.1)
+        finally:
+            process.terminate()
+            process.join()
+        self.assertEqual(process.exitcode, 0)
+
+    def test_reload_with_metrics(self):
+        process = Process(
+            target=start_policy_daemon,
+            args=("--port", "9998", "--workers", "2", "--metrics-port", "9996"),
+        )
+        process.start()
+        try:
+            # Wait a bit for workers to start
+            time.sleep(1)
+            # Act as old workers still handling a request: metrics
+            # ports are not released yet
+            holders = []
+            for port in (9996, 9997):
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                s.bind(("127.0.0.1", port))
+                s.listen()
+                holders.append(s)
+            os.kill(process.pid, signal.SIGHUP)
+            for i in range(10):
+                s = self.connect_to_daemon(9998)
+                s.send(b"protocol_state=RCPT\n\n")
+                self.assertEqual(s.recv(1024), b"action=dunno\n\n")
+                s.close()
+                time.sleep(0.2)
+            for s in holders:
+                s.close()
+            for port in (9996, 9997):
+                self.assertTrue(self.get_metrics(port).startswith(b"HTTP/1.0 200 OK"))
+        finally:
+            process.terminate()
+            process.join()
+        self.assertEqual(process.exitcode, 0)
+
     def test_domain_limit(self):
         domain = self.set_domain_limit("test.com", 2)
         s = self.connect_to_daemon()
@@ -207,6 +357,7 @@ sasl_username=user@test.com
 
         async def run_test():
             await policyd_core.reset_counters()
+            await policyd_core.close_redis_client()
 
         # Run the async test
         event_loop.run_until_complete(run_test())
@@ -215,6 +366,289 @@ sasl_username=user@test.com
         self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, domain.name), 20)
         self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, account.email), 10)
 
+    def test_load_message_limits(self):
+        domain = self.set_domain_limit("test.com", 20)
+        account = self.set_account_limit("user@test.com", 10)
+        self.rclient.delete(constants.REDIS_LIMITS_HASHNAME)
+
+        async def run_test():
+            await policyd_core.load_message_limits()
+            await policyd_core.close_redis_client()
+
+        asyncio.run(run_test())
+        self.assertEqual(
+            self.rclient.hget(constants.REDIS_LIMITS_HASHNAME, domain.name), 20
+        )
+        self.assertEqual(
+            self.rclient.hget(constants.REDIS_LIMITS_HASHNAME, account.email), 10
+        )
+
+
+class CheckLimitsTestCase(RedisTestCaseMixin, SimpleTestCase):
+    """Test cases for the server-side limit check.
+
+    A redis instance is required to run those tests.
+    """
+
+    def run_check_limits(self, names):
+        async def run_test():
+            try:
+                return await policyd_core.check_limits(names)
+            finally:
+                await policyd_core.close_redis_client()
+
+        return asyncio.run(run_test())
+
+    def test_check_limits(self):
+        names = ["test.com", "user@test.com"]
+        self.assertEqual(self.run_check_limits(names), (True, [None, None]))
+
+        self.rclient.hset(constants.REDIS_HASHNAME, "test.com", 2)
+        self.rclient.hset(constants.REDIS_HASHNAME, "user@test.com", 1)
+        self.assertEqual(self.run_check_limits(names), (True, [1, 0]))
+
+        # Nothing is decremented when one counter is exhausted
+        self.assertEqual(self.run_check_limits(names), (False, [1, 0]))
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 1)
+
+    @override_settings(POLICYD_COUNTER_MODE=constants.COUNTER_MODE_WINDOW)
+    def test_check_window_limits(self):
+        names = ["test.com", "user@test.com"]
+        self.assertEqual(self.run_check_limits(names), (True, [None, None]))
+
+        self.rclient.hset(constants.REDIS_LIMITS_HASHNAME, "test.com", 2)
+        self.rclient.hset(constants.REDIS_LIMITS_HASHNAME, "user@test.com", 1)
+        self.assertEqual(self.run_check_limits(names), (True, [1, 0]))
+        self.assertEqual(self.run_check_limits(names), (False, [1, 0]))
+
+        window, window_end = utils.get_current_window()
+        key = utils.get_window_counter_key(window, "test.com")
+        self.assertEqual(self.rclient.get(key), b"1")
+        self.assertTrue(0 < self.rclient.ttl(key) <= window_end - time.time() + 1)
+        self.assertEqual(utils.get_message_counter("user@test.com"), 0)
+
+        # A new window starts with fresh counters
+        self.rclient.delete(key, utils.get_window_counter_key(window, "user@test.com"))
+        self.assertEqual(self.run_check_limits(names), (True, [1, 0]))
+
+    @override_settings(
+        POLICYD_COUNTER_MODE=constants.COUNTER_MODE_LEASE, POLICYD_LEASE_SIZE=2
+    )
+    def test_check_leased_limits(self):
+        self.rclient.hset(constants.REDIS_HASHNAME, "test.com", 3)
+
+        async def run_test():
+            results = [await policyd_core.check_limits(["test.com"]) for i in range(4)]
+            await policyd_core.release_leases()
+            await policyd_core.close_redis_client()
+            return results
+
+        self.assertEqual(
+            asyncio.run(run_test()),
+            [(True, [2]), (True, [1]), (True, [0]), (False, [0])],
+        )
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 0)
+
+    @override_settings(
+        POLICYD_COUNTER_MODE=constants.COUNTER_MODE_LEASE, POLICYD_LEASE_SIZE=5
+    )
+    def test_release_leases(self):
+        self.rclient.hset(constants.REDIS_HASHNAME, "test.com", 10)
+
+        async def run_test(reset=False):
+            result = await policyd_core.check_limits(["test.com", "user@test.com"])
+            if reset:
+                self.rclient.hset(constants.REDIS_HASHNAME, "test.com", 10)
+                self.rclient.incr(constants.REDIS_GENERATION_KEY)
+            await policyd_core.release_leases()
+            await policyd_core.close_redis_client()
+            return result
+
+        self.assertEqual(asyncio.run(run_test()), (True, [9, None]))
+        # Unused tokens are given back
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 9)
+
+        # Tokens leased before a reset are dropped
+        asyncio.run(run_test(reset=True))
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 10)
+
+    @override_settings(POLICYD_COUNTER_WINDOW="hour")
+    def test_get_current_window(self):
+        now = timezone.localtime()
+        window, window_end = utils.get_current_window(now)
+        self.assertEqual(window, now.strftime("%Y%m%d%H"))
+        self.assertTrue(0 < window_end - now.timestamp() <= 3600)
+
+
+class NotificationDispatcherTestCase(RedisTestCaseMixin, TransactionTestCase):
+    """Test cases for limit reached notifications."""
+
+    def setUp(self):
+        super().setUp()
+        call_command("load_initial_data")
+        admin_factories.populate_database()
+        admin = core_models.User.objects.get(username="admin@test.com")
+        admin.is_superuser = True
+        admin.save()
+
+    def get_dispatcher(self, **kwargs):
+        """Return a dispatcher (to create from the event loop)."""
+        rclient = aioredis.Redis.from_url(settings.REDIS_URL)
+        return notifications.NotificationDispatcher(rclient, **kwargs)
+
+    def test_notify_once_per_day(self):
+        async def notify():
+            dispatcher = self.get_dispatcher()
+            with mock.patch.object(dispatcher, "process") as process:
+                result = [
+                    dispatcher.notify("domain", "test.com"),
+                    dispatcher.notify("domain", "test.com"),
+                    dispatcher.notify("account", "user@test.com"),
+                ]
+                await dispatcher.close()
+            return result, process.call_args_list
+
+        result, calls = asyncio.run(notify())
+        self.assertEqual(result, [True, False, True])
+        self.assertEqual(
+            calls, [mock.call([("domain", "test.com"), ("account", "user@test.com")])]
+        )
+
+    def test_notify_queue_full(self):
+        async def notify():
+            dispatcher = self.get_dispatcher(max_pending=1)
+            with mock.patch.object(dispatcher, "process"):
+                result = [
+                    dispatcher.notify("domain", "test.com"),
+                    dispatcher.notify("domain", "test2.com"),
+                ]
+                await dispatcher.task
+                # Dropped notifications can be sent later
+                result.append(dispatcher.notify("domain", "test2.com"))
+                await dispatcher.close()
+            return result
+
+        self.assertEqual(asyncio.run(notify()), [True, False, True])
+
+    def test_notify_once_per_day_all_workers(self):
+        async def notify():
+            calls = []
+            # Several workers, or a reloaded one
+            for _ in range(2):
+                dispatcher = self.get_dispatcher()
+                with mock.patch.object(dispatcher, "process") as process:
+                    dispatcher.notify("domain", "test.com")
+                    await dispatcher.close()
+                calls += process.call_args_list
+            return calls
+
+        calls = asyncio.run(notify())
+        self.assertEqual(calls, [mock.call([("domain", "test.com")])])
+        key = "{}:{}:domain:test.com".format(
+            constants.REDIS_NOTIFICATION_PREFIX,
+            timezone.localdate().strftime("%Y%m%d"),
+        )
+        self.assertTrue(0 < self.rclient.ttl(key) <= 24 * 3600)
+
+    def test_send_notifications(self):
+        async def notify():
+            dispatcher = self.get_dispatcher()
+            dispatcher.notify("domain", "test.com")
+            dispatcher.notify("account", "user@test.com")
+            await dispatcher.close()
+
+        with mock.patch("modoboa.policyd.notifications.aiosmtplib.SMTP") as smtp:
+            smtp.return_value.__aenter__.return_value = smtp.return_value
+            smtp.return_value.send_message = AsyncMock()
+            asyncio.run(notify())
+        self.assertEqual(smtp.call_count, 1)
+        messages = [
+            call.args[0] for call in smtp.return_value.send_message.call_args_list
+        ]
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0]["To"], "admin@test.com")
+        self.assertTrue(
+            admin_models.Alarm.objects.filter(
+                domain__name="test.com", mailbox__isnull=True
+            ).exists()
+        )
+        self.assertTrue(
+            admin_models.Alarm.objects.filter(
+                mailbox__address="user", mailbox__domain__name="test.com"
+            ).exists()
+        )
+
+
+class BenchmarkTestCase(RedisTestCaseMixin, SimpleTestCase):
+    """Test cases for the benchmark tool."""
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile([3], 95), 3)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_run(self):
+        # Metrics would be inherited by daemons started by other tests
+        for metric in metrics.REGISTRY:
+            self.addCleanup(metric.reset)
+        scenario = benchmark.Scenario(
+            senders=10, domains=2, limited_ratio=0.5, limit=1000, seed=1
+        )
+        requests = scenario.build_requests(50)
+        self.assertIn(b"protocol_state=RCPT\n", requests[0])
+        self.assertTrue(requests[0].endswith(b"\n\n"))
+
+        async def run():
+            rclient = policyd_core.get_redis_client()
+            await scenario.setup(rclient)
+            server, port = await benchmark.start_local_daemon()
+            try:
+                results = await benchmark.Benchmark(
+                    "127.0.0.1", port, requests, connections=5, requests_per_connection=4
+                ).run()
+            finally:
+                await benchmark.stop_local_daemon(server)
+            counters = await rclient.hgetall(constants.REDIS_HASHNAME)
+            await scenario.cleanup(rclient)
+            await policyd_core.close_redis_client()
+            return results, counters
+
+        results, counters = asyncio.run(run())
+        self.assertEqual(results["requests"], 50)
+        self.assertEqual(results["errors"], 0)
+        self.assertEqual(results["actions"], {"dunno": 50})
+        self.assertLessEqual(results["p50"], results["p99"])
+        self.assertEqual(sorted(counters), sorted(scenario.limited))
+        self.assertFalse(self.rclient.exists(constants.REDIS_HASHNAME))
+
+
+class MetricsTestCase(SimpleTestCase):
+    """Test cases for metrics."""
+
+    def test_render(self):
+        counter = metrics.Counter("test_total", "A counter.", ["action"])
+        histogram = metrics.Histogram("test_seconds", "A histogram.", buckets=[1, 2])
+        try:
+            counter.inc(action='say "hello"')
+            counter.inc(2, action='say "hello"')
+            histogram.observe(0.5)
+            histogram.observe(1.5)
+            content = metrics.render()
+        finally:
+            metrics.REGISTRY.remove(counter)
+            metrics.REGISTRY.remove(histogram)
+        self.assertIn("# TYPE test_total counter\n", content)
+        self.assertIn('test_total{action="say \\"hello\\""} 3\n', content)
+        self.assertIn('test_seconds_bucket{le="1"} 1\n', content)
+        self.assertIn('test_seconds_bucket{le="2"} 2\n', content)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2\n', content)
+        self.assertIn("test_seconds_sum 2\n", content)
+        self.assertIn("test_seconds_count 2\n", content)
+        with self.assertRaises(ValueError):
+            counter.inc(state="RCPT")
+
 
 class ModelsTestCase(RedisTestCaseMixin, ModoTestCase):
     """Admin models test cases."""
@@ -228,7 +662,8 @@ class ModelsTestCase(RedisTestCaseMixin, ModoTestCase):
     def test_domain_detail_view(self):
         domain = admin_models.Domain.objects.get(name="test.com")
         domain.message_limit = 10
-        domain.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            domain.save()
         url = reverse("admin:domain_detail", args=[domain.pk])
         response = self.client.get(url)
         self.assertContains(response, "Message sending limit")
@@ -237,7 +672,8 @@ class ModelsTestCase(RedisTestCaseMixin, ModoTestCase):
         account = core_models.User.objects.get(username="user@test.com")
         mb = account.mailbox
         mb.message_limit = 10
-        mb.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            mb.save()
 
         url = reverse("admin:account_detail", args=[account.pk])
         response = self.client.get(url)
@@ -246,7 +682,8 @@ class ModelsTestCase(RedisTestCaseMixin, ModoTestCase):
     def test_domain_signal_handler(self):
         domain = admin_models.Domain.objects.get(name="test.com")
         domain.message_limit = 10
-        domain.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            domain.save()
         self.assertEqual(
             self.rclient.hget(constants.REDIS_HASHNAME, domain.name),
             domain.message_limit,
@@ -255,12 +692,228 @@ class ModelsTestCase(RedisTestCaseMixin, ModoTestCase):
         # Force constructor call to fill _loaded_values
         domain = admin_models.Domain.objects.get(name="test.com")
         domain.message_limit = 50
-        domain.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            domain.save()
         self.assertEqual(
             self.rclient.hget(constants.REDIS_HASHNAME, domain.name),
             domain.message_limit,
         )
 
+        self.assertEqual(
+            self.rclient.hget(constants.REDIS_LIMITS_HASHNAME, domain.name),
+            domain.message_limit,
+        )
+
         domain.message_limit = None
-        domain.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            domain.save()
         self.assertFalse(self.rclient.hexists(constants.REDIS_HASHNAME, domain.name))
+        self.assertFalse(
+            self.rclient.hexists(constants.REDIS_LIMITS_HASHNAME, domain.name)
+        )
+
+    def test_signal_handler_batches_operations(self):
+        domains = admin_models.Domain.objects.filter(name__in=["test.com", "test2.com"])
+        with mock.patch.object(
+            utils, "get_redis_connection", wraps=utils.get_redis_connection
+        ) as get_connection:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    for domain in domains:
+                        domain.message_limit = 10
+                        domain.save()
+                        for mb in domain.mailbox_set.all():
+                            mb.message_limit = 5
+                            mb.save()
+                self.assertFalse(
+                    self.rclient.hexists(constants.REDIS_HASHNAME, "test.com")
+                )
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 10)
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test2.com"), 10)
+        self.assertEqual(
+            self.rclient.hget(constants.REDIS_HASHNAME, "admin@test.com"), 5
+        )
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "user@test.com"), 5)
+
+    def test_signal_handler_rollback(self):
+        domain = admin_models.Domain.objects.get(name="test.com")
+        mb = admin_models.Mailbox.objects.get(address="user", domain=domain)
+        with self.captureOnCommitCallbacks(execute=True):
+            domain.message_limit = 10
+            domain.save()
+            try:
+                with transaction.atomic():
+                    mb.message_limit = 10
+                    mb.save()
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 10)
+        self.assertFalse(
+            self.rclient.hexists(constants.REDIS_HASHNAME, "user@test.com")
+        )
+
+    def test_signal_handler_rollback_first_savepoint(self):
+        domain = admin_models.Domain.objects.get(name="test.com")
+        mb = admin_models.Mailbox.objects.get(address="user", domain=domain)
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    mb.message_limit = 10
+                    mb.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            domain.message_limit = 10
+            domain.save()
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 10)
+        self.assertFalse(
+            self.rclient.hexists(constants.REDIS_HASHNAME, "user@test.com")
+        )
+
+    def test_signal_handler_order(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            domain = admin_models.Domain.objects.get(name="test.com")
+            domain.message_limit = 10
+            domain.save()
+            with transaction.atomic():
+                domain = admin_models.Domain.objects.get(name="test.com")
+                domain.message_limit = None
+                domain.save()
+            domain = admin_models.Domain.objects.get(name="test.com")
+            domain.message_limit = 20
+            domain.save()
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 20)
+        self.assertEqual(
+            self.rclient.hget(constants.REDIS_LIMITS_HASHNAME, "test.com"), 20
+        )
+
+
+@override_settings(POLICYD_POLICY_SNAPSHOT=True)
+class PolicySnapshotTestCase(RedisTestCaseMixin, ModoTestCase):
+    """Policy snapshot test cases."""
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create test data."""
+        super().setUpTestData()
+        admin_factories.populate_database()
+
+    def test_load(self):
+        mb = admin_models.Mailbox.objects.get(address="user", domain__name="test.com")
+        mb.is_send_only = True
+        mb.save()
+        mb.senderaddress_set.create(address="user@extra.com")
+        mb.senderaddress_set.create(address="@other.com")
+        admin_models.Domain.objects.filter(name="test2.com").update(enabled=False)
+
+        policy = snapshot.PolicySnapshot()
+        policy.load()
+        self.assertTrue(policy.is_domain_enabled("test.com"))
+        self.assertFalse(policy.is_domain_enabled("test2.com"))
+        self.assertIsNone(policy.is_domain_enabled("unknown.com"))
+        self.assertTrue(policy.is_send_only("user@test.com"))
+        self.assertFalse(policy.is_send_only("admin@test.com"))
+        self.assertTrue(policy.is_mailbox_active("admin@test.com"))
+        self.assertFalse(policy.is_mailbox_active("unknown@test.com"))
+        self.assertTrue(policy.is_sender_allowed("user@test.com", "user@test.com"))
+        self.assertTrue(policy.is_sender_allowed("user@test.com", "user@extra.com"))
+        self.assertTrue(policy.is_sender_allowed("user@test.com", "any@other.com"))
+        self.assertFalse(policy.is_sender_allowed("user@test.com", "admin@test.com"))
+        self.assertFalse(policy.is_sender_allowed("admin@test.com", "user@test.com"))
+
+    def subscribe(self):
+        """Return a function returning published events."""
+        pubsub = self.rclient.pubsub()
+        pubsub.subscribe(constants.REDIS_POLICY_CHANNEL)
+        self.addCleanup(pubsub.close)
+
+        def get_events():
+            events = []
+            while True:
+                message = pubsub.get_message(timeout=0.1)
+                if message is None:
+                    return events
+                if message["type"] == "message":
+                    events.append(message["data"].decode())
+
+        return get_events
+
+    def test_refresh(self):
+        policy = snapshot.PolicySnapshot()
+        policy.load()
+        get_events = self.subscribe()
+
+        account = core_models.User.objects.get(username="user@test.com")
+        with self.captureOnCommitCallbacks(execute=True):
+            account.is_active = False
+            account.save()
+            account.mailbox.senderaddress_set.create(address="user@extra.com")
+        events = get_events()
+        self.assertEqual(set(events), {"mailbox:user@test.com"})
+        for event in events:
+            policy.refresh(event)
+        self.assertFalse(policy.is_mailbox_active("user@test.com"))
+        self.assertTrue(policy.is_sender_allowed("user@test.com", "user@extra.com"))
+
+        domain = admin_models.Domain.objects.get(name="test2.com")
+        mb = admin_models.Mailbox.objects.get(address="user", domain=domain)
+        with self.captureOnCommitCallbacks(execute=True):
+            domain.enabled = False
+            domain.save()
+            mb.delete()
+        events = get_events()
+        self.assertIn("domain:test2.com", events)
+        self.assertIn("mailbox:user@test2.com", events)
+        for event in events:
+            policy.refresh(event)
+        self.assertFalse(policy.is_domain_enabled("test2.com"))
+        self.assertIsNone(policy.get_mailbox_flags("user@test2.com"))
+
+        domain = admin_models.Domain.objects.get(name="test.com")
+        domain.name = "renamed.com"
+        with self.captureOnCommitCallbacks(execute=True):
+            domain.save()
+        self.assertEqual(get_events(), ["reload"])
+        policy.refresh("reload")
+        self.assertTrue(policy.is_domain_enabled("renamed.com"))
+        self.assertTrue(policy.is_mailbox_active("admin@renamed.com"))
+        self.assertIsNone(policy.get_mailbox_flags("admin@test.com"))
+
+    def test_unrelated_changes(self):
+        get_events = self.subscribe()
+        account = core_models.User.objects.get(username="user@test.com")
+        with self.captureOnCommitCallbacks(execute=True):
+            account.last_login = timezone.now()
+            account.save(update_fields=["last_login"])
+            account.first_name = "Homer"
+            account.save()
+            account.mailbox.message_limit = 10
+            account.mailbox.save()
+            domain = admin_models.Domain.objects.get(name="test.com")
+            domain.message_limit = 10
+            domain.save()
+        self.assertEqual(get_events(), [])
+
+        with override_settings(POLICYD_POLICY_SNAPSHOT=False):
+            with self.captureOnCommitCallbacks(execute=True):
+                account.is_active = False
+                account.save()
+        self.assertEqual(get_events(), [])
+
+    def test_refresh_retry(self):
+        conn = mock.Mock()
+        with mock.patch.object(
+            snapshot.PolicySnapshot,
+            "refresh",
+            side_effect=[None, DatabaseError, None],
+        ) as refresh, mock.patch.object(policyd_core, "connections") as connections:
+            connections.all.return_value = [conn]
+            async_to_sync(policyd_core.refresh_policy_snapshot)("reload")
+            # The connection is kept open
+            conn.close.assert_not_called()
+            # Lost connection
+            async_to_sync(policyd_core.refresh_policy_snapshot)("reload")
+        conn.close.assert_called_once_with()
+        self.assertEqual(refresh.call_count, 3)
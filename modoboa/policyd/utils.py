@@ -1,22 +1,77 @@
 """Tooling."""
 
+import datetime
+
 import redis
 
 from django.conf import settings
+from django.utils import timezone
 
 from . import constants
 
+_connection_pool = None
+
+
+def get_connection_pool():
+    """Return the connection pool shared by synchronous clients."""
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = redis.ConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_QUOTA_DB,
+        )
+    return _connection_pool
+
 
 def get_redis_connection():
     """Return a client connection to Redis server."""
-    rclient = redis.Redis(
-        host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_QUOTA_DB
-    )
+    rclient = redis.Redis(connection_pool=get_connection_pool())
     rclient.set_response_callback("HGET", int)
     return rclient
 
 
+def get_counter_mode():
+    """Return the way message counters are stored."""
+    return getattr(settings, "POLICYD_COUNTER_MODE", constants.COUNTER_MODE_HASH)
+
+
+def is_policy_snapshot_enabled():
+    """Tell if daemons maintain a snapshot of policy attributes.
+
+    Disabled by default since no check uses it yet.
+    """
+    return getattr(settings, "POLICYD_POLICY_SNAPSHOT", False)
+
+
+def get_current_window(now=None):
+    """Return the identifier and the end timestamp of the current window.
+
+    The window duration is defined by the POLICYD_COUNTER_WINDOW
+    setting (day or hour).
+    """
+    window = getattr(settings, "POLICYD_COUNTER_WINDOW", "day")
+    now = timezone.localtime(now)
+    if window == "hour":
+        start = now.replace(minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(hours=1)
+    else:
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(days=1)
+    return start.strftime(constants.COUNTER_WINDOWS[window]), int(end.timestamp())
+
+
+def get_window_counter_key(window, name):
+    """Return the key of the counter for name during window."""
+    return "{}:{}:{}".format(constants.REDIS_WINDOW_PREFIX, window, name)
+
+
 def get_message_counter(key):
     """Return current counter for given key."""
     rclient = get_redis_connection()
-    return rclient.hget(constants.REDIS_HASHNAME, key)
+    if get_counter_mode() != constants.COUNTER_MODE_WINDOW:
+        return rclient.hget(constants.REDIS_HASHNAME, key)
+    limit = rclient.hget(constants.REDIS_LIMITS_HASHNAME, key)
+    window = get_current_window()[0]
+    sent = rclient.get(get_window_counter_key(window, key))
+    return limit - int(sent or 0)